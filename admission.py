@@ -0,0 +1,82 @@
+"""Admission control for /ask: rate limits, priorities and load shedding.
+
+- per-user and per-team rate limits (fixed one minute windows in Redis)
+- direct messages go to the 'high' queue, channels to 'default'; workers
+  always drain 'high' first
+- backpressure: a question is rejected right away when the oldest job of
+  its queue has already waited longer than ASK_MAX_QUEUE_WAIT
+"""
+import time
+from datetime import datetime
+from redis import Redis
+from rq import Queue
+from rq.job import Job
+
+import settings
+
+
+HIGH_PRIORITY_QUEUE = 'high'
+DEFAULT_QUEUE = 'default'
+QUEUES = (HIGH_PRIORITY_QUEUE, DEFAULT_QUEUE)
+
+BUSY_MESSAGE = "Sorry, I'm busy right now, please try again in a few minutes."
+RATE_LIMITED_MESSAGE = "Sorry, too many questions, please try again in a minute."
+
+
+def queue_wait(queue):
+    """Seconds the oldest job of the queue has been waiting."""
+    job_ids = queue.get_job_ids(0, 1)
+    if not job_ids:
+        return 0.0
+    try:
+        job = Job.fetch(job_ids[0], connection=queue.connection)
+    except Exception:
+        return 0.0
+    if job.enqueued_at is None:
+        return 0.0
+    return (datetime.utcnow() - job.enqueued_at).total_seconds()
+
+
+def job_age(job):
+    """Seconds since the question was asked, retries included."""
+    if job is None:
+        return 0.0
+    asked_at = job.meta.get('asked_at')
+    if asked_at is None:
+        return 0.0
+    return time.time() - asked_at
+
+
+class Admission(object):
+    def __init__(self, conn=None):
+        self.conn = conn or Redis()
+        self.user_limit = getattr(settings, 'ASK_RATE_LIMIT_USER', 5)
+        self.team_limit = getattr(settings, 'ASK_RATE_LIMIT_TEAM', 60)
+        self.max_queue_wait = getattr(settings, 'ASK_MAX_QUEUE_WAIT', 60)
+
+    def queue_name(self, channel_name):
+        if channel_name == 'directmessage':
+            return HIGH_PRIORITY_QUEUE
+        return DEFAULT_QUEUE
+
+    def _over_limit(self, key, limit):
+        if not limit:
+            return False
+        window = int(time.time() // 60)
+        key = f'askme:ratelimit:{key}:{window}'
+        pipe = self.conn.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, 120)
+        count, _ = pipe.execute()
+        return count > limit
+
+    def admit(self, team_id, user_id, channel_name):
+        """Return (queue_name, None) or (None, reason) when the question is rejected."""
+        if self._over_limit(f'user:{team_id}:{user_id}', self.user_limit):
+            return None, 'rate_limited_user'
+        if self._over_limit(f'team:{team_id}', self.team_limit):
+            return None, 'rate_limited_team'
+        name = self.queue_name(channel_name)
+        if self.max_queue_wait and queue_wait(Queue(name, connection=self.conn)) > self.max_queue_wait:
+            return None, 'busy'
+        return name, None
@@ -1,23 +1,37 @@
 import os
 import json
+import time
 import uuid
 import traceback
 from datetime import datetime
 from redis import Redis
-from rq import Queue, Retry
-import requests
-from flask import Flask, jsonify, request
+from rq import Queue, Retry, get_current_job
+from flask import Flask, Response, jsonify, request
 from faqbot import FAQBot
+import vectordb
+from index_versions import IndexVersions, is_versioned, index_version
+from admission import Admission, QUEUES, BUSY_MESSAGE, RATE_LIMITED_MESSAGE, job_age
+from precompute import record_question, lookup as precomputed_lookup
+import query_log
+import metrics
+import profiler
+import resilience
+import delivery
+import knowledge_bases
 import settings
 
 app = Flask(__name__)
 app.debug = True
 
-def enqueue_question(func, api_id, question, response_url):
-    q = Queue(connection=Redis())
-    return q.enqueue(func, api_id, question, response_url, 
+def enqueue_question(func, api_id, question, response_url, queue_name='default', kb=None):
+    q = Queue(queue_name, connection=Redis())
+    # the question deadline bounds the job, retries included
+    timeout = getattr(settings, 'FAQBOT_DEADLINE', 0) or settings.OPENAI_REQUEST_TIMEOUT
+    return q.enqueue(func, api_id, question, response_url, kb=kb,
                      retry=Retry(max=3), 
-                     job_timeout=settings.OPENAI_REQUEST_TIMEOUT*2)
+                     job_timeout=int(timeout)*2,
+                     # kept across retries, used to drop stale questions
+                     meta={'asked_at': time.time()})
 
 
 class Logger(object):
@@ -65,6 +79,12 @@ class APIResponse(object):
         self.log.error('Access denied', **data)
         return jsonify(data), 403
 
+    def unavailable(self, msg, **data):
+        data['status'] = 'unavailable'
+        data['error'] = msg
+        self.log.error(msg, **data)
+        return jsonify(data), 503
+
     def success(self, msg, **data):
         data['status'] = 'success'
         self.log.info(msg, **data)
@@ -85,6 +105,56 @@ def index():
 def status():
     return APIResponse().success("OK")
 
+def index_available(database=None):
+    database = database or settings.VECTOR_DATABASE
+    if is_versioned(database):
+        return IndexVersions(database).current() is not None
+    if database.startswith('multi://'):
+        return bool(vectordb.multi_read_manifest(vectordb.multi_directory(database)))
+    # FAISS is a local file, the other engines are remote services
+    if '://' in database or database in ('mock', 'dummy'):
+        return True
+    return os.path.exists(database)
+
+def queue_depths(conn):
+    """Jobs waiting in each queue, high priority included."""
+    return {name: len(Queue(name, connection=conn)) for name in QUEUES}
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    api = APIResponse()
+    try:
+        conn = Redis()
+        depths = queue_depths(conn)
+        gauges = metrics.get_gauges(conn)
+    except Exception as e:
+        return api.unavailable('Redis not available', error=str(e))
+    kbs = knowledge_bases.knowledge_bases()
+    available = {name: index_available(kb.vector_database) for name, kb in kbs.items()}
+    data = {'index_available': all(available.values()),
+            'index_loaded_at': gauges.get('askme_index_loaded_timestamp_seconds'),
+            'index_load_seconds': gauges.get('askme_index_load_seconds'),
+            'index_cache_bytes': gauges.get('askme_index_cache_bytes'),
+            'queue_depth': sum(depths.values()),
+            'queue_depths': depths}
+    if len(kbs) > 1:
+        data['knowledge_bases'] = available
+    default = knowledge_bases.get()
+    if is_versioned(default.vector_database):
+        data['index_version'] = IndexVersions(default.vector_database).current()
+    if not data['index_available']:
+        return api.unavailable('Index not available', **data)
+    return api.success('Ready', **data)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    try:
+        conn = Redis()
+        body = metrics.render(conn, {'askme_queue_depth': sum(queue_depths(conn).values())})
+    except Exception as e:
+        return APIResponse().error('Metrics not available', error=str(e))
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
 @app.route('/dump', methods=['POST'])
 def dump():
     api = APIResponse()
@@ -111,7 +181,11 @@ def ask_bot():
         try:
             token_id = request.form['token']
             user_name = request.form.get('user_name', None)
+            user_id = request.form.get('user_id', user_name)
+            team_id = request.form.get('team_id', None)
             team_domain = request.form.get('team_domain', None)
+            channel_name = request.form.get('channel_name', None)
+            channel_id = request.form.get('channel_id', None)
         except KeyError:
             return api.denied()
 
@@ -119,7 +193,8 @@ def ask_bot():
             return api.denied()
 
         cmd = request.form['command']
-        if cmd != '/askplivo':
+        kb = knowledge_bases.select(cmd, channel_name, channel_id)
+        if kb is None:
             return api.error('Invalid command')
         question = request.form['text']
         response_url = request.form['response_url']
@@ -135,20 +210,198 @@ def ask_bot():
     if not question:
         return api.error('Invalid request, no question provided (empty)')
 
-    api.get_log().info('Processing the question ...', question=question, response_url=response_url)
-    job = enqueue_question(ask_bot_async, api.get_api_id(), question, response_url)
+    with metrics.Spans(api.get_api_id()) as spans:
+        spans.incr('askme_kb_questions_total', kb=kb)
+        # a frequent question is answered right away, without queuing nor admission
+        json_response = precomputed_answer(api, question, kb)
+        if json_response is None:
+            queue_name, reason = Admission().admit(team_id or team_domain, user_id, channel_name)
+            spans.incr('askme_admission_total', result=reason or queue_name)
+    spans.flush()
+    if json_response is not None:
+        record_question(question)
+        api.get_log().info('Answered from the precomputed answers', question=question)
+        return jsonify(json_response), 200
+    if reason is not None:
+        api.get_log().warning('Question rejected', reason=reason, user_name=user_name, team_domain=team_domain)
+        message = BUSY_MESSAGE if reason == 'busy' else RATE_LIMITED_MESSAGE
+        return jsonify({
+                "response_type": "ephemeral",
+                "text": f"*TicketID*: {api.get_api_id()}\n{message}\n"
+        }), 200
+
+    # mined off-peak for the questions worth precomputing
+    record_question(question)
+    api.get_log().info('Processing the question ...', question=question, response_url=response_url, queue=queue_name, kb=kb)
+    job = enqueue_question(ask_bot_async, api.get_api_id(), question, response_url, queue_name, kb)
     api.get_log().info('Started background job', job=job)
     return jsonify({
             "response_type": "in_channel",
             "text": f"*TicketID*: {api.get_api_id()}\n_Processing your question, please wait..._\n"
     }), 200
 
-def ask_bot_async(api_id, question, response_url):
+def precomputed_answer(api, question, kb):
+    """Slack message of the precomputed answer of a question, None to queue it.
+    The web processes load no index nor embeddings: exact matches only (the
+    similar questions are matched by the workers)."""
+    if kb != knowledge_bases.default_name() or not getattr(settings, 'FAQBOT_PRECOMPUTED', True):
+        return None
+    start = time.perf_counter()
+    default = knowledge_bases.get(kb)
+    vector_url = default.vector_database
+    if is_versioned(vector_url):
+        vector_url = IndexVersions(vector_url).current_url()
+        if vector_url is None:
+            return None
+    version = index_version(vector_url, default.vector_database, default.index_name)
+    with metrics.span('precomputed'):
+        response = precomputed_lookup(question, version)
+    metrics.incr('askme_precomputed_answers_total', result='hit' if response else 'miss')
+    if response is None:
+        return None
+    query_log.append(question, origin='slack', ticket=api.get_api_id(), index_version=version,
+                     precomputed=True, seconds=round(time.perf_counter() - start, 4))
+    metrics.incr('askme_questions_total', status='success')
+    return slack_answer(api, question, response)
+
+def slack_answer(api, question, response):
+    """Slack message of an answer: {'answer', 'sources'}."""
+    # format code block for Slack
+    _answer = response['answer']
+    answer = ''
+    for line in _answer.split('\n'):
+        if line.startswith('```'):
+            answer += line[:3] + '\n'
+        else:
+            answer += line + '\n'
+    # format sources for Slack
+    sources = '\n'.join(' - '+ src for src in response['sources'])
+    return {
+        "text": f"*TicketID*: {api.get_api_id()}\n*Question*: _{question}_\n*Answer*\n{answer}\n*Sources*\n{sources}\n",
+        "response_type": "in_channel"
+    }
+
+@app.route('/batch', methods=['POST'])
+def ask_batch():
+    api = APIResponse()
+    data = request.get_json(silent=True) or {}
+    if data.get('token') != settings.SLACK_TOKEN_ID:
+        return api.denied()
+    questions = data.get('questions')
+    if not isinstance(questions, list) or not questions:
+        return api.error('Invalid request, no questions provided')
+    max_questions = getattr(settings, 'FAQBOT_BATCH_MAX_QUESTIONS', 1000)
+    if len(questions) > max_questions:
+        return api.error(f'Invalid request, more than {max_questions} questions')
+    try:
+        kb = knowledge_bases.get(data.get('kb')).name
+    except ValueError as e:
+        return api.error(str(e))
+    api.get_log().info('Processing batch', questions=len(questions), kb=kb)
+    bot = FAQBot(kb=kb)
+    bot.origin = 'batch'
+
+    def generate():
+        for result in bot.ask_batch([str(q).strip() for q in questions]):
+            yield result + '\n'
+        api.get_log().info('Processed batch', questions=len(questions))
+    return Response(generate(), mimetype='application/x-ndjson')
+
+def post_to_slack(api, response_url, json_response):
+    """Post through the pooled session, raise when Slack still fails after the retries."""
+    api.get_log().info('Sending response to slack', response_url=response_url, json_response=json_response)
+    with metrics.span('slack_post'):
+        r = delivery.post(response_url, json_response)
+    api.get_log().info('Sent response to slack', response_url=response_url, status_code=r.status_code)
+    return r
+
+def deliver(api, response_url, json_response, answers=None):
+    """Post a checkpointed answer once: an RQ retry after a failed post only posts it again."""
+    answers = answers or delivery.AnswerStore()
+    if answers.delivered(api.get_api_id()):
+        api.get_log().info('Answer already delivered')
+        return
+    try:
+        post_to_slack(api, response_url, json_response)
+    except Exception as e:
+        metrics.incr('askme_slack_post_failures_total')
+        api.get_log().error('Delivering the answer failed', error=str(e))
+        raise
+    answers.mark_delivered(api.get_api_id())
+
+def ask_bot_async(api_id, question, response_url, kb=None):
     api = APIResponse(api_id)
+    job = get_current_job()
+    status = 'failed'
+    answers = delivery.AnswerStore()
+    with metrics.Spans(api_id) as spans:
+        if job is not None and job.enqueued_at is not None:
+            spans.observe('queue_wait', (datetime.utcnow() - job.enqueued_at).total_seconds())
+        spans.profiler = profiler.sample(api_id)
+        try:
+            with spans.span('total'):
+                checkpoint = answers.get(api_id)
+                if checkpoint is not None:
+                    # a retry of a question answered before: deliver, don't generate again
+                    api.get_log().info('Reusing the computed answer')
+                    spans.incr('askme_answers_reused_total')
+                    status, json_response = checkpoint
+                elif is_stale(job):
+                    status, json_response = _drop_stale_question(api, question, job_age(job))
+                else:
+                    try:
+                        with resilience.deadline_scope(question_deadline(job)):
+                            status, json_response = _ask_bot_async(api, question, kb)
+                    except resilience.DeadlineExceeded:
+                        # too late to answer: busy, as for a question already stale when started
+                        status, json_response = _drop_stale_question(api, question, job_age(job))
+                    answers.save(api_id, status, json_response)
+                try:
+                    deliver(api, response_url, json_response, answers)
+                except Exception:
+                    # raised again for RQ to retry the delivery
+                    status = 'undelivered'
+                    raise
+        finally:
+            spans.incr('askme_questions_total', status=status)
+            api.get_log().info('Spans', spans=spans.as_dict())
+            spans.flush()
+            if spans.profiler is not None:
+                save_profile(api, spans, status)
+
+def save_profile(api, spans, status):
+    try:
+        folded, memory = spans.profiler.stop().save(status=status, spans=spans.as_dict())
+        api.get_log().info('Profile saved', stacks=folded, memory=memory)
+    except Exception as e:
+        api.get_log().warning('Could not save the profile', error=str(e))
+
+def is_stale(job):
+    """Asked more than ASK_MAX_AGE seconds ago, or past its deadline already."""
+    deadline = question_deadline(job)
+    if deadline is not None and deadline - time.time() < getattr(settings, 'FAQBOT_LLM_MIN_SECONDS', 2.0):
+        return True
+    return job_age(job) > getattr(settings, 'ASK_MAX_AGE', 45)
+
+def question_deadline(job):
+    """FAQBOT_DEADLINE seconds after the question was asked, not after the last RQ retry started."""
+    seconds = getattr(settings, 'FAQBOT_DEADLINE', 0)
+    if not seconds or job is None or job.meta.get('asked_at') is None:
+        return None
+    return job.meta['asked_at'] + seconds
+
+def _drop_stale_question(api, question, age):
+    api.get_log().warning('Dropping stale question', age=age)
+    json_response = {"text": f"*TicketID*: {api.get_api_id()}\n*Question*: _{question}_\n{BUSY_MESSAGE}\n", "response_type": "in_channel"}
+    return 'dropped', json_response
+
+def _ask_bot_async(api, question, kb=None):
+    """(status, Slack message) of a question, without posting it."""
     bot = None
     try:
-        api.get_log().info('Creating bot instance')
-        bot = FAQBot()
+        api.get_log().info('Creating bot instance', kb=kb)
+        bot = FAQBot(kb=kb)
+        bot.origin = 'slack'
         bot.set_debug(True)
         api.get_log().info('Created bot instance')
         result = bot.ask(question=question)
@@ -161,50 +414,24 @@ def ask_bot_async(api_id, question, response_url):
                 "text": f"*TicketID*: {api.get_api_id()}\n*Question*: _{question}_\nOops, something went wrong: {data['error']}\n",
                 "response_type": "in_channel"
             }
-            api.get_log().info('Sending response to slack', response_url=response_url, json_response=json_response)
-            r = requests.post(response_url, json=json_response)
-            api.get_log().info('Sent response to slack', response_url=response_url, status_code=r.status_code)
-            return
+            return 'error', json_response
         elif data['status'] == 'success':
             stats = data['response']['stats']
             api.get_log().debug('Stats', stats=stats)
-            # format code block for Slack
-            _answer = data['response']['answer']
-            answer = ''
-            for line in _answer.split('\n'):
-                if line.startswith('```'):
-                    answer += line[:3] + '\n'
-                else:
-                    answer += line + '\n'
-            # format sources for Slack
-            sources = '\n'.join(' - '+ src for src in data['response']['sources'])
-            # send response to slack
-            json_response = {
-                "text": f"*TicketID*: {api.get_api_id()}\n*Question*: _{question}_\n*Answer*\n{answer}\n*Sources*\n{sources}\n",
-                "response_type": "in_channel"
-            }
-            api.get_log().info('Sending response to slack', response_url=response_url, json_response=json_response)
-            r = requests.post(response_url, json=json_response)
-            api.get_log().info('Sent response to slack', response_url=response_url, status_code=r.status_code)
-            return
+            return 'success', slack_answer(api, question, data['response'])
+    except resilience.DeadlineExceeded:
+        raise
     except Exception as e:
         api.get_log().error('Oops, something went wrong', error=str(e), trace=traceback.format_exc())
         json_response = {"text": f"*TicketID*: {api.get_api_id()}\n*Question*: _{question}_\n*Answer*\nOops, something went wrong\n", "response_type": "in_channel"}
-        api.get_log().info('Sending response to slack', response_url=response_url, json_response=json_response)
-        r = requests.post(response_url, json=json_response)
-        api.get_log().info('Sent response to slack', response_url=response_url, status_code=r.status_code)
-        return
+        return 'error', json_response
     finally:
         try: del bot
         except: pass
 
     api.get_log().error('Oops, something went wrong', error='Unknown error')
     json_response = {"text": f"*TicketID*: {api.get_api_id()}\n*Question*: _{question}_\n*Answer*\nOops, something went wrong\n", "response_type": "in_channel"}
-    api.get_log().info('Sending response to slack', response_url=response_url, json_response=json_response)
-    r = requests.post(response_url, json=json_response)
-    api.get_log().info('Sent response to slack', response_url=response_url, status_code=r.status_code)
-    return
-
+    return 'error', json_response
 
 
 if __name__ == "__main__":
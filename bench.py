@@ -0,0 +1,256 @@
+"""Offline retrieval benchmark across the vectordb engines.
+
+Every engine is built from the same deterministic fixture corpus with
+deterministic fake embeddings (no OpenAI calls), then a fixed query set is
+replayed against it. The report is written as JSON.
+
+    python3 bench.py -e faiss,chroma,qdrant -n 5000 -o bench.json
+
+Qdrant runs in local mode (on disk, in-process) and Redis needs a local
+redis-stack server (--redis-url), it is skipped when not reachable.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import resource
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.docstore.document import Document
+
+import vectordb
+
+
+ENGINES = ('mock', 'faiss', 'chroma', 'qdrant', 'redis')
+
+TOPICS = {
+    'sms': 'sms message send text number destination source unicode encoding delivery report',
+    'voice': 'call voice answer hangup dial conference record speak play transfer',
+    'xml': 'xml response element speak play getdigits dial redirect wait hangup',
+    'webhook': 'webhook callback url status event signature validation request post',
+    'number': 'number phone buy purchase rent search country region inventory release',
+    'account': 'account auth id token subaccount balance pricing credit invoice',
+    'sdk': 'sdk python node java ruby php dotnet go client install version',
+    'media': 'mms media image attachment upload url size content type',
+}
+FILLER = ('the a to for with from using how can your this that api plivo request '
+          'response example code method parameter value return object').split()
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings using feature hashing."""
+    def __init__(self, size=256):
+        self.size = size
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype='float32')
+        for word in re.findall(r'\w+', text.lower()):
+            h = int(hashlib.md5(word.encode()).hexdigest(), 16)
+            vector[h % self.size] += 1.0 if (h >> 64) % 2 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+def fixture_corpus(size, seed=42):
+    """Deterministic corpus of short chunks (below the splitter chunk size)."""
+    rng = np.random.default_rng(seed)
+    topics = sorted(TOPICS)
+    docs = []
+    for i in range(size):
+        topic = topics[i % len(topics)]
+        words = TOPICS[topic].split()
+        text = ' '.join(rng.choice(words, 12).tolist() + rng.choice(FILLER, 20).tolist())
+        text = f'{topic} {i} {text}'
+        docs.append(Document(page_content=text,
+                             metadata={'source': f'https://fixture/{topic}/{i}', 'category': topic}))
+    return docs
+
+
+def load_corpus(path):
+    docs = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                data = json.loads(line)
+                docs.append(Document(page_content=data['page_content'], metadata=data.get('metadata', {})))
+    return docs
+
+
+def fixture_queries(docs, size, seed=42):
+    rng = np.random.default_rng(seed + 1)
+    queries = []
+    for i in rng.choice(len(docs), min(size, len(docs)), replace=False):
+        words = docs[int(i)].page_content.split()
+        queries.append(' '.join(rng.choice(words, 8).tolist()))
+    return queries
+
+
+def ground_truth(embeddings, docs, queries, k):
+    matrix = np.asarray(embeddings.embed_documents([doc.page_content for doc in docs]), dtype='float32')
+    truth = []
+    for query in queries:
+        scores = matrix @ np.asarray(embeddings.embed_query(query), dtype='float32')
+        truth.append([docs[i].page_content for i in np.argsort(-scores)[:k]])
+    return truth
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is in KB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = np.asarray(values)
+    return {'p50': round(float(np.percentile(values, 50)), 3),
+            'p95': round(float(np.percentile(values, 95)), 3),
+            'p99': round(float(np.percentile(values, 99)), 3),
+            'mean': round(float(values.mean()), 3)}
+
+
+def engine_url(engine, workdir, args):
+    if engine == 'mock':
+        return 'mock'
+    if engine == 'faiss':
+        return os.path.join(workdir, 'bench.faiss')
+    if engine == 'chroma':
+        return 'chroma://' + os.path.join(workdir, 'chroma')
+    if engine == 'qdrant':
+        return args.qdrant_url or 'qdrant://' + os.path.join(workdir, 'qdrant')
+    if engine == 'redis':
+        return args.redis_url
+    raise ValueError(f"Unknown engine: {engine}")
+
+
+def redis_available(url):
+    try:
+        import redis
+        redis.from_url(url).ping()
+        return True
+    except Exception as e:
+        print(f"Redis not reachable at {url}: {e}")
+        return False
+
+
+def bench_engine(engine, docs, queries, truth, embeddings, workdir, args):
+    vector_url = engine_url(engine, workdir, args)
+    result = {'engine': engine, 'vector_url': vector_url, 'docs': len(docs)}
+    ingest_kwargs = {}
+    if engine == 'faiss':
+        ingest_kwargs = {'index_type': args.faiss_index_type, 'quantizer': args.faiss_quantizer}
+        result['params'] = dict(ingest_kwargs)
+
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    vectordb.Ingestor.ingest(vector_url, list(docs), embeddings=embeddings, **ingest_kwargs)
+    ingest_s = time.perf_counter() - start
+    result['ingest_s'] = round(ingest_s, 3)
+    result['ingest_docs_per_s'] = round(len(docs) / ingest_s, 1) if ingest_s else None
+    if engine == 'mock':
+        # the mock engine has nothing to query
+        return result
+
+    start = time.perf_counter()
+    db = vectordb.Loader.load(vector_url, embeddings=embeddings)
+    result['load_s'] = round(time.perf_counter() - start, 3)
+
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        found = db.similarity_search(query, k=args.k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(expected) & set(doc.page_content for doc in found))
+    result['query_latency_ms'] = percentiles(latencies)
+    result[f'recall@{args.k}'] = round(hits / float(len(queries) * args.k), 4) if queries else None
+    result['rss_delta_bytes'] = rss_bytes() - rss_before
+    if engine == 'faiss':
+        size = 0
+        for name in os.listdir(workdir):
+            if name.startswith('bench.faiss'):
+                size += os.path.getsize(os.path.join(workdir, name))
+        result['disk_bytes'] = size
+    return result
+
+
+def run(args):
+    embeddings = HashEmbeddings(args.dim)
+    if args.corpus:
+        docs = load_corpus(args.corpus)
+    else:
+        docs = fixture_corpus(args.docs, args.seed)
+    queries = fixture_queries(docs, args.queries, args.seed)
+    truth = ground_truth(embeddings, docs, queries, args.k)
+    print(f"Corpus: {len(docs)} docs, queries: {len(queries)}, k: {args.k}")
+
+    report = {'corpus': args.corpus or 'fixture', 'docs': len(docs), 'queries': len(queries),
+              'k': args.k, 'dim': args.dim, 'seed': args.seed, 'results': []}
+    for engine in args.engines:
+        if engine == 'redis' and not redis_available(args.redis_url):
+            report['results'].append({'engine': engine, 'skipped': 'redis not reachable'})
+            continue
+        workdir = tempfile.mkdtemp(prefix=f'bench-{engine}-')
+        try:
+            print(f"Benchmarking engine: {engine}")
+            result = bench_engine(engine, docs, queries, truth, embeddings, workdir, args)
+        except Exception as e:
+            print(f"ERROR: engine {engine}: {e}")
+            result = {'engine': engine, 'error': str(e)}
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(result)
+        report['results'].append(result)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"Report saved into {args.output}")
+    else:
+        print(output)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline retrieval benchmark across vectordb engines")
+    parser.add_argument("-e", "--engines", type=lambda v: [e.strip() for e in v.split(',') if e.strip()],
+                        default=['mock', 'faiss', 'chroma', 'qdrant'], help=f"Engines among {','.join(ENGINES)} - default: mock,faiss,chroma,qdrant")
+    parser.add_argument("-n", "--docs", type=int, default=2000, help="Fixture corpus size - default: 2000")
+    parser.add_argument("-c", "--corpus", type=str, default="", help="JSON lines corpus ({page_content, metadata}) instead of the fixture corpus")
+    parser.add_argument("-q", "--queries", type=int, default=200, help="Number of queries - default: 200")
+    parser.add_argument("-k", type=int, default=4, help="Number of neighbours - default: 4")
+    parser.add_argument("--dim", type=int, default=256, help="Fake embedding size - default: 256")
+    parser.add_argument("--seed", type=int, default=42, help="Fixture random seed - default: 42")
+    parser.add_argument("--faiss-index-type", type=str, default="flat", help="FAISS index type - default: flat")
+    parser.add_argument("--faiss-quantizer", type=str, default="none", help="FAISS quantizer - default: none")
+    parser.add_argument("--qdrant-url", type=str, default="", help="Qdrant url - default: local mode in a temp directory")
+    parser.add_argument("--redis-url", type=str, default="redis://localhost:6379", help="Redis stack url - default: redis://localhost:6379")
+    parser.add_argument("-o", "--output", type=str, default="", help="Write the JSON report into this file")
+    args = parser.parse_args()
+    for engine in args.engines:
+        if engine not in ENGINES:
+            parser.error(f"Unknown engine: {engine}")
+    run(args)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,8 @@ from gitignore_parser import parse_gitignore
 from langchain.docstore.document import Document
 from langchain.document_loaders.base import BaseLoader
 
+import cpu_pool
+
 
 
 
@@ -84,9 +86,10 @@ class BaseCodeLoader(BaseLoader):
     def load(self) -> List[Document]:
         """Load from path."""
         if os.path.isfile(self.path):
-            self._load_file(Path(file_path))
+            self._load_file(Path(self.path))
         else:
             self._load_directory(Path(self.path))
+        self._detect_languages()
         return self._documents
 
     def _debug(self, message: str):
@@ -152,14 +155,24 @@ class BaseCodeLoader(BaseLoader):
             language = self.extension_to_language[ext]
             metadata = {"source": file_path.as_posix(), 'language': language, 'file_extension': ext, 'category': 'code'}
         except:
-            language = self.detect_language_from_text(text)
-            metadata = {"source": file_path.as_posix(), 'language': language.lower(), 'file_extension': ext, 'category': 'code'}
+            # guessed for all the files at once by _detect_languages()
+            metadata = {"source": file_path.as_posix(), 'language': None, 'file_extension': ext, 'category': 'code'}
 
         if extra_metadata:
             metadata.update(extra_metadata)
         self._documents.append(Document(page_content=text, metadata=metadata))
         return
 
+    def _detect_languages(self):
+        """Detect the language of the files without a known extension, in the CPU pool."""
+        pending = [doc for doc in self._documents if doc.metadata.get('language') is None]
+        if not pending:
+            return
+        self._debug(f"Detecting the language of {len(pending)} files")
+        languages = cpu_pool.detect_languages([doc.page_content for doc in pending])
+        for doc, language in zip(pending, languages):
+            doc.metadata['language'] = language.lower()
+
     # Method to detect the programming language of the code
     @classmethod
     def detect_language_from_text(cls, text):
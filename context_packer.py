@@ -0,0 +1,103 @@
+"""Assemble the context of the stuff chain under a token budget.
+
+Candidates are re-ranked with maximal marginal relevance (on their stored
+vectors when the engine has them), each chunk is trimmed to the span most
+relevant to the question, and chunks are packed until the tiktoken measured
+budget is reached.
+"""
+import re
+import numpy as np
+import tiktoken
+from langchain.docstore.document import Document
+from langchain.vectorstores.utils import maximal_marginal_relevance
+
+
+# "Content: ...\nSource: ..." added by the stuff chain document prompt
+DOCUMENT_PROMPT_OVERHEAD = 8
+
+WORD_RE = re.compile(r'\w{3,}')
+
+
+def query_terms(text):
+    return set(w.lower() for w in WORD_RE.findall(text))
+
+
+class ContextPacker(object):
+    def __init__(self, max_tokens=2000, chunk_max_tokens=300, min_chunk_tokens=32,
+                 lambda_mult=0.7, baseline_k=4, model_name=None):
+        self.max_tokens = max_tokens
+        self.chunk_max_tokens = chunk_max_tokens
+        self.min_chunk_tokens = min_chunk_tokens
+        self.lambda_mult = lambda_mult
+        self.baseline_k = baseline_k
+        try:
+            self.encoding = tiktoken.encoding_for_model(model_name or '')
+        except KeyError:
+            self.encoding = tiktoken.get_encoding('cl100k_base')
+
+    def count_tokens(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def rerank(self, query_vector, candidates):
+        """Order (document, vector) candidates by MMR, or keep the search order
+        when the vectors are not available."""
+        if not candidates or any(vector is None for _, vector in candidates):
+            return [doc for doc, _ in candidates]
+        vectors = [np.asarray(vector, dtype='float32') for _, vector in candidates]
+        order = maximal_marginal_relevance(np.asarray(query_vector, dtype='float32'), vectors,
+                                           lambda_mult=self.lambda_mult, k=len(vectors))
+        return [candidates[i][0] for i in order]
+
+    def trim(self, text, terms, max_tokens):
+        """Keep the window of lines with the most question terms within max_tokens."""
+        if self.count_tokens(text) <= max_tokens:
+            return text
+        lines = text.splitlines()
+        sizes = [self.count_tokens(line) + 1 for line in lines]
+        scores = [len(query_terms(line) & terms) for line in lines]
+        best, best_score = None, -1
+        end, size, score = 0, 0, 0
+        for start in range(len(lines)):
+            while end < len(lines) and size + sizes[end] <= max_tokens:
+                size += sizes[end]
+                score += scores[end]
+                end += 1
+            if end > start and score > best_score:
+                best, best_score = (start, end), score
+            if end > start:
+                size -= sizes[start]
+                score -= scores[start]
+            else:
+                end = start + 1
+        if best is not None:
+            return '\n'.join(lines[best[0]:best[1]])
+        # a single line longer than the budget
+        return self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:max_tokens])
+
+    def pack(self, question, query_vector, candidates):
+        """Return (documents, info) for the [(document, vector)] search candidates."""
+        terms = query_terms(question)
+        ranked = self.rerank(query_vector, candidates)
+        baseline_tokens = sum(self.count_tokens(doc.page_content) + DOCUMENT_PROMPT_OVERHEAD
+                              for doc, _ in candidates[:self.baseline_k])
+        seen = set()
+        packed = []
+        remaining = self.max_tokens
+        for doc in ranked:
+            if doc.page_content in seen:
+                continue
+            seen.add(doc.page_content)
+            overhead = DOCUMENT_PROMPT_OVERHEAD + self.count_tokens(str(doc.metadata.get('source', '')))
+            budget = min(self.chunk_max_tokens, remaining - overhead)
+            if budget < self.min_chunk_tokens:
+                break
+            text = self.trim(doc.page_content, terms, budget)
+            packed.append(Document(page_content=text, metadata=doc.metadata))
+            remaining -= self.count_tokens(text) + overhead
+        packed_tokens = self.max_tokens - remaining
+        info = {'candidates': len(candidates),
+                'packed': len(packed),
+                'baseline_tokens': baseline_tokens,
+                'packed_tokens': packed_tokens,
+                'tokens_saved': baseline_tokens - packed_tokens}
+        return packed, info
@@ -0,0 +1,206 @@
+"""Process pool for the CPU bound stages of the ingestion.
+
+HTML parsing (BeautifulSoup), programming language guessing (pygments) and
+chunk splitting run in INGEST_CPU_WORKERS processes (default: one per core).
+Tasks are submitted in chunks and only plain (text, metadata) tuples or
+language names travel between the processes, never soups or Documents.
+With one worker, or too few items to amortize the transfers, everything
+runs inline.
+
+Scaling report, docs/sec of every stage versus the number of workers on a
+synthetic corpus:
+
+    python3 cpu_pool.py -n 2000 -w 1,2,4,8 -o cpu_scaling.json
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import atexit
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import pygments.lexers
+from langchain.docstore.document import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 10
+# batches per worker, to balance uneven items without paying a round trip per item
+TASKS_PER_WORKER = 4
+
+_pool = None
+_pool_workers = 0
+_pool_pid = None
+
+
+def cpu_workers():
+    return int(os.environ.get("INGEST_CPU_WORKERS", 0) or os.cpu_count() or 1)
+
+
+def shutdown():
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.shutdown()
+    _pool = None
+
+
+atexit.register(shutdown)
+
+
+def _get_pool(workers):
+    global _pool, _pool_workers, _pool_pid
+    if _pool is None or _pool_workers != workers or _pool_pid != os.getpid():
+        shutdown()
+        _pool = ProcessPoolExecutor(max_workers=workers)
+        _pool_workers = workers
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def _picklable(func):
+    try:
+        pickle.dumps(func)
+        return True
+    except Exception:
+        return False
+
+
+def _batches(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def map_batches(func, items, workers=None):
+    """Return [func(item) for item in items], in the process pool when worth it.
+
+    func receives and returns lists (a batch of items / results) and must be a
+    module level function.
+    """
+    workers = workers or cpu_workers()
+    if workers <= 1 or len(items) < 2 * workers:
+        return func(items)
+    size = max(1, -(-len(items) // (workers * TASKS_PER_WORKER)))
+    results = []
+    for batch in _get_pool(workers).map(func, _batches(items, size)):
+        results.extend(batch)
+    return results
+
+
+# HTML parsing
+
+def _parse_pages(pages):
+    from bs4 import BeautifulSoup
+    results = []
+    for html, el, parser, parsing_function, meta_function in pages:
+        soup = BeautifulSoup(html, parser)
+        results.append((parsing_function(soup), meta_function(el, soup)))
+    return results
+
+
+def parse_pages(pages, parsing_function, meta_function, parser='html.parser', workers=None):
+    """Parse the [(html, sitemap element)] pages into Documents."""
+    if not (_picklable(parsing_function) and _picklable(meta_function)):
+        # e.g. lambdas: can't be sent to the workers
+        workers = 1
+    items = [(html, el, parser, parsing_function, meta_function) for html, el in pages]
+    return [Document(page_content=text, metadata=metadata)
+            for text, metadata in map_batches(_parse_pages, items, workers)]
+
+
+# language detection
+
+def _detect_languages(texts):
+    return [pygments.lexers.guess_lexer(text).name for text in texts]
+
+
+def detect_languages(texts, workers=None):
+    """Return the pygments lexer name guessed for every text."""
+    return map_batches(_detect_languages, list(texts), workers)
+
+
+# splitting
+
+def _split(docs):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    return [[(chunk.page_content, chunk.metadata) for chunk in splitter.split_documents(
+                [Document(page_content=text, metadata=metadata)])]
+            for text, metadata in docs]
+
+
+def split_documents(docs, workers=None):
+    """Split the documents into chunks, in the same order as split_documents()."""
+    items = [(doc.page_content, doc.metadata) for doc in docs]
+    return [Document(page_content=text, metadata=metadata)
+            for chunks in map_batches(_split, items, workers)
+            for text, metadata in chunks]
+
+
+# scaling report
+
+def synthetic_corpus(size, seed=42):
+    from bench import fixture_corpus
+    docs = fixture_corpus(size, seed)
+    pages = []
+    for doc in docs:
+        paragraphs = ''.join(f'<p>{doc.page_content} {i}</p>' for i in range(20))
+        html = (f'<html><head><title>{doc.metadata["category"]}</title></head><body>'
+                f'<nav><a href="/">home</a></nav><div class="content">{paragraphs}</div></body></html>')
+        pages.append((html, {'loc': doc.metadata['source']}))
+    snippets = [f'def handler_{i}(request):\n    """{doc.page_content}"""\n    return {{"id": {i}}}\n' * 5
+                for i, doc in enumerate(docs)]
+    texts = [Document(page_content=f'{doc.page_content}\n\n' * 30, metadata=doc.metadata) for doc in docs]
+    return pages, snippets, texts
+
+
+def scaling_report(size, workers_list, seed=42):
+    from sitemap import _default_parsing_function, _default_meta_function
+    pages, snippets, texts = synthetic_corpus(size, seed)
+    stages = {
+        'parse': lambda workers: parse_pages(pages, _default_parsing_function, _default_meta_function, workers=workers),
+        'detect_language': lambda workers: detect_languages(snippets, workers=workers),
+        'split': lambda workers: split_documents(texts, workers=workers),
+    }
+    report = {'docs': size, 'cpu_count': os.cpu_count(), 'results': []}
+    baseline = {}
+    for workers in workers_list:
+        result = {'workers': workers}
+        for name, stage in stages.items():
+            # the first call pays the pool start
+            stage(workers)
+            start = time.perf_counter()
+            stage(workers)
+            elapsed = time.perf_counter() - start
+            docs_per_s = size / elapsed if elapsed else 0.0
+            baseline.setdefault(name, docs_per_s)
+            result[name] = {'seconds': round(elapsed, 3),
+                            'docs_per_s': round(docs_per_s, 1),
+                            'speedup': round(docs_per_s / baseline[name], 2) if baseline[name] else None}
+        print(result)
+        report['results'].append(result)
+    shutdown()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling of the ingestion CPU stages with the number of workers")
+    parser.add_argument("-n", "--docs", type=int, default=2000, help="Synthetic corpus size - default: 2000")
+    parser.add_argument("-w", "--workers", type=lambda v: [int(w) for w in v.split(',') if w.strip()],
+                        default=[1, 2, 4, os.cpu_count() or 1], help="Worker counts, comma separated - default: 1,2,4,<cpus>")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed - default: 42")
+    parser.add_argument("-o", "--output", type=str, default="", help="Write the JSON report into this file")
+    args = parser.parse_args()
+    report = scaling_report(args.docs, sorted(set(args.workers)), args.seed)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"Report saved into {args.output}")
+    else:
+        print(output)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Checkpointed answers and their delivery to Slack.
+
+Answering a question and posting the answer to its response_url are two
+steps: the Slack message is saved in Redis under the ticket ID as soon as it
+is computed, then posted. When the post fails (after its own bounded
+retries), the RQ retry of the job finds the saved message and only posts it
+again: an answer is never generated twice.
+
+The posts share a pooled requests session per process, with connect/read
+timeouts and retries with backoff on connection errors, 429 and 5xx.
+"""
+import os
+import json
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from redis import Redis
+
+import settings
+
+
+PREFIX = 'askme:answer'
+
+_session = None
+_session_pid = None
+
+
+class AnswerStore(object):
+    """Slack message of every ticket, and whether it was delivered."""
+    def __init__(self, conn=None):
+        self.conn = conn or Redis()
+        self.ttl = int(getattr(settings, 'ANSWER_TTL', 86400))
+
+    def get(self, ticket):
+        """(status, message) computed for the ticket, None if not computed yet."""
+        try:
+            raw = self.conn.hget(f'{PREFIX}:{ticket}', 'answer')
+        except Exception as e:
+            print(f"WARNING: answer checkpoint read failed: {e}")
+            return None
+        if raw is None:
+            return None
+        data = json.loads(raw)
+        return data['status'], data['message']
+
+    def save(self, ticket, status, message):
+        try:
+            pipe = self.conn.pipeline(transaction=True)
+            pipe.hset(f'{PREFIX}:{ticket}', mapping={'answer': json.dumps({'status': status, 'message': message}),
+                                                     'computed_at': time.time()})
+            pipe.expire(f'{PREFIX}:{ticket}', self.ttl)
+            pipe.execute()
+            return True
+        except Exception as e:
+            print(f"WARNING: answer checkpoint failed: {e}")
+            return False
+
+    def delivered(self, ticket):
+        try:
+            return self.conn.hexists(f'{PREFIX}:{ticket}', 'delivered_at')
+        except Exception as e:
+            print(f"WARNING: answer checkpoint read failed: {e}")
+            return False
+
+    def mark_delivered(self, ticket):
+        try:
+            self.conn.hset(f'{PREFIX}:{ticket}', 'delivered_at', time.time())
+        except Exception as e:
+            print(f"WARNING: answer checkpoint failed: {e}")
+
+
+def session():
+    """The pooled HTTP session of the process (sessions must not cross a fork)."""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        retry = Retry(total=int(getattr(settings, 'SLACK_POST_RETRIES', 3)),
+                      backoff_factor=float(getattr(settings, 'SLACK_POST_BACKOFF', 0.5)),
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['POST']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+        _session = requests.Session()
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+        _session_pid = os.getpid()
+    return _session
+
+
+def post(url, payload):
+    """POST payload as JSON, raise when it still fails after the retries."""
+    timeout = (float(getattr(settings, 'SLACK_POST_CONNECT_TIMEOUT', 3.05)),
+               float(getattr(settings, 'SLACK_POST_TIMEOUT', 10)))
+    r = session().post(url, json=payload, timeout=timeout)
+    r.raise_for_status()
+    return r
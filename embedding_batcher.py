@@ -0,0 +1,148 @@
+"""Micro-batching of the query embeddings.
+
+Every question used to embed its query with its own OpenAI request. The
+BatchingEmbeddings wrapper sends the queries of a process to a dispatcher
+thread instead: it collects the queries asked within EMBEDDING_BATCH_WINDOW_MS
+(up to EMBEDDING_BATCH_SIZE of them), embeds them with a single request and
+hands every caller its vector. The last EMBEDDING_CACHE_SIZE query vectors
+are kept in an LRU, so a repeated query is not embedded again.
+
+Batching happens between the threads and coroutines of one process (the
+gunicorn threads, the async API, ask_batch); an RQ worker answers one job
+at a time and only benefits from the LRU.
+"""
+import os
+import time
+import queue
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from langchain.embeddings.base import Embeddings
+
+import metrics
+import resilience
+import settings
+
+
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class EmbeddingDispatcher(object):
+    """Embed the queries submitted by many threads with batched requests."""
+    def __init__(self, embed_documents, window=0.005, max_batch=64, cache_size=4096):
+        self.embed_documents = embed_documents
+        self.window = window
+        self.max_batch = max_batch
+        self.cache = LRUCache(cache_size)
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # threads don't survive a fork, every process dispatches for itself
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, args=(self._queue,), daemon=True,
+                                 name='askme-embeddings').start()
+                self._pid = os.getpid()
+
+    def submit(self, text):
+        """Future of (vector, result): result is 'hit' for a cached vector, 'sent'
+        for the one query of a batch counting the request, 'batched' otherwise."""
+        future = Future()
+        vector = self.cache.get(text)
+        if vector is not None:
+            future.set_result((vector, 'hit'))
+            return future
+        self._start()
+        self._queue.put((text, future))
+        return future
+
+    def _run(self, pending_queue):
+        while True:
+            pending = [pending_queue.get()]
+            end = time.monotonic() + self.window
+            while len(pending) < self.max_batch:
+                left = end - time.monotonic()
+                try:
+                    pending.append(pending_queue.get(timeout=left) if left > 0 else pending_queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._send(pending)
+
+    def _send(self, pending):
+        texts = list(dict.fromkeys(text for text, _ in pending))
+        try:
+            vectors = self.embed_documents(texts)
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        by_text = dict(zip(texts, vectors))
+        for text, vector in by_text.items():
+            self.cache.put(text, vector)
+        for i, (text, future) in enumerate(pending):
+            future.set_result((by_text[text], 'sent' if i == 0 else 'batched'))
+
+
+class BatchingEmbeddings(Embeddings):
+    """Embeddings whose queries go through an EmbeddingDispatcher, the documents
+    are embedded directly (they already come in batches)."""
+    def __init__(self, embeddings, window=None, max_batch=None, cache_size=None):
+        self.embeddings = embeddings
+        self.dispatcher = EmbeddingDispatcher(
+            embeddings.embed_documents,
+            window=getattr(settings, 'EMBEDDING_BATCH_WINDOW_MS', 5) / 1000.0 if window is None else window,
+            max_batch=max_batch or getattr(settings, 'EMBEDDING_BATCH_SIZE', 64),
+            cache_size=getattr(settings, 'EMBEDDING_CACHE_SIZE', 4096) if cache_size is None else cache_size)
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        left = resilience.remaining()
+        vector, result = self.dispatcher.submit(text).result(timeout=None if left is None else max(0.0, left))
+        metrics.incr('askme_embedding_queries_total', result=result)
+        return vector
+
+    async def aembed_documents(self, texts):
+        return await asyncio.get_running_loop().run_in_executor(None, self.embed_documents, texts)
+
+    async def aembed_query(self, text):
+        vector, result = await asyncio.wrap_future(self.dispatcher.submit(text))
+        metrics.incr('askme_embedding_queries_total', result=result)
+        return vector
+
+
+def batching(embeddings):
+    """Wrap embeddings in BatchingEmbeddings, unless EMBEDDING_BATCH is disabled."""
+    if not getattr(settings, 'EMBEDDING_BATCH', True) or isinstance(embeddings, BatchingEmbeddings):
+        return embeddings
+    return BatchingEmbeddings(embeddings)
@@ -18,7 +18,12 @@ case "$ENV" in
 	"*" | "prod")
 		echo "Running in Prod Mode"
 		redis-server --daemonize yes
-		rqworker --verbose &
-		gunicorn -c ./gunicorn.conf.py app:app
+		python3 ./worker_pool.py &
+		POOL_PID=$!
+		gunicorn -c ./gunicorn.conf.py app:app &
+		GUNICORN_PID=$!
+		# drain the workers (finish the running jobs) on deploy
+		trap 'kill -TERM $GUNICORN_PID $POOL_PID; wait $POOL_PID; exit 0' TERM
+		wait $GUNICORN_PID
 	;;
 esac
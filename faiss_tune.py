@@ -0,0 +1,182 @@
+"""Measure recall@k, latency and memory of FAISS index types and vector
+encodings against the exact flat index."""
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+import vectordb
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return float(np.percentile(np.asarray(values), p))
+
+
+def load_queries(db, base, args):
+    """Return (base_vectors, query_vectors).
+
+    Either embed real questions from a file (one per line) or hold out
+    random vectors from the index so queries are not in the searched set.
+    """
+    if args.questions:
+        with open(args.questions) as f:
+            questions = [line.strip() for line in f if line.strip()]
+        print(f"Embedding {len(questions)} questions from {args.questions}")
+        queries = np.asarray([db.embedding_function(q) for q in questions], dtype='float32')
+        return base, queries
+    rng = np.random.default_rng(args.seed)
+    n_queries = min(args.queries, base.shape[0] // 10)
+    if n_queries <= 0:
+        raise ValueError("Not enough vectors in the index to hold out queries")
+    idx = rng.permutation(base.shape[0])
+    return base[idx[n_queries:]], base[idx[:n_queries]]
+
+
+def search_latencies(index, queries, k):
+    latencies = []
+    results = []
+    for q in queries:
+        start = time.perf_counter()
+        _, ids = index.search(q.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(ids[0])
+    return np.asarray(results), latencies
+
+
+def recall_at_k(truth, found, k):
+    hits = 0
+    for t, f in zip(truth, found):
+        hits += len(set(t[:k]) & set(f[:k]) - {-1})
+    return hits / float(len(truth) * k)
+
+
+def index_size(index):
+    faiss = vectordb._import_faiss()
+    return int(faiss.serialize_index(vectordb.faiss_unwrap(index)).size)
+
+
+def measure(name, index, queries, truth, k, **params):
+    found, latencies = search_latencies(index, queries, k)
+    return {'index': name,
+            'params': params,
+            f'recall@{k}': round(recall_at_k(truth, found, k), 4),
+            'latency_ms_p50': round(percentile(latencies, 50), 4),
+            'latency_ms_p95': round(percentile(latencies, 95), 4),
+            'latency_ms_p99': round(percentile(latencies, 99), 4),
+            'index_bytes': index_size(index),
+            }
+
+
+def measure_all(name, index, base, queries, truth, k, args, **params):
+    """Measure an index as is, and with exact re-scoring when it is quantized."""
+    results = []
+    rescore_factors = [0]
+    if params.get('quantizer', 'none') != 'none':
+        rescore_factors = args.rescore_factor
+    for factor in rescore_factors:
+        searched = index
+        if factor > 0:
+            searched = vectordb.FaissRescoringIndex(index, base, factor)
+        result = measure(name, searched, queries, truth, k, rescore_factor=factor, **params)
+        results.append(result)
+        print(result)
+    return results
+
+
+def run(args):
+    db = vectordb.Loader.load(args.input, rescore_factor=0)
+    vectors = vectordb.faiss_extract_vectors(db.index)
+    base, queries = load_queries(db, vectors, args)
+    k = args.k
+    print(f"Base vectors: {base.shape[0]}, queries: {queries.shape[0]}, k: {k}")
+
+    report = {'input': args.input, 'base_vectors': int(base.shape[0]),
+              'queries': int(queries.shape[0]), 'k': k, 'results': []}
+
+    flat = vectordb.faiss_build_index(base, 'flat')
+    flat_bytes = index_size(flat)
+    truth, _ = search_latencies(flat, queries, k)
+    report['results'].append(measure('flat', flat, queries, truth, k))
+
+    for quantizer in args.quantizer:
+        if quantizer != 'none':
+            start = time.perf_counter()
+            index = vectordb.faiss_build_index(base, 'flat', quantizer, pq_m=args.pq_m)
+            build_s = time.perf_counter() - start
+            for result in measure_all('flat', index, base, queries, truth, k, args, quantizer=quantizer):
+                result['build_s'] = round(build_s, 3)
+                report['results'].append(result)
+
+        for m in args.hnsw_m:
+            start = time.perf_counter()
+            index = vectordb.faiss_build_index(base, 'hnsw', quantizer, hnsw_m=m, pq_m=args.pq_m,
+                                               hnsw_ef_construction=args.hnsw_ef_construction)
+            build_s = time.perf_counter() - start
+            for ef in args.hnsw_ef_search:
+                vectordb.faiss_set_search_params(index, hnsw_ef_search=ef)
+                for result in measure_all('hnsw', index, base, queries, truth, k, args,
+                                          quantizer=quantizer, hnsw_m=m, hnsw_ef_search=ef):
+                    result['build_s'] = round(build_s, 3)
+                    report['results'].append(result)
+
+        for nlist in args.ivf_nlist:
+            start = time.perf_counter()
+            index = vectordb.faiss_build_index(base, 'ivf', quantizer, ivf_nlist=nlist, pq_m=args.pq_m)
+            build_s = time.perf_counter() - start
+            actual_nlist = vectordb.faiss_extract_ivf(index).nlist
+            for nprobe in args.ivf_nprobe:
+                if nprobe > actual_nlist:
+                    continue
+                vectordb.faiss_set_search_params(index, ivf_nprobe=nprobe)
+                for result in measure_all('ivf', index, base, queries, truth, k, args,
+                                          quantizer=quantizer, ivf_nlist=actual_nlist, ivf_nprobe=nprobe):
+                    result['build_s'] = round(build_s, 3)
+                    report['results'].append(result)
+
+    for result in report['results']:
+        result['compression'] = round(flat_bytes / float(result['index_bytes']), 2)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"Report saved into {args.output}")
+    else:
+        print(output)
+    return report
+
+
+def str_list(value):
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FAISS index tuning: recall@k and latency against the flat index")
+    parser.add_argument("-i", "--input", type=str, required=True, help="FAISS file to benchmark (e.g. data/codebot.faiss.amd64)")
+    parser.add_argument("-k", type=int, default=4, help="Number of neighbours - default: 4 (retriever default)")
+    parser.add_argument("-q", "--queries", type=int, default=200, help="Number of held out vectors used as queries - default: 200")
+    parser.add_argument("--questions", type=str, default="", help="File with one question per line to embed and use as queries (calls OpenAI)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for the held out queries")
+    parser.add_argument("--hnsw-m", type=int_list, default=[16, 32], help="HNSW M values - default: 16,32")
+    parser.add_argument("--hnsw-ef-construction", type=int, default=80, help="HNSW efConstruction - default: 80")
+    parser.add_argument("--hnsw-ef-search", type=int_list, default=[16, 32, 64, 128], help="HNSW efSearch values - default: 16,32,64,128")
+    parser.add_argument("--ivf-nlist", type=int_list, default=[0], help="IVF nlist values, 0 for auto - default: 0")
+    parser.add_argument("--ivf-nprobe", type=int_list, default=[1, 4, 8, 16, 32], help="IVF nprobe values - default: 1,4,8,16,32")
+    parser.add_argument("--quantizer", type=str_list, default=['none'], help="Vector encodings to test among none,sq8,fp16,pq - default: none")
+    parser.add_argument("--pq-m", type=int, default=0, help="PQ sub-quantizers, 0 for dim/4 (16x compression) - default: 0")
+    parser.add_argument("--rescore-factor", type=int_list, default=[0, 4], help="Exact re-scoring of k*factor candidates for quantized indexes, 0 to disable - default: 0,4")
+    parser.add_argument("-o", "--output", type=str, default="", help="Write the JSON report into this file")
+    args = parser.parse_args()
+    run(args)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,229 @@
 import os
 import sys
+import time
+import asyncio
+import functools
+import contextvars
+import threading
 import traceback
 import argparse
 import json
-from prompt_toolkit import print_formatted_text, HTML
-from prompt_toolkit import prompt
-from langchain.prompts.chat import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import RetrievalQAWithSourcesChain
-from langchain.callbacks import get_openai_callback
+from concurrent.futures import ThreadPoolExecutor
+from langchain.callbacks.openai_info import OpenAICallbackHandler
+from langchain.schema import BaseRetriever
+from langchain.vectorstores.base import VectorStore
 
 import vectordb
+import metrics
 import settings
+from index_versions import IndexVersions, is_versioned, index_version
+import precompute
+import query_log
+import resilience
+from embedding_batcher import batching
+from index_cache import IndexCache
+import knowledge_bases
+
+
+# prompt_toolkit (prompt mode), the chain stack and the context packer are
+# imported when first used, so workers and CLI questions start faster
+def print_html(text):
+    from prompt_toolkit import print_formatted_text, HTML
+    print_formatted_text(HTML(text))
+
+
+def retrieved_chunks(candidates):
+    """Source, chunk ID and relevance of the [(document, vector, relevance)] search candidates."""
+    return [{'source': doc.metadata.get('source'),
+             'id': vectordb.chunk_id(doc),
+             'score': None if score is None else round(float(score), 4)}
+            for doc, _, score in candidates]
+
+
+class SpanRetriever(BaseRetriever):
+    """Retriever timing the query embedding and the vector search separately.
+
+    With a ContextPacker, fetch_k candidates are retrieved and packed under
+    the packer token budget instead of returning the top k chunks.
+    """
+    def __init__(self, db, embeddings=None, k=4, packer=None, fetch_k=20):
+        self.db = db
+        self.embeddings = embeddings
+        self.k = k
+        self.packer = packer
+        self.fetch_k = fetch_k
+        self._prefetched = {}
+
+    def _supports_vector_search(self):
+        return type(self.db).similarity_search_by_vector is not VectorStore.similarity_search_by_vector
+
+    def _search(self, vectors, queries=None):
+        """Return one [(document, vector or None, relevance or None)] candidates list per query vector."""
+        k = self.k if self.packer is None else self.fetch_k
+        if isinstance(self.db, vectordb.MultiIndex):
+            return self.db.search(queries or [None] * len(vectors), vectors, k,
+                                  with_vectors=self.packer is not None)
+        if vectordb.is_faiss(self.db):
+            results = vectordb.faiss_scored_search_batch(self.db, vectors, k, with_vectors=self.packer is not None)
+            return [[(doc, vector, vectordb.relevance_score('faiss', distance)) for doc, vector, distance in hits]
+                    for hits in results]
+        # engines without access to the stored vectors: no MMR re-ranking
+        if hasattr(self.db, 'similarity_search_with_score_by_vector'):
+            engine_name = vectordb.engine_of(self.db)
+            return [[(doc, None, vectordb.relevance_score(engine_name, score))
+                     for doc, score in self.db.similarity_search_with_score_by_vector(vector, k=k)]
+                    for vector in vectors]
+        return [[(doc, None, None) for doc in self.db.similarity_search_by_vector(vector, k=k)]
+                for vector in vectors]
+
+    def _select(self, query, vector, candidates):
+        """Return (documents, context packing info or None, retrieved chunks)."""
+        retrieved = retrieved_chunks(candidates)
+        candidates = [(doc, vector) for doc, vector, _ in candidates]
+        if self.packer is None:
+            return [doc for doc, _ in candidates], None, retrieved
+        with metrics.span('context_packing'):
+            docs, info = self.packer.pack(query, vector, candidates)
+        return docs, info, retrieved
+
+    def _record(self, info, retrieved):
+        # the query log keeps the source and relevance of the candidates
+        metrics.annotate(retrieved=retrieved)
+        if info is None:
+            return
+        metrics.annotate(context=info)
+        metrics.incr('askme_context_tokens_total', info['packed_tokens'], type='packed')
+        metrics.incr('askme_context_tokens_total', info['baseline_tokens'], type='baseline')
+
+    def prefetch(self, queries):
+        """Retrieve the documents of many queries with one embedding call and one
+        batched search, get_relevant_documents then returns them without any call."""
+        if self.embeddings is None or not self._supports_vector_search():
+            return False
+        queries = list(dict.fromkeys(queries))
+        with metrics.span('embedding'):
+            vectors = self.embeddings.embed_documents(queries)
+        with metrics.span('vector_search'):
+            candidates = self._search(vectors, queries)
+        for query, vector, hits in zip(queries, vectors, candidates):
+            self._prefetched[query] = self._select(query, vector, hits)
+        return True
+
+    def discard(self, queries):
+        """Drop the prefetched documents of queries that were not asked (e.g. failed)."""
+        for query in queries:
+            self._prefetched.pop(query, None)
+
+    def get_relevant_documents(self, query):
+        prefetched = self._prefetched.pop(query, None)
+        if prefetched is not None:
+            docs, info, retrieved = prefetched
+            self._record(info, retrieved)
+            return docs
+        resilience.check('retrieval')
+        if self.embeddings is None or not self._supports_vector_search():
+            with metrics.span('retrieval'):
+                docs = self.db.similarity_search(query, k=self.k)
+            self._record(None, retrieved_chunks([(doc, None, None) for doc in docs]))
+            return docs
+        with metrics.span('embedding'):
+            vector = self.embeddings.embed_query(query)
+        with metrics.span('vector_search'):
+            candidates = self._search([vector], [query])[0]
+        docs, info, retrieved = self._select(query, vector, candidates)
+        self._record(info, retrieved)
+        return docs
+
+    async def _aembed_query(self, query):
+        aembed_query = getattr(self.embeddings, 'aembed_query', None)
+        if aembed_query is not None:
+            try:
+                return await aembed_query(query)
+            except NotImplementedError:
+                pass
+        return await run_in_executor(self.embeddings.embed_query, query)
+
+    async def aget_relevant_documents(self, query):
+        prefetched = self._prefetched.pop(query, None)
+        if prefetched is not None:
+            docs, info, retrieved = prefetched
+            self._record(info, retrieved)
+            return docs
+        resilience.check('retrieval')
+        if self.embeddings is None or not self._supports_vector_search():
+            with metrics.span('retrieval'):
+                docs = await run_in_executor(functools.partial(self.db.similarity_search, query, k=self.k))
+            self._record(None, retrieved_chunks([(doc, None, None) for doc in docs]))
+            return docs
+        with metrics.span('embedding'):
+            vector = await self._aembed_query(query)
+        with metrics.span('vector_search'):
+            candidates = (await run_in_executor(self._search, [vector], [query]))[0]
+        docs, info, retrieved = self._select(query, vector, candidates)
+        self._record(info, retrieved)
+        return docs
+
+
+class MetricsCallbackHandler(OpenAICallbackHandler):
+    """Collect tokens and cost (always, not only in debug) and time the LLM calls.
+
+    The spans are bound explicitly: async chains run sync handlers in executor
+    threads, outside of the caller context.
+    """
+    _llm_start = None
+    # the model that answered (the fallback one, maybe) and whether it was hedged
+    model_name = None
+    hedged = False
+
+    def __init__(self, spans=None):
+        super().__init__()
+        self.spans = spans
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._llm_start = time.perf_counter()
+
+    def on_llm_end(self, response, **kwargs):
+        super().on_llm_end(response, **kwargs)
+        output = response.llm_output or {}
+        self.model_name = output.get('model_name') or self.model_name
+        self.hedged = self.hedged or bool(output.get('hedged'))
+        if self._llm_start is not None and self.spans is not None:
+            self.spans.observe('llm', time.perf_counter() - self._llm_start)
+        self._llm_start = None
+
+
+async def run_in_executor(func, *args):
+    """Run a blocking call in the default executor, keeping the current spans."""
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(ctx.run, func, *args))
 
 
 class BaseFAQBot(object):
-    def __init__(self):
+    # indexes loaded by the process, shared by the bots of every knowledge base
+    _index_cache = None
+    # versioned indexes, per (database, index_name): the version served by this process, and
+    # the new one loaded and warmed in the background, served from the next bot instance
+    _active_urls = {}
+    _pending_urls = {}
+    _watcher_pids = {}
+    # False in the workers forked by worker_pool.py: their parent watches the versions
+    # and replaces them, instead of every worker loading a private copy of each version
+    watch_versions = True
+    # answer the frequent questions from the precomputed store (see precompute.py)
+    use_precomputed = True
+    # where the questions come from, in the query log: slack, cli, batch or api
+    origin = 'api'
+
+    def __init__(self, kb=None):
+        # the knowledge base answering, see knowledge_bases.py
+        self.kb = knowledge_bases.get(kb)
         self._db = None
+        self._embeddings = None
+        # the vector URL (version) the bot answers from, resolved once by get_db()
+        self._vector_url = None
         self._debug = False
         self._chain = None
+        self._retriever = None
         k = os.getenv("OPENAI_API_KEY")
         if not k:
             raise Exception("OPENAI_API_KEY not set")
@@ -43,33 +244,189 @@ class BaseFAQBot(object):
     def get_cost(self):
         return self._set_cost
 
+    @classmethod
+    def index_cache(cls):
+        if cls._index_cache is None:
+            cls._index_cache = IndexCache(int(getattr(settings, 'INDEX_CACHE_MAX_MB', 0) * 2**20))
+        return cls._index_cache
+
+    @classmethod
+    def load_db(cls, vector_url, kb=None):
+        """Load the index once per process (until evicted from the index cache),
+        so workers forked after a preload share its memory pages copy-on-write."""
+        kb = knowledge_bases.get(kb)
+
+        def load():
+            loader = vectordb.Loader(vector_url, index_name=kb.index_name)
+            # the queries of concurrent questions share embedding requests
+            return loader.run(), batching(loader.embeddings)
+        return cls.index_cache().get((vector_url, kb.index_name), load, kb=kb.name)
+
+    @classmethod
+    def preload_imports(cls):
+        """Import the chain stack now, e.g. in a parent process before forking workers."""
+        import langchain.prompts.chat
+        import langchain.chat_models
+        import langchain.chains
+        import context_packer
+
+    @classmethod
+    def serving_url(cls, kb=None):
+        """Vector URL to answer with: the database of the knowledge base, or its current version."""
+        kb = knowledge_bases.get(kb)
+        key = (kb.vector_database, kb.index_name)
+        if not is_versioned(kb.vector_database):
+            return kb.vector_database
+        cls._start_watcher(kb, key)
+        if cls._pending_urls.get(key) is not None:
+            cls._switch(key, cls._pending_urls[key])
+        if cls._active_urls.get(key) is None:
+            url = IndexVersions(kb.vector_database).current_url()
+            if url is None:
+                raise Exception(f"No current version of {kb.vector_database}")
+            cls.load_db(url, kb.name)
+            cls._switch(key, url)
+        return cls._active_urls[key]
+
+    @classmethod
+    def active_url(cls, kb=None):
+        """Version of a versioned knowledge base served by this process, None before its first question."""
+        kb = knowledge_bases.get(kb)
+        return cls._active_urls.get((kb.vector_database, kb.index_name))
+
+    def index_version(self):
+        """Version of the index this bot answers from, without switching versions."""
+        self.get_db()
+        return index_version(self._vector_url, self.kb.vector_database, self.kb.index_name)
+
+    @classmethod
+    def _switch(cls, key, url):
+        database, index_name = key
+        versions = IndexVersions(database)
+        old_url = cls._active_urls.get(key)
+        cls._active_urls[key] = url
+        cls._pending_urls.pop(key, None)
+        versions.acquire(versions.version_of(url))
+        if old_url is not None and old_url != url:
+            # bots created before the switch keep their reference until they are done
+            cls.index_cache().pop((old_url, index_name))
+            versions.release(versions.version_of(old_url))
+            print(f"Switched index from {old_url} to {url}")
+        metrics.set_gauge('askme_index_loaded_timestamp_seconds', time.time())
+
+    @classmethod
+    def lease_versions(cls):
+        """Lease the versions this process serves under its own pid, e.g. the ones a
+        forked worker inherited: the lease of its parent ends when the parent switches."""
+        for (database, _), url in cls._active_urls.items():
+            versions = IndexVersions(database)
+            versions.acquire(versions.version_of(url))
+
+    @classmethod
+    def _start_watcher(cls, kb, key):
+        if not cls.watch_versions or cls._watcher_pids.get(key) == os.getpid():
+            return
+        # threads don't survive a fork, every process watches for itself
+        cls._watcher_pids[key] = os.getpid()
+        interval = getattr(settings, 'INDEX_WATCH_INTERVAL', 10)
+        threading.Thread(target=cls._watch_versions, args=(kb, key, interval), daemon=True).start()
+
+    @classmethod
+    def _watch_versions(cls, kb, key, interval):
+        versions = IndexVersions(key[0])
+        while True:
+            time.sleep(interval)
+            try:
+                url = versions.current_url()
+                if url is None or url in (cls._active_urls.get(key), cls._pending_urls.get(key)):
+                    continue
+                print(f"New index version {url}, loading in the background")
+                start = time.perf_counter()
+                # counts the index cache load and evictions, no question to add them to
+                with metrics.Spans() as spans:
+                    db, _ = cls.load_db(url, kb.name)
+                spans.flush()
+                vectordb.warm(db)
+                metrics.set_gauge('askme_index_load_seconds', time.perf_counter() - start)
+                cls._pending_urls[key] = url
+                print(f"Loaded index version {url} in {time.perf_counter() - start:.1f}s")
+            except Exception as e:
+                print(f"WARNING: loading index version failed: {e}")
+
     def get_db(self):
         if self._db is None:
-            self._db = vectordb.Loader.load(settings.VECTOR_DATABASE)
+            self._vector_url = self.serving_url(self.kb.name)
+            self._db, self._embeddings = self.load_db(self._vector_url, self.kb.name)
         return self._db
 
+    def _get_retriever(self):
+        packer = None
+        max_tokens = getattr(settings, 'FAQBOT_CONTEXT_MAX_TOKENS', 0)
+        if max_tokens:
+            from context_packer import ContextPacker
+            packer = ContextPacker(max_tokens=max_tokens,
+                                   chunk_max_tokens=getattr(settings, 'FAQBOT_CONTEXT_CHUNK_MAX_TOKENS', 300),
+                                   lambda_mult=getattr(settings, 'FAQBOT_CONTEXT_MMR_LAMBDA', 0.7),
+                                   model_name=settings.FAQBOT_OPENAI_MODEL)
+        return SpanRetriever(self.get_db(), self._embeddings, packer=packer,
+                             fetch_k=getattr(settings, 'FAQBOT_CONTEXT_FETCH_K', 20))
+
     def _get_llm_chain(self):
         if self._chain is None:
-            system_template = settings.FAQBOT_SYSTEM_TEMPLATE
+            from langchain.prompts.chat import (
+                ChatPromptTemplate,
+                SystemMessagePromptTemplate,
+                HumanMessagePromptTemplate,
+            )
+            from langchain.chains import RetrievalQAWithSourcesChain
+            system_template = self.kb.setting('FAQBOT_SYSTEM_TEMPLATE')
             messages = [
                 SystemMessagePromptTemplate.from_template(system_template),
                 HumanMessagePromptTemplate.from_template("{question}")
             ]
             chat_prompt = ChatPromptTemplate.from_messages(messages)
+            self._retriever = self._get_retriever()
             chain_type_kwargs = {"prompt": chat_prompt}
-            llm = ChatOpenAI(model_name=settings.FAQBOT_OPENAI_MODEL, 
-                             temperature=settings.FAQBOT_OPENAI_TEMPERATURE, 
-                             max_tokens=settings.FAQBOT_OPENAI_MAX_TOKENS,
-                             request_timeout=settings.FAQBOT_OPENAI_REQUEST_TIMEOUT)
+            llm = self._get_llm()
             self._chain = RetrievalQAWithSourcesChain.from_chain_type(
                 llm=llm,
                 chain_type="stuff",
-                retriever=self.get_db().as_retriever(),
+                retriever=self._retriever,
                 return_source_documents=True,
                 chain_type_kwargs=chain_type_kwargs
             )
         return self._chain
 
+    def _get_llm(self):
+        """The chat model, falling back to FAQBOT_OPENAI_FALLBACK_MODEL then to a
+        sources only answer, with hedged requests under the question deadline."""
+        from langchain.chat_models import ChatOpenAI
+        models = []
+        for model_name in (settings.FAQBOT_OPENAI_MODEL, getattr(settings, 'FAQBOT_OPENAI_FALLBACK_MODEL', '')):
+            if not model_name or model_name in [model.model_name for model in models]:
+                continue
+            models.append(ChatOpenAI(model_name=model_name,
+                                     temperature=settings.FAQBOT_OPENAI_TEMPERATURE,
+                                     max_tokens=settings.FAQBOT_OPENAI_MAX_TOKENS,
+                                     request_timeout=settings.FAQBOT_OPENAI_REQUEST_TIMEOUT,
+                                     # the deadline and the fallback handle the slow and failing requests
+                                     max_retries=getattr(settings, 'FAQBOT_OPENAI_MAX_RETRIES', 1)))
+        return resilience.ResilientChatModel(
+            models=models,
+            hedge=getattr(settings, 'FAQBOT_HEDGE', True),
+            hedge_delay=getattr(settings, 'FAQBOT_HEDGE_DELAY', 10.0),
+            hedge_min_delay=getattr(settings, 'FAQBOT_HEDGE_MIN_DELAY', 1.0),
+            min_seconds=getattr(settings, 'FAQBOT_LLM_MIN_SECONDS', 2.0),
+            breaker_failures=getattr(settings, 'FAQBOT_BREAKER_FAILURES', 5),
+            breaker_window=getattr(settings, 'FAQBOT_BREAKER_WINDOW', 60.0),
+            breaker_cooldown=getattr(settings, 'FAQBOT_BREAKER_COOLDOWN', 30.0),
+            sources_only_message=getattr(settings, 'FAQBOT_SOURCES_ONLY_MESSAGE', resilience.SOURCES_ONLY_MESSAGE))
+
+    def deadline(self):
+        """Deadline of a question asked now."""
+        seconds = getattr(settings, 'FAQBOT_DEADLINE', 0)
+        return time.time() + seconds if seconds else None
+
     def parse_question(self, question):
         q = []
         for line in question.splitlines():
@@ -79,34 +436,142 @@ class BaseFAQBot(object):
 
     @classmethod
     def perror(cls, error):
-        print_formatted_text(HTML('<p fg="ansired">ERROR: {}</p>'.format(error)))
+        print_html('<p fg="ansired">ERROR: {}</p>'.format(error))
         print('\n')
 
-    def ask(self, question):
+    def ask(self, question, precomputed=True):
         if not question:
             return json.dumps({"status": "error",
                                "error": "Question is required"})
-        data = self.query_as_dict(question)
+        data = (precomputed and self.precomputed(question)) or self.query_as_dict(question)
         return json.dumps({"status": "success",
                            'response': data})
 
-    def _query(self, question):
-        question = self.parse_question(question)
-        result = {}
+    def precomputed(self, question):
+        """The stored response of a frequent question, None to run the chain."""
+        if not self.use_precomputed or not getattr(settings, 'FAQBOT_PRECOMPUTED', True):
+            return None
+        # the precomputed store holds the answers of the default knowledge base only
+        if self.kb.name != knowledge_bases.default_name():
+            return None
+        start = time.perf_counter()
+        with metrics.span('precomputed'):
+            response = precompute.lookup(question, self.index_version(), self._embeddings)
+        metrics.incr('askme_precomputed_answers_total', result='hit' if response else 'miss')
+        if response is None:
+            return None
+        self._log_query(question, metrics.current(), time.perf_counter() - start, precomputed=True)
+        response = dict(response, question=question)
         if self.is_debug_enabled():
-            with get_openai_callback() as cb:
-                result = self._get_llm_chain()(question)
-                result["stats"] = {'total_tokens': cb.total_tokens,
-                            'prompt_tokens': cb.prompt_tokens,
-                            'completion_tokens': cb.completion_tokens,
-                            'successful_requests': cb.successful_requests,
-                            'total_cost': cb.total_cost}
-        else:
-            result = self._get_llm_chain()(question)
+            spans = metrics.current()
+            response['stats'] = {'total_tokens': 0,
+                                 'prompt_tokens': 0,
+                                 'completion_tokens': 0,
+                                 'successful_requests': 0,
+                                 'total_cost': 0.0,
+                                 'precomputed': True}
+            response['spans'] = spans.as_dict() if spans is not None else {}
+            response['raw_response'] = ''
+        return response
+
+    def ask_batch(self, questions, concurrency=None):
+        """Answer many questions: one embedding call and one batched search for
+        all of them, then concurrent completions. Yield the JSON answers in input order."""
+        concurrency = concurrency or getattr(settings, 'FAQBOT_BATCH_CONCURRENCY', 4)
+        # builds the retriever
+        self._get_llm_chain()
+        # the precomputed answers need no retrieval
+        hits = [self.precomputed(q) if q else None for q in questions]
+        queries = [self.parse_question(q) for q, hit in zip(questions, hits) if q and hit is None]
+        self._retriever.prefetch(queries)
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                futures = [pool.submit(self._ask_safe, q, hit) for q, hit in zip(questions, hits)]
+                for future in futures:
+                    yield future.result()
+        finally:
+            # the questions failing before their retrieval (or abandoned) leave theirs behind
+            self._retriever.discard(queries)
+
+    def _ask_safe(self, question, precomputed=None):
+        try:
+            if precomputed is not None:
+                return json.dumps({"status": "success", "response": precomputed})
+            return self.ask(question, precomputed=False)
+        except Exception as e:
+            return json.dumps({"status": "error", "error": str(e), "question": question})
+
+    def _query(self, question):
+        spans = metrics.current()
+        if spans is None:
+            with metrics.Spans() as spans:
+                return self._query_logged(question, spans)
+        return self._query_logged(question, spans)
+
+    def _query_logged(self, question, spans):
+        start = time.perf_counter()
+        try:
+            with resilience.deadline_scope(self.deadline()):
+                result = self._query_with_spans(self.parse_question(question), spans)
+        except resilience.DeadlineExceeded:
+            self._log_query(question, spans, time.perf_counter() - start, status='dropped')
+            raise
+        except Exception:
+            self._log_query(question, spans, time.perf_counter() - start, status='error')
+            raise
+        self._log_query(question, spans, time.perf_counter() - start, result=result)
+        return result
+
+    def _log_query(self, question, spans, seconds, status='success', result=None, precomputed=False):
+        stats = (result or {}).get('stats', {})
+        # 'sources_only': answered without a completion, see resilience.py
+        degraded = spans.attrs.get('degraded') if spans is not None else None
+        if degraded and status == 'success':
+            status = 'degraded'
+        query_log.append(question,
+                         origin=self.origin,
+                         ticket=spans.api_id if spans is not None else None,
+                         status=status,
+                         index_version=self.index_version(),
+                         model=stats.get('model') or (None if degraded else settings.FAQBOT_OPENAI_MODEL),
+                         degraded=degraded,
+                         hedged=stats.get('hedged', False),
+                         precomputed=precomputed,
+                         retrieved=spans.attrs.get('retrieved') if spans is not None else None,
+                         stages=spans.as_dict() if spans is not None else None,
+                         seconds=round(seconds, 4),
+                         prompt_tokens=stats.get('prompt_tokens', 0),
+                         completion_tokens=stats.get('completion_tokens', 0),
+                         cost_usd=stats.get('total_cost', 0.0))
+
+    def _query_with_spans(self, question, spans):
+        cb = MetricsCallbackHandler(spans)
+        chain = self._get_llm_chain()
+        with spans.span('chain'):
+            result = chain(question, callbacks=[cb])
+        return self._add_stats(result, cb, spans)
+
+    def _add_stats(self, result, cb, spans):
+        spans.incr('askme_tokens_total', cb.prompt_tokens, type='prompt')
+        spans.incr('askme_tokens_total', cb.completion_tokens, type='completion')
+        spans.incr('askme_openai_requests_total', cb.successful_requests)
+        spans.incr('askme_openai_cost_usd_total', cb.total_cost)
+        result["stats"] = {'total_tokens': cb.total_tokens,
+                    'prompt_tokens': cb.prompt_tokens,
+                    'completion_tokens': cb.completion_tokens,
+                    'successful_requests': cb.successful_requests,
+                    'total_cost': cb.total_cost,
+                    'model': cb.model_name,
+                    'hedged': cb.hedged}
+        if 'context' in spans.attrs:
+            result["stats"]['context'] = spans.attrs['context']
+        result["spans"] = spans.as_dict()
         return result
 
     def query_as_dict(self, question):
-        result = self._query(question)
+        return self._result_as_dict(question, self._query(question))
+
+    def _result_as_dict(self, question, result):
         data_sources = list(set([doc.metadata['source'] for doc in result['source_documents']]))
         response = {'question': question,
                     'answer': result['answer'], 
@@ -114,9 +579,66 @@ class BaseFAQBot(object):
                     }
         if self.is_debug_enabled():
             response['stats'] = result['stats']
+            response['spans'] = result['spans']
             response['raw_response'] = str(result)
         return response
 
+    async def aask(self, question, timeout=None):
+        """Awaitable ask(): the question embedding, the vector search (in the
+        default executor) and the completion never block the event loop.
+
+        Raise asyncio.TimeoutError after timeout seconds (default:
+        FAQBOT_OPENAI_REQUEST_TIMEOUT), cancelling the in-flight requests.
+        """
+        if not question:
+            return json.dumps({"status": "error",
+                               "error": "Question is required"})
+        data = await run_in_executor(self.precomputed, question)
+        if data is None:
+            data = await self.aquery_as_dict(question, timeout=timeout)
+        return json.dumps({"status": "success",
+                           'response': data})
+
+    async def aquery_as_dict(self, question, timeout=None):
+        if timeout is None:
+            timeout = int(settings.FAQBOT_OPENAI_REQUEST_TIMEOUT)
+        result = await asyncio.wait_for(self._aquery(question), timeout)
+        return self._result_as_dict(question, result)
+
+    async def _aquery(self, question):
+        spans = metrics.current()
+        if spans is None:
+            with metrics.Spans() as spans:
+                return await self._aquery_logged(question, spans)
+        return await self._aquery_logged(question, spans)
+
+    async def _aquery_logged(self, question, spans):
+        start = time.perf_counter()
+        try:
+            with resilience.deadline_scope(self.deadline()):
+                result = await self._aquery_with_spans(self.parse_question(question), spans)
+        except asyncio.CancelledError:
+            # aquery_as_dict() timed out
+            self._log_query(question, spans, time.perf_counter() - start, status='timeout')
+            raise
+        except resilience.DeadlineExceeded:
+            self._log_query(question, spans, time.perf_counter() - start, status='dropped')
+            raise
+        except Exception:
+            self._log_query(question, spans, time.perf_counter() - start, status='error')
+            raise
+        self._log_query(question, spans, time.perf_counter() - start, result=result)
+        return result
+
+    async def _aquery_with_spans(self, question, spans):
+        cb = MetricsCallbackHandler(spans)
+        if self._chain is None:
+            # loading the index is blocking
+            await run_in_executor(self._get_llm_chain)
+        with spans.span('chain'):
+            result = await self._chain.acall(question, callbacks=[cb])
+        return self._add_stats(result, cb, spans)
+
     def query_as_text(self, question):
         result = self._query(question)
         data_sources = set(['- '+doc.metadata['source'] for doc in result['source_documents']])
@@ -154,6 +676,9 @@ class FAQBot(BaseFAQBot):
     bot.set_debug(True)
     result = bot.ask(question="send an SMS")
 
+    # asyncio
+    result = await bot.aask(question="send an SMS", timeout=60)
+
     # Prompt mode
     bot = FAQBot()
     bot.run()
@@ -161,34 +686,36 @@ class FAQBot(BaseFAQBot):
     # CLI mode
     FAQBot.cli()
     '''
-    def __init__(self, banner='FAQBot'):
+    def __init__(self, banner='FAQBot', kb=None):
         self._banner = f'<p fg="ansiwhite">{banner}</p><p fg="ansired"> ("/help" for help)</p>'
-        super().__init__()
+        super().__init__(kb)
         self._set_cost = True
 
     @classmethod
     def cli(cls, banner='FAQBot'):
         parser = argparse.ArgumentParser(description="FAQBot")
         parser.add_argument("-a", "--ask", type=str, default="", help="Question to ask (required in CLI mode). Use '-' for stdin.")
-        parser.add_argument("-m", "--mode", type=str, choices=['prompt', 'cli'], default="prompt", help="CLI mode or Prompt mode - default: prompt")
+        parser.add_argument("-m", "--mode", type=str, choices=['prompt', 'cli', 'batch'], default="prompt", help="CLI mode, Prompt mode or Batch mode (-a is a file with one question per line, JSON lines output) - default: prompt")
         parser.add_argument("-d", "--debug", action="store_true", help="Enable debug mode (show OpenAI API cost and response)")
+        parser.add_argument("-k", "--kb", type=str, default="", help="Knowledge base to answer from - default: DEFAULT_KNOWLEDGE_BASE")
         parser.add_argument("-b", "--banner", type=str, default="FAQBot", help=f"Banner text (only used in prompt mode) - default {banner}")
         args = parser.parse_args()
         debug = args.debug
         banner = args.banner
         mode = args.mode
         ask = args.ask
-        if ask == '-':
+        if ask == '-' and mode != 'batch':
             ask = sys.stdin.read()
         if ask and mode == 'prompt':
             cls.perror("-a/--ask cannot be use in Prompt mode")
             parser.print_help()
             sys.exit(1)
-        if mode == 'cli' and not ask:
-            cls.perror("-a/--ask is required in CLI mode")
+        if mode in ('cli', 'batch') and not ask:
+            cls.perror(f"-a/--ask is required in {mode} mode")
             parser.print_help()
             sys.exit(1)
-        bot = cls(banner=banner)
+        bot = cls(banner=banner, kb=args.kb or None)
+        bot.origin = 'batch' if mode == 'batch' else 'cli'
         debug is True and bot.set_debug(True)
         if mode == 'prompt':
             bot.run()
@@ -196,6 +723,9 @@ class FAQBot(BaseFAQBot):
         elif mode == 'cli':
             bot.cli_run(ask)
             return
+        elif mode == 'batch':
+            bot.batch_run(ask)
+            return
 
         parser.print_help()
         sys.exit(1)
@@ -204,8 +734,19 @@ class FAQBot(BaseFAQBot):
         self.query_and_print_result(question)
         sys.exit(0)
 
+    def batch_run(self, path):
+        f = sys.stdin if path == '-' else open(path)
+        try:
+            questions = [line.strip() for line in f if line.strip()]
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        for result in self.ask_batch(questions):
+            print(result, flush=True)
+        sys.exit(0)
+
     def run(self):
-        print_formatted_text(HTML(self._banner))
+        print_html(self._banner)
         while True:
             try:
                 self._wait_for_input()
@@ -225,7 +766,7 @@ class FAQBot(BaseFAQBot):
         print("\033c")
 
     def _cmd_banner(self):
-        print_formatted_text(HTML(self._banner))
+        print_html(self._banner)
         print('\n')
 
     def _cmd_ask(self, query):
@@ -264,6 +805,7 @@ class FAQBot(BaseFAQBot):
         print('\n')
 
     def _wait_for_input(self):
+        from prompt_toolkit import prompt
         query = prompt(">>> ")
         if query == "/quit":
             self._cmd_exit('Bye!')
@@ -0,0 +1,111 @@
+"""Import time report of the entry points, to keep cold starts fast.
+
+Every module is imported in a fresh interpreter with `python -X importtime`,
+as a CLI question, a forked worker or a gunicorn boot would. The report gives
+the median total import time, the slowest top level packages, and fails when
+an entry point imports one of the deferred packages (the engine clients and
+the prompt UI, imported only when used) or exceeds --max-seconds.
+
+    python3 import_time.py -m faqbot,vectordb,app,worker_pool,ingest --max-seconds 3 -o import_time.json
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+MODULES = ('faqbot', 'vectordb', 'app', 'worker_pool', 'ingest')
+DEFERRED = ('faiss', 'qdrant_client', 'chromadb', 'prompt_toolkit')
+
+
+def import_times(module):
+    """Import module in a fresh interpreter, return {package: (self_us, cumulative_us, depth)}."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    times = {}
+    errors = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            errors.append(line)
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+            self_us, cumulative_us = int(self_us), int(cumulative_us)
+        except ValueError:
+            # the header line
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        times[name.strip()] = (self_us, cumulative_us, depth)
+    if proc.returncode != 0:
+        raise Exception(f"import {module} failed: {' '.join(errors[-3:])}")
+    return times
+
+
+def module_report(module, runs=3, top=10, deferred=DEFERRED):
+    totals = []
+    times = {}
+    for _ in range(runs + 1):
+        times = import_times(module)
+        # every top level import, including the module itself and the ones it pulls in
+        totals.append(sum(cumulative for _, cumulative, depth in times.values() if depth == 0) / 1e6)
+    # the first run compiles the .pyc files
+    totals = sorted(totals[1:])
+    slowest = sorted(((name, cumulative) for name, (_, cumulative, depth) in times.items() if depth == 0),
+                     key=lambda item: item[1], reverse=True)[:top]
+    return {'module': module,
+            'seconds': round(totals[len(totals) // 2], 3),
+            'min_seconds': round(totals[0], 3),
+            'max_seconds': round(totals[-1], 3),
+            'modules_imported': len(times),
+            'slowest': [{'package': name, 'seconds': round(cumulative / 1e6, 3)} for name, cumulative in slowest],
+            'deferred_imported': sorted(name for name in times if name in deferred)}
+
+
+def run(args):
+    report = {'python': sys.version.split()[0], 'runs': args.runs, 'results': []}
+    failed = False
+    for module in args.modules:
+        try:
+            result = module_report(module, args.runs, args.top, args.deferred)
+        except Exception as e:
+            print(f"ERROR: {e}")
+            report['results'].append({'module': module, 'error': str(e)})
+            failed = True
+            continue
+        errors = []
+        if result['deferred_imported']:
+            errors.append(f"imports deferred packages: {', '.join(result['deferred_imported'])}")
+        if args.max_seconds and result['seconds'] > args.max_seconds:
+            errors.append(f"imports in {result['seconds']}s, budget {args.max_seconds}s")
+        result['errors'] = errors
+        failed = failed or bool(errors)
+        print({'module': module, 'seconds': result['seconds'], 'errors': errors})
+        report['results'].append(result)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"Report saved into {args.output}")
+    else:
+        print(output)
+    return not failed
+
+
+def main():
+    str_list = lambda v: [x.strip() for x in v.split(',') if x.strip()]
+    parser = argparse.ArgumentParser(description="Import time of the entry points")
+    parser.add_argument("-m", "--modules", type=str_list, default=list(MODULES), help=f"Modules to import, comma separated - default: {','.join(MODULES)}")
+    parser.add_argument("-r", "--runs", type=int, default=3, help="Imports per module, the median is reported - default: 3")
+    parser.add_argument("-t", "--top", type=int, default=10, help="Slowest top level packages to list - default: 10")
+    parser.add_argument("--deferred", type=str_list, default=list(DEFERRED), help=f"Packages the entry points must not import - default: {','.join(DEFERRED)}")
+    parser.add_argument("--max-seconds", type=float, default=0, help="Fail when a module takes longer to import, 0 disables - default: 0")
+    parser.add_argument("-o", "--output", type=str, default="", help="Write the JSON report into this file")
+    args = parser.parse_args()
+    sys.exit(0 if run(args) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Indexes loaded by a process, least recently used evicted under a memory budget.
+
+The bots of every knowledge base share the cache of their process: an index
+is loaded on its first question and kept while used. When the loaded
+indexes take more than INDEX_CACHE_MAX_MB, the least recently used ones are
+dropped (the bots still answering with them keep their reference until
+they are done) and loaded again on their next question. The budget is per
+process; the sizes are estimates, see vectordb.index_memory().
+
+An index is keyed by (vector_url, index_name): knowledge bases sharing a
+Redis or Qdrant server differ only by their index / collection name.
+
+Hits, loads and evictions are counted per knowledge base in
+askme_index_cache_total.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+import vectordb
+import metrics
+
+
+class IndexCache(object):
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        # (vector_url, index_name) -> {'db', 'embeddings', 'kb', 'bytes', 'used_at'}
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load, kb=None):
+        """(db, embeddings) of the (vector_url, index_name) key, loaded with load() on a miss."""
+        with self._lock:
+            entry = self._hit(key)
+            if entry is None:
+                loading = self._loading.setdefault(key, threading.Lock())
+        if entry is not None:
+            metrics.incr('askme_index_cache_total', kb=kb, result='hit')
+            return entry['db'], entry['embeddings']
+        # one thread loads, the others asking for the same index wait for it
+        with loading:
+            with self._lock:
+                entry = self._hit(key)
+            if entry is not None:
+                metrics.incr('askme_index_cache_total', kb=kb, result='hit')
+                return entry['db'], entry['embeddings']
+            start = time.perf_counter()
+            with metrics.span('index_load'):
+                db, embeddings = load()
+            load_seconds = time.perf_counter() - start
+            size = vectordb.index_memory(db)
+            with self._lock:
+                self._entries[key] = {'db': db, 'embeddings': embeddings, 'kb': kb,
+                                             'bytes': size, 'used_at': time.time()}
+                self._loading.pop(key, None)
+                evicted = self._evict(keep=key)
+        print(f"Loaded index {describe(key)} ({kb}, {size / 2**20:.1f} MB) in {load_seconds:.1f}s")
+        metrics.incr('askme_index_cache_total', kb=kb, result='load')
+        for entry in evicted:
+            metrics.incr('askme_index_cache_total', kb=entry['kb'], result='eviction')
+        if metrics.current() is not None:
+            metrics.set_gauge('askme_index_cache_bytes', self.bytes())
+            metrics.set_gauge('askme_index_loaded_timestamp_seconds', time.time())
+            metrics.set_gauge('askme_index_load_seconds', load_seconds)
+        return db, embeddings
+
+    def _hit(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            entry['used_at'] = time.time()
+        return entry
+
+    def _evict(self, keep):
+        evicted = []
+        while self.max_bytes and self.bytes() > self.max_bytes:
+            victim = next((key for key in self._entries if key != keep), None)
+            if victim is None:
+                print(f"WARNING: index {describe(keep)} alone exceeds the index cache budget of {self.max_bytes / 2**20:.0f} MB")
+                break
+            entry = self._entries.pop(victim)
+            print(f"Evicted index {describe(victim)} ({entry['kb']}, {entry['bytes'] / 2**20:.1f} MB)")
+            evicted.append(entry)
+        return evicted
+
+    def pop(self, key):
+        with self._lock:
+            return self._entries.pop(key, None)
+
+    def bytes(self):
+        return sum(entry['bytes'] for entry in self._entries.values())
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def stats(self):
+        with self._lock:
+            return {describe(key): {'kb': entry['kb'], 'bytes': entry['bytes'], 'used_at': entry['used_at']}
+                    for key, entry in self._entries.items()}
+
+
+def describe(key):
+    vector_url, index_name = key
+    return f"{vector_url} ({index_name})" if index_name else vector_url
@@ -0,0 +1,245 @@
+"""Versioned index directories with an atomically flipped "current" pointer.
+
+With a {version} placeholder in VECTOR_DATABASE, e.g.
+
+    VECTOR_DATABASE=/data/askme/{version}/codebot.faiss
+    VECTOR_DATABASE=multi:///data/askme/{version}
+
+every ingestion run writes into a new /data/askme/vYYYYmmdd-HHMMSS directory
+and, once done, flips the /data/askme/current symlink to it. The processes
+serving questions watch the pointer, load and warm the new version in the
+background and switch between two questions. They hold a lease on the version
+they serve, versions not current, not among the INDEX_VERSIONS_KEEP most
+recent and without a live lease are garbage collected.
+
+    python3 index_versions.py list
+    python3 index_versions.py rollback
+    python3 index_versions.py activate v20230601-120000
+    python3 index_versions.py gc --keep 2
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+
+import settings
+
+
+VERSION_PLACEHOLDER = '{version}'
+CURRENT = 'current'
+LEASES = '.leases'
+# last ingestion run of the indexes synced in place (Redis, Qdrant, Chroma)
+INGEST_RUN_PREFIX = 'askme:ingest_run'
+
+
+def is_versioned(vector_url):
+    return VERSION_PLACEHOLDER in (vector_url or '')
+
+
+def index_version(vector_url, database=None, index_name=None):
+    """Identifier of the index content served from vector_url: its version with a
+    versioned database (default: VECTOR_DATABASE), the modification time of a
+    local FAISS file or multi-index manifest, the last ingestion run recorded by
+    record_ingest_run() for the engines synced in place (Redis, Qdrant, Chroma),
+    'live' when there is none."""
+    database = database or settings.VECTOR_DATABASE
+    if is_versioned(database):
+        return IndexVersions(database).version_of(vector_url)
+    path = None
+    if vector_url.startswith('multi://'):
+        from vectordb import multi_directory, MULTI_MANIFEST
+        path = os.path.join(multi_directory(vector_url), MULTI_MANIFEST)
+    elif '://' not in vector_url:
+        path = vector_url
+    if path and os.path.exists(path):
+        return time.strftime('m%Y%m%d-%H%M%S', time.gmtime(os.path.getmtime(path)))
+    return last_ingest_run(vector_url, index_name) or 'live'
+
+
+def _ingest_run_key(vector_url, index_name=None):
+    from vectordb import DEFAULT_INDEX_NAME
+    return f'{INGEST_RUN_PREFIX}:{vector_url}:{index_name or DEFAULT_INDEX_NAME}'
+
+
+def record_ingest_run(vector_url, run_id, index_name=None, conn=None):
+    """Change the index_version() of an index synced in place, once an ingestion
+    run (or an import) into it is complete."""
+    version = time.strftime('r%Y%m%d-%H%M%S', time.gmtime()) + f'-{run_id[:8]}'
+    try:
+        from redis import Redis
+        (conn or Redis()).set(_ingest_run_key(vector_url, index_name), version)
+        return version
+    except Exception as e:
+        print(f"WARNING: recording ingestion run failed: {e}")
+        return None
+
+
+def last_ingest_run(vector_url, index_name=None, conn=None):
+    try:
+        from redis import Redis
+        version = (conn or Redis()).get(_ingest_run_key(vector_url, index_name))
+    except Exception as e:
+        print(f"WARNING: reading ingestion run failed: {e}")
+        return None
+    return version.decode() if version else None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class IndexVersions(object):
+    def __init__(self, vector_url):
+        prefix, self.suffix = vector_url.split(VERSION_PLACEHOLDER, 1)
+        self.scheme = ''
+        if '://' in prefix:
+            self.scheme, prefix = prefix.split('://', 1)
+            self.scheme += '://'
+        self.root = prefix
+
+    def path(self, version):
+        return os.path.join(self.root, version)
+
+    def url(self, version):
+        return self.scheme + self.path(version) + self.suffix
+
+    def version_of(self, url):
+        return url[len(self.scheme + self.root):].strip('/').split('/')[0]
+
+    def versions(self):
+        """Version names, oldest first."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if name.startswith('v') and os.path.isdir(self.path(name)) and not name.endswith('.tmp'))
+
+    def current(self):
+        try:
+            return os.path.basename(os.readlink(os.path.join(self.root, CURRENT)))
+        except OSError:
+            return None
+
+    def current_url(self):
+        version = self.current()
+        return self.url(version) if version else None
+
+    def create(self, copy_current=False):
+        """Create an empty version directory, or a copy of the current one (e.g.
+        the multi-index sub-indexes a partial refresh doesn't rebuild)."""
+        version = time.strftime('v%Y%m%d-%H%M%S', time.gmtime())
+        while os.path.exists(self.path(version)):
+            version += 'b'
+        current = self.current()
+        if copy_current and current:
+            # a real copy: the sqlite docstores are updated in place
+            shutil.copytree(self.path(current), self.path(version) + '.tmp')
+            os.replace(self.path(version) + '.tmp', self.path(version))
+        else:
+            os.makedirs(self.path(version))
+        return version
+
+    def activate(self, version):
+        """Point current to version, atomically: readers see the old or the new one."""
+        if version not in self.versions():
+            raise ValueError(f"Unknown index version {version} in {self.root}")
+        link = os.path.join(self.root, CURRENT)
+        if os.path.lexists(link + '.tmp'):
+            os.remove(link + '.tmp')
+        os.symlink(version, link + '.tmp')
+        os.replace(link + '.tmp', link)
+        print(f"Index version {version} is current")
+        return version
+
+    def rollback(self):
+        """Activate the version before the current one."""
+        versions = self.versions()
+        current = self.current()
+        older = [version for version in versions if current is None or version < current]
+        if not older:
+            raise ValueError(f"No version older than {current} in {self.root}")
+        return self.activate(older[-1])
+
+    def _lease_path(self, version, pid=None):
+        return os.path.join(self.root, LEASES, f"{version}.{pid or os.getpid()}")
+
+    def acquire(self, version):
+        os.makedirs(os.path.join(self.root, LEASES), exist_ok=True)
+        with open(self._lease_path(version), 'w') as f:
+            f.write(str(time.time()))
+
+    def release(self, version):
+        try:
+            os.remove(self._lease_path(version))
+        except FileNotFoundError:
+            pass
+
+    def in_use(self, version):
+        """Whether a live process serves version, removing the leases of dead ones."""
+        directory = os.path.join(self.root, LEASES)
+        if not os.path.isdir(directory):
+            return False
+        used = False
+        for name in os.listdir(directory):
+            lease_version, _, pid = name.rpartition('.')
+            if lease_version != version or not pid.isdigit():
+                continue
+            if _pid_alive(int(pid)):
+                used = True
+            else:
+                os.remove(os.path.join(directory, name))
+        return used
+
+    def gc(self, keep=2):
+        """Delete the versions that are not current, not among the keep most
+        recent other ones (the rollback targets) and not served anymore."""
+        current = self.current()
+        others = [version for version in self.versions() if version != current]
+        removed = []
+        for version in others[:max(0, len(others) - keep)]:
+            if self.in_use(version):
+                print(f"Keeping index version {version}: still in use")
+                continue
+            shutil.rmtree(self.path(version), ignore_errors=True)
+            removed.append(version)
+            print(f"Removed index version {version}")
+        return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the versions of a versioned VECTOR_DATABASE")
+    parser.add_argument("command", choices=['list', 'activate', 'rollback', 'gc'])
+    parser.add_argument("version", nargs='?', default=None, help="Version to activate")
+    parser.add_argument("--keep", type=int, default=getattr(settings, 'INDEX_VERSIONS_KEEP', 2),
+                        help="gc: previous versions to keep for rollbacks")
+    args = parser.parse_args()
+    if not is_versioned(settings.VECTOR_DATABASE):
+        print(f"VECTOR_DATABASE has no {VERSION_PLACEHOLDER} placeholder: {settings.VECTOR_DATABASE}")
+        sys.exit(1)
+    versions = IndexVersions(settings.VECTOR_DATABASE)
+    if args.command == 'list':
+        current = versions.current()
+        for version in versions.versions():
+            flags = ['current'] if version == current else []
+            if versions.in_use(version):
+                flags.append('in use')
+            print(f"{version} {' '.join(flags)}".strip())
+    elif args.command == 'activate':
+        if not args.version:
+            parser.error("activate requires a version")
+        versions.activate(args.version)
+    elif args.command == 'rollback':
+        versions.rollback()
+    elif args.command == 'gc':
+        versions.gc(args.keep)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,79 @@
 import sys
 import os
+import argparse
+from urllib.parse import urlparse
 from langchain.document_loaders.sitemap import SitemapLoader
 from code_loader import GithubCodeLoader
 from sitemapchunk_loader import SitemapChunkLoader
-from vectordb import Ingestor
+from vectordb import Ingestor, multi_directory
+from ingest_journal import IngestJournal
+from index_versions import IndexVersions, is_versioned, record_ingest_run
+import knowledge_bases
+import metrics
+import profiler
 import settings
 
-def ingest_docs_from_github_repos():
+def is_multi_index(vector_url=None):
+    return (vector_url or settings.VECTOR_DATABASE).startswith("multi://")
+
+
+def is_faiss_file(vector_url=None):
+    vector_url = vector_url or settings.VECTOR_DATABASE
+    return '://' not in vector_url and vector_url not in ('mock', 'dummy')
+
+
+def source_name(url):
+    """Name of a source (its sub-index in a multi-index): the repo name or the docs site host."""
+    parsed = urlparse(url)
+    if url.endswith('.git') or parsed.netloc == 'github.com':
+        name = os.path.basename(parsed.path.rstrip('/'))
+        return name[:-len('.git')] if name.endswith('.git') else name
+    return parsed.netloc or url
+
+
+def is_selected(url, sources):
+    return not sources or url in sources or source_name(url) in sources
+
+
+def journal_path():
+    """The run journal lives next to a local index, in the working directory otherwise."""
+    if is_versioned(settings.VECTOR_DATABASE):
+        return os.path.join(IndexVersions(settings.VECTOR_DATABASE).root, 'ingest.journal.json')
+    if is_multi_index():
+        directory = multi_directory(settings.VECTOR_DATABASE)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, 'ingest.journal.json')
+    if is_faiss_file():
+        return settings.VECTOR_DATABASE + '.journal.json'
+    return 'ingest.journal.json'
+
+
+def ingest_source(journal, url, index, docs, urls=None, **kwargs):
+    """Ingest the batch number index of a source into the single index, or into
+    the sub-index of the source in a multi-index, which its first batch replaces."""
+    name = source_name(url)
+    # saved by the interrupted run maybe: don't add its FAISS chunks twice
+    kwargs.update(dedupe=journal.interrupted(url, index))
+    journal.batch(url, name, index, 'fetched', len(docs), urls=urls)
+    if is_multi_index(journal.vector_url):
+        kwargs.update(overwrite=not journal.has_committed(name))
+    else:
+        kwargs.update(overwrite=False)
+    Ingestor.ingest(journal.vector_url, docs, source=name, run_id=journal.run_id,
+                    index_name=getattr(settings, 'VECTOR_INDEX_NAME', None), build_index=False,
+                    checkpoint=lambda stage: journal.batch(url, name, index, stage), **kwargs)
+    journal.batch(url, name, index, 'committed')
+
+
+def finish_source(journal, url):
+    """Redis/Qdrant: delete the chunks of the source this run didn't upsert."""
+    name = source_name(url)
+    Ingestor.delete_stale(journal.vector_url, name, run_id=journal.run_id,
+                          index_name=getattr(settings, 'VECTOR_INDEX_NAME', None))
+    journal.done(url, name)
+
+
+def ingest_docs_from_github_repos(journal, sources=None):
     """Ingest all docs."""
     repos = set()
     ingested_docs = 0
@@ -22,20 +89,25 @@ def ingest_docs_from_github_repos():
             print(f"Invalid repo {repo}. Format should be (repo_url, branch)")
             continue
 
-    repos = list(repos)
+    repos = sorted((repo_url, branch) for repo_url, branch in repos if is_selected(repo_url, sources))
     for repo_url, branch in repos:
+        if journal.is_done(repo_url):
+            print(f"Skipping {repo_url}, already ingested by run {journal.run_id}")
+            continue
         print(f"Loading {repo_url} with branch {branch}")
         loader = GithubCodeLoader(repo_url, branch=branch, debug=True)
-        docs = loader.load()
+        with metrics.span('fetch'):
+            docs = loader.load()
         if docs:
             print(f"Loaded {len(docs)} documents from {repo_url}")
             ingested_docs += len(docs)
-            Ingestor.ingest(settings.VECTOR_DATABASE, docs, overwrite=False)
+            ingest_source(journal, repo_url, 0, docs)
+            finish_source(journal, repo_url)
             continue
     return ingested_docs
 
 
-def ingest_docs_from_sitemaps():
+def ingest_docs_from_sitemaps(journal, sources=None):
     ingested_docs = 0
     if not settings.INGEST_SITEMAP_URLS:
         print("No sitemap urls specified in settings.INGEST_SITEMAP_URLS")
@@ -48,39 +120,136 @@ def ingest_docs_from_sitemaps():
 
     print(f"Loading sitemaps from {settings.INGEST_SITEMAP_URLS}")
     for sitemap_url in settings.INGEST_SITEMAP_URLS:
+        if not is_selected(sitemap_url, sources):
+            continue
+        if journal.is_done(sitemap_url):
+            print(f"Skipping {sitemap_url}, already ingested by run {journal.run_id}")
+            continue
         print(f"Loading {sitemap_url} START")
         loader = SitemapChunkLoader(web_path=sitemap_url, 
                                     filter_urls=filter_urls,
                                     )
+        index = journal.committed_batches(sitemap_url)
+        if index:
+            skipped = loader.skip_urls(journal.committed_urls(sitemap_url))
+            print(f"Resuming {sitemap_url}: skipped {skipped} documents of {index} committed batches")
+        sitemap_docs = 0
         while True:
-            docs = loader.load_chunks(chunk_size=200)
+            with metrics.span('fetch'):
+                docs = loader.load_chunks(chunk_size=200)
             if len(docs) > 0:
                 print(f"Loaded {len(docs)} documents from {sitemap_url}")
-                ingested_docs += len(docs)
-                Ingestor.ingest(settings.VECTOR_DATABASE, docs, overwrite=False, ingest_size=200)
+                sitemap_docs += len(docs)
+                ingest_source(journal, sitemap_url, index, docs, urls=loader.last_urls, ingest_size=200)
+                index += 1
                 continue
             print(f"Loading {sitemap_url} NO MORE DOCUMENTS TO LOAD")
             break
+        # an empty load is more likely a fetch failure than an empty site, keep the chunks
+        if index:
+            finish_source(journal, sitemap_url)
+        ingested_docs += sitemap_docs
         print(f"Loading {sitemap_url} DONE")
     return ingested_docs
 
 
-def ingest_all_docs():
+def ingest_all_docs(journal, sources=None):
     """Ingest all docs."""
-    ingested_docs = ingest_docs_from_github_repos() 
-    ingested_docs += ingest_docs_from_sitemaps()
+    ingested_docs = ingest_docs_from_github_repos(journal, sources) 
+    ingested_docs += ingest_docs_from_sitemaps(journal, sources)
     print(f"Ingested total {ingested_docs} documents")
+    # the batches were merged into flat FAISS indexes, build FAISS_INDEX_TYPE/FAISS_QUANTIZER once
+    Ingestor.build_index(journal.vector_url)
+    print(f"Run summary: {journal.summary()}")
+
+
+def ingest_profiled(journal, sources=None):
+    with metrics.Spans(journal.run_id) as spans:
+        spans.profiler = profiler.create(f"ingest-{journal.run_id}").start()
+        try:
+            with spans.span('total'):
+                ingest_all_docs(journal, sources)
+        finally:
+            folded, memory = spans.profiler.stop().save(spans=spans.as_dict())
+            print(f"Profile of run {journal.run_id} saved to {folded} and {memory}")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest the repos and sitemaps into the vector database")
+    parser.add_argument("-s", "--source", action="append", default=[],
+                        help="refresh only this source (repo/sitemap URL or name), repeatable - default: all")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the interrupted run of the journal from its last checkpoint")
+    parser.add_argument("--journal", type=str, default="",
+                        help="run journal file - default: next to the vector database")
+    parser.add_argument("--precompute", action="store_true",
+                        help="precompute the answers of the most frequent questions once ingested")
+    parser.add_argument("-k", "--kb", type=str, default="",
+                        help="ingest the sources of this knowledge base into its database - default: VECTOR_DATABASE")
+    parser.add_argument("--profile", action="store_true",
+                        help="sample the stacks and the peak memory per stage of the run into PROFILE_DIR")
+    args = parser.parse_args()
+    if args.kb:
+        try:
+            kb = knowledge_bases.apply(args.kb)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        print(f"Ingesting knowledge base {kb.name} into {kb.vector_database}")
     if not settings.OPENAI_API_KEY:
         print("OPENAI_API_KEY not set")
         sys.exit(1)
     if not settings.VECTOR_DATABASE:
         print("VECTOR_DATABASE not set")
         sys.exit(1)
-    if os.path.exists(settings.VECTOR_DATABASE):
-        print(f"Database {settings.VECTOR_DATABASE} already exists. Delete it first if you want to re-ingest")
+    if args.source and is_faiss_file():
+        print("--source requires a multi://, Redis or Qdrant VECTOR_DATABASE")
         sys.exit(1)
-    ingest_all_docs()
+    path = args.journal or journal_path()
+    journal = IngestJournal.load(path)
+    if args.resume:
+        if journal is None or journal.finished:
+            print(f"No interrupted run to resume in {path}")
+            sys.exit(1)
+        if journal.database != settings.VECTOR_DATABASE:
+            print(f"Run {journal.run_id} ingested into {journal.database}, not {settings.VECTOR_DATABASE}")
+            sys.exit(1)
+        print(f"Resuming run {journal.run_id}: {journal.summary()}")
+    else:
+        if journal is not None and not journal.finished:
+            print(f"Run {journal.run_id} was interrupted: continue it with --resume or delete {path}")
+            sys.exit(1)
+        vector_url, version = settings.VECTOR_DATABASE, None
+        if is_versioned(settings.VECTOR_DATABASE):
+            # a new version, served once complete; a multi-index starts from the current
+            # one so the sources not refreshed are kept
+            versions = IndexVersions(settings.VECTOR_DATABASE)
+            version = versions.create(copy_current=is_multi_index())
+            vector_url = versions.url(version)
+            print(f"Ingesting into new index version {version}")
+        # a multi-index refreshes each source in its own sub-index, leaving the others
+        # untouched, Redis and Qdrant re-ingestions are idempotent syncs
+        elif is_faiss_file() and os.path.exists(settings.VECTOR_DATABASE):
+            print(f"Database {settings.VECTOR_DATABASE} already exists. Delete it first if you want to re-ingest")
+            sys.exit(1)
+        journal = IngestJournal.start(path, vector_url, database=settings.VECTOR_DATABASE, version=version)
+    if args.profile:
+        ingest_profiled(journal, args.source)
+    else:
+        ingest_all_docs(journal, args.source)
+    if journal.data.get('version'):
+        versions = IndexVersions(settings.VECTOR_DATABASE)
+        versions.activate(journal.data['version'])
+        versions.gc(getattr(settings, 'INDEX_VERSIONS_KEEP', 2))
+    elif not is_faiss_file() and not is_multi_index():
+        # Redis, Qdrant and Chroma are synced in place: a new index version for
+        # the precomputed answers
+        record_ingest_run(settings.VECTOR_DATABASE, journal.run_id,
+                          getattr(settings, 'VECTOR_INDEX_NAME', None))
+    journal.finish()
+    if args.precompute and args.kb and args.kb != knowledge_bases.default_name():
+        print("Precomputed answers are only served for the default knowledge base, skipping")
+    elif args.precompute:
+        import precompute
+        precompute.refresh(force=True)
 
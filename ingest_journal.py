@@ -0,0 +1,140 @@
+"""Journal of an ingestion run, to resume it after a crash.
+
+Every source (repo or sitemap) is ingested in batches, one Ingestor.ingest()
+call each. The journal records, per source, the batches that were fetched,
+embedded and committed to the vector database, and it is rewritten
+atomically after every step:
+
+    {"run_id": "...", "vector_url": "...", "database": "...", "version": null,
+     "started_at": 1700000000.0, "finished_at": null,
+     "sources": {"https://github.com/org/repo.git": {
+         "name": "repo", "status": "running", "docs": 1200,
+         "batches": [{"status": "committed", "docs": 200, "urls": [...]},
+                     {"status": "fetched", "docs": 200, "urls": [...]}]}}}
+
+A resumed run keeps the run ID (so the Redis/Qdrant stale chunk deletion
+still sees the chunks upserted before the crash), skips the finished sources
+and the pages of the committed batches of the interrupted one (by URL, a
+sitemap may have changed meanwhile). The batch interrupted after it was
+saved but before it was recorded as committed is ingested again: Redis and
+Qdrant overwrite its chunks, FAISS leaves out the ones already in the index.
+"""
+import os
+import json
+import time
+import uuid
+
+
+class IngestJournal(object):
+    def __init__(self, path, data=None):
+        self.path = path
+        self.data = data
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return cls(path, json.load(f))
+
+    @classmethod
+    def start(cls, path, vector_url, database=None, version=None):
+        journal = cls(path, {'run_id': uuid.uuid4().hex,
+                             'vector_url': vector_url,
+                             'database': database or vector_url,
+                             'version': version,
+                             'started_at': time.time(),
+                             'finished_at': None,
+                             'sources': {}})
+        journal.save()
+        return journal
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+    @property
+    def run_id(self):
+        return self.data['run_id']
+
+    @property
+    def vector_url(self):
+        """Where the run ingests: VECTOR_DATABASE or the new version of a versioned one."""
+        return self.data['vector_url']
+
+    @property
+    def database(self):
+        return self.data.get('database', self.data['vector_url'])
+
+    @property
+    def finished(self):
+        return self.data['finished_at'] is not None
+
+    def finish(self):
+        self.data['finished_at'] = time.time()
+        self.save()
+
+    def source(self, url, name):
+        if url not in self.data['sources']:
+            self.data['sources'][url] = {'name': name, 'status': 'pending', 'docs': 0, 'batches': []}
+        return self.data['sources'][url]
+
+    def is_done(self, url):
+        return self.data['sources'].get(url, {}).get('status') == 'done'
+
+    def committed_batches(self, url):
+        """Number of leading batches of the source already in the vector database."""
+        count = 0
+        for batch in self.data['sources'].get(url, {}).get('batches', []):
+            if batch['status'] != 'committed':
+                break
+            count += 1
+        return count
+
+    def committed_urls(self, url):
+        """Pages of the committed batches of the source."""
+        return {page for batch in self.data['sources'].get(url, {}).get('batches', [])
+                if batch['status'] == 'committed' for page in batch.get('urls', [])}
+
+    def interrupted(self, url, index):
+        """Whether the batch number index of the source was started by a previous
+        process and not committed: its chunks may already be in the index."""
+        batches = self.data['sources'].get(url, {}).get('batches', [])
+        return index < len(batches) and batches[index]['status'] != 'committed'
+
+    def has_committed(self, name):
+        """Whether any batch of a source named name (e.g. a multi-index sub-index) was committed."""
+        return any(source['name'] == name and self.committed_batches(url)
+                   for url, source in self.data['sources'].items())
+
+    def batch(self, url, name, index, status, docs=None, urls=None):
+        """Record the status of the batch number index of a source."""
+        source = self.source(url, name)
+        source['status'] = 'running'
+        batches = source['batches']
+        # an interrupted batch is fetched again, drop what was recorded past it
+        del batches[index + 1:]
+        if len(batches) <= index:
+            batches.append({'status': status, 'docs': docs or 0})
+        else:
+            batches[index]['status'] = status
+            if docs is not None:
+                batches[index]['docs'] = docs
+        if urls is not None:
+            batches[index]['urls'] = urls
+        if status == 'committed':
+            source['docs'] = sum(batch['docs'] for batch in batches)
+        self.save()
+
+    def done(self, url, name):
+        source = self.source(url, name)
+        source['status'] = 'done'
+        self.save()
+
+    def summary(self):
+        sources = self.data['sources'].values()
+        return {'run_id': self.run_id,
+                'sources_done': sum(1 for source in sources if source['status'] == 'done'),
+                'sources_started': len(sources),
+                'docs_committed': sum(source['docs'] for source in sources)}
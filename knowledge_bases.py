@@ -0,0 +1,90 @@
+"""Named knowledge bases served by the same workers.
+
+KNOWLEDGE_BASES maps a name to its vector database and what it answers:
+
+    KNOWLEDGE_BASES = {
+        'docs': {'vector_database': '/data/docs/{version}/docs.faiss', 'commands': ['/askplivo']},
+        'runbooks': {'vector_database': 'qdrant://localhost:6333', 'index_name': 'runbooks',
+                     'commands': ['/askops'], 'channels': ['sre-oncall'],
+                     'settings': {'FAQBOT_SYSTEM_TEMPLATE': '...', 'INGEST_SITEMAP_URLS': [...]}},
+    }
+
+A Slack question goes to the knowledge base of its slash command; when
+several share the command, to the one listing the channel, else to the one
+without channels. 'settings' override the global settings of the same name
+for the knowledge base (system template, ingestion sources, ...).
+
+Without KNOWLEDGE_BASES there is a single 'default' knowledge base: VECTOR_DATABASE
+answering /askplivo.
+"""
+import settings
+
+
+DEFAULT = 'default'
+DEFAULT_COMMAND = '/askplivo'
+
+
+class KnowledgeBase(object):
+    def __init__(self, name, vector_database, index_name=None, commands=None, channels=None, settings=None):
+        self.name = name
+        self.vector_database = vector_database
+        # Redis index / Qdrant collection
+        self.index_name = index_name
+        self.commands = list(commands or [])
+        self.channels = list(channels or [])
+        self.settings = dict(settings or {})
+
+    def setting(self, name, default=None):
+        if name in self.settings:
+            return self.settings[name]
+        return getattr(settings, name, default)
+
+    def __repr__(self):
+        return f'KnowledgeBase({self.name!r}, {self.vector_database!r})'
+
+
+def knowledge_bases():
+    """{name: KnowledgeBase}, in the configuration order."""
+    config = getattr(settings, 'KNOWLEDGE_BASES', None)
+    if not config:
+        return {DEFAULT: KnowledgeBase(DEFAULT, settings.VECTOR_DATABASE,
+                                       index_name=getattr(settings, 'VECTOR_INDEX_NAME', None),
+                                       commands=[DEFAULT_COMMAND])}
+    return {name: KnowledgeBase(name, **entry) for name, entry in config.items()}
+
+
+def default_name():
+    return getattr(settings, 'DEFAULT_KNOWLEDGE_BASE', '') or next(iter(knowledge_bases()))
+
+
+def get(name=None):
+    kbs = knowledge_bases()
+    name = name or default_name()
+    if name not in kbs:
+        raise ValueError(f"Unknown knowledge base: {name}")
+    return kbs[name]
+
+
+def select(command, *channels):
+    """Name of the knowledge base answering a slash command in a channel (name
+    or ID), None when no knowledge base answers the command."""
+    candidates = [kb for kb in knowledge_bases().values() if command in kb.commands]
+    for kb in candidates:
+        if any(channel and channel in kb.channels for channel in channels):
+            return kb.name
+    for kb in candidates:
+        if not kb.channels:
+            return kb.name
+    return None
+
+
+def apply(name):
+    """Make the settings of a knowledge base the global ones, for a CLI working
+    on a single knowledge base (e.g. ingest.py --kb)."""
+    kb = get(name)
+    settings.VECTOR_DATABASE = kb.vector_database
+    if kb.index_name:
+        settings.VECTOR_INDEX_NAME = kb.index_name
+    for key, value in kb.settings.items():
+        setattr(settings, key, value)
+    return kb
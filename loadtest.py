@@ -0,0 +1,398 @@
+"""End-to-end load test of the Slack -> RQ -> LLM -> Slack path.
+
+Starts a local OpenAI stub (chat completions and embeddings, with configurable
+latency and error rate), a local receiver for the Slack response_url posts,
+the app under gunicorn and N real rqworkers, then fires signed /askplivo
+requests at the app and reports percentiles for:
+  - ack: time until /ask answers Slack
+  - queue_wait: time the job waited in RQ (enqueued -> started)
+  - processing: time the worker spent on the job (started -> ended)
+  - e2e: time until the answer was posted to response_url
+
+    python3 loadtest.py -n 200 -w 1,2,4,8 --llm-latency 3 -o loadtest.json
+
+A redis server must be running on localhost:6379 (app.py uses the default Redis()).
+"""
+import os
+import re
+import sys
+import json
+import time
+import hmac
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from urllib.parse import urlencode
+from datetime import timezone
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import requests
+
+
+TICKET_RE = re.compile(r'\*TicketID\*: ([0-9a-f-]+)')
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        return json.loads(body or b'{}')
+
+    def _send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _BackgroundServer(object):
+    def __init__(self, handler, port=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.server.owner = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _OpenAIStubHandler(_JSONHandler):
+    def do_POST(self):
+        stub = self.server.owner
+        data = self._read_json()
+        if self.path.endswith('/embeddings'):
+            time.sleep(stub.embedding_latency)
+            self._send_json(200, stub.embeddings(data))
+        elif self.path.endswith('/chat/completions'):
+            if random.random() < stub.slow_rate:
+                stub.count('slow')
+                time.sleep(stub.slow_latency)
+            else:
+                time.sleep(max(0.0, random.gauss(stub.llm_latency, stub.llm_jitter)))
+            if random.random() < stub.error_rate or data.get('model') in stub.failing_models:
+                stub.count('errors')
+                self._send_json(500, {'error': {'message': 'stub error', 'type': 'server_error'}})
+                return
+            self._send_json(200, stub.chat_completion(data))
+        else:
+            self._send_json(404, {'error': {'message': f'unknown path {self.path}'}})
+
+
+class OpenAIStub(_BackgroundServer):
+    """Local stand-in for the OpenAI chat completion and embedding endpoints.
+
+    slow_rate of the completions take slow_latency seconds (the tail), and the
+    completions of failing_models always fail.
+    """
+    def __init__(self, llm_latency=2.0, llm_jitter=0.5, embedding_latency=0.05,
+                 error_rate=0.0, dim=1536, port=0, slow_rate=0.0, slow_latency=30.0, failing_models=()):
+        super().__init__(_OpenAIStubHandler, port)
+        self.llm_latency = llm_latency
+        self.llm_jitter = llm_jitter
+        self.embedding_latency = embedding_latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.failing_models = set(failing_models)
+        self.dim = dim
+        self.counters = {'embeddings': 0, 'chat': 0, 'errors': 0, 'slow': 0}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def _vector(self, text):
+        seed = int(hashlib.md5(json.dumps(text).encode()).hexdigest()[:8], 16)
+        vector = np.random.default_rng(seed).standard_normal(self.dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embeddings(self, data):
+        inputs = data.get('input', [])
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        self.count('embeddings')
+        return {'object': 'list', 'model': data.get('model', 'stub'),
+                'data': [{'object': 'embedding', 'index': i, 'embedding': self._vector(text)}
+                         for i, text in enumerate(inputs)],
+                'usage': {'prompt_tokens': len(inputs), 'total_tokens': len(inputs)}}
+
+    def chat_completion(self, data):
+        self.count('chat')
+        prompt_tokens = sum(len(str(m.get('content', '')).split()) for m in data.get('messages', []))
+        return {'id': f'chatcmpl-stub-{random.randint(0, 1 << 30)}', 'object': 'chat.completion',
+                'created': int(time.time()), 'model': data.get('model', 'stub'),
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant',
+                                         'content': 'Stub answer.\nSOURCES: https://fixture/stub'}}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': 5,
+                          'total_tokens': prompt_tokens + 5}}
+
+
+class _ReceiverHandler(_JSONHandler):
+    def do_POST(self):
+        data = self._read_json()
+        self.server.owner.received(data)
+        self._send_json(200, {'ok': True})
+
+
+class SlackReceiver(_BackgroundServer):
+    """Local stand-in for the Slack response_url, records when each ticket is answered."""
+    def __init__(self, port=0):
+        super().__init__(_ReceiverHandler, port)
+        self.answers = {}
+        self._lock = threading.Lock()
+
+    def received(self, data):
+        match = TICKET_RE.search(data.get('text', ''))
+        if not match:
+            return
+        with self._lock:
+            self.answers[match.group(1)] = {'received_at': time.time(), 'text': data['text']}
+
+    def count(self, tickets):
+        with self._lock:
+            return len([t for t in tickets if t in self.answers])
+
+
+def slack_form(token, question, response_url, i):
+    return {'token': token, 'team_id': 'TLOAD', 'team_domain': 'loadtest',
+            'channel_id': 'CLOAD', 'channel_name': 'loadtest',
+            'user_id': f'U{i % 50}', 'user_name': f'loadtest{i % 50}',
+            'command': '/askplivo', 'text': question,
+            'response_url': response_url, 'trigger_id': f'load.{i}'}
+
+
+def slack_headers(body, signing_secret):
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    if signing_secret:
+        ts = str(int(time.time()))
+        base = f'v0:{ts}:{body}'.encode()
+        signature = hmac.new(signing_secret.encode(), base, hashlib.sha256).hexdigest()
+        headers['X-Slack-Request-Timestamp'] = ts
+        headers['X-Slack-Signature'] = f'v0={signature}'
+    return headers
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = np.asarray(values)
+    return {'count': int(len(values)),
+            'p50': round(float(np.percentile(values, 50)), 3),
+            'p90': round(float(np.percentile(values, 90)), 3),
+            'p99': round(float(np.percentile(values, 99)), 3),
+            'max': round(float(values.max()), 3)}
+
+
+def build_fixture_index(path, docs):
+    # imported here: OPENAI_API_BASE must point to the stub first
+    import bench
+    import vectordb
+    print(f"Building fixture index {path} with {docs} docs")
+    vectordb.Ingestor.ingest(path, bench.fixture_corpus(docs))
+
+
+def wait_for_http(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return True
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+def job_timings(api_ids):
+    """Read enqueued/started/ended timestamps of the finished jobs from RQ."""
+    from redis import Redis
+    from rq.job import Job
+    from rq.registry import FinishedJobRegistry, FailedJobRegistry
+    conn = Redis()
+    timings = {}
+    job_ids = []
+    for name in ('high', 'default'):
+        job_ids += FinishedJobRegistry(name, connection=conn).get_job_ids()
+        job_ids += FailedJobRegistry(name, connection=conn).get_job_ids()
+    for job in Job.fetch_many(job_ids, connection=conn):
+        if job is None or not job.args or job.args[0] not in api_ids:
+            continue
+        if not (job.enqueued_at and job.started_at and job.ended_at):
+            continue
+        ts = lambda d: d.replace(tzinfo=timezone.utc).timestamp()
+        timings[job.args[0]] = {'queue_wait': ts(job.started_at) - ts(job.enqueued_at),
+                                'processing': ts(job.ended_at) - ts(job.started_at)}
+    return timings
+
+
+def run_once(args, env, receiver, workers):
+    from redis import Redis
+    from rq import Queue
+    for name in ('high', 'default'):
+        Queue(name, connection=Redis()).empty()
+    procs = [subprocess.Popen(['rqworker'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+             for _ in range(workers)]
+    time.sleep(args.worker_warmup)
+    response_url = receiver.url + '/response'
+    sent = {}
+    acks = []
+    failed = 0
+
+    def fire(i):
+        question = args.questions[i % len(args.questions)]
+        body = urlencode(slack_form(args.token, question, response_url, i))
+        start = time.time()
+        r = requests.post(args.app_url + '/ask', data=body,
+                          headers=slack_headers(body, args.signing_secret), timeout=60)
+        ack = time.time() - start
+        data = r.json() if r.status_code == 200 else {}
+        # ephemeral answers are admission control rejections
+        if data.get('response_type') != 'in_channel':
+            return start, ack, None
+        match = TICKET_RE.search(data.get('text', ''))
+        return start, ack, match.group(1) if match else None
+
+    print(f"Workers: {workers}, sending {args.requests} requests (concurrency {args.concurrency})")
+    run_start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for start, ack, ticket in pool.map(fire, range(args.requests)):
+            acks.append(ack)
+            if ticket is None:
+                failed += 1
+                continue
+            sent[ticket] = start
+
+    deadline = time.time() + args.timeout
+    while receiver.count(sent) < len(sent) and time.time() < deadline:
+        time.sleep(0.5)
+    run_end = max([receiver.answers[t]['received_at'] for t in sent if t in receiver.answers] or [time.time()])
+
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    e2e = [receiver.answers[t]['received_at'] - sent[t] for t in sent if t in receiver.answers]
+    errors = len([t for t in sent if t in receiver.answers and 'Oops' in receiver.answers[t]['text']])
+    timings = job_timings(set(sent))
+    elapsed = run_end - run_start
+    return {'workers': workers,
+            'requests': args.requests,
+            'rejected': failed,
+            'answered': len(e2e),
+            'answered_with_error': errors,
+            'answered_busy': len([t for t in sent if t in receiver.answers and 'busy' in receiver.answers[t]['text']]),
+            'timed_out': len(sent) - len(e2e),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_per_s': round(len(e2e) / elapsed, 3) if elapsed > 0 else None,
+            'ack_s': percentiles(acks),
+            'queue_wait_s': percentiles([t['queue_wait'] for t in timings.values()]),
+            'processing_s': percentiles([t['processing'] for t in timings.values()]),
+            'e2e_s': percentiles(e2e)}
+
+
+def run(args):
+    stub = OpenAIStub(args.llm_latency, args.llm_jitter, args.embedding_latency, args.error_rate).start()
+    receiver = SlackReceiver().start()
+    env = dict(os.environ)
+    env.update({'OPENAI_API_BASE': stub.url + '/v1',
+                'OPENAI_API_KEY': env.get('OPENAI_API_KEY') or 'sk-loadtest',
+                'OPENAI_MODEL': env.get('OPENAI_MODEL') or 'gpt-3.5-turbo',
+                'SLACK_TOKEN_ID': args.token})
+    if not args.admission:
+        env.update({'ASK_RATE_LIMIT_USER': '0', 'ASK_RATE_LIMIT_TEAM': '0',
+                    'ASK_MAX_QUEUE_WAIT': '0', 'ASK_MAX_AGE': str(args.timeout)})
+    os.environ.update(env)
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    if not args.vector_database:
+        args.vector_database = os.path.join(workdir, 'loadtest.faiss')
+        build_fixture_index(args.vector_database, args.docs)
+    env['VECTOR_DATABASE'] = args.vector_database
+
+    gunicorn = None
+    if not args.app_url:
+        port = args.app_port
+        gunicorn = subprocess.Popen(['gunicorn', '-c', './gunicorn.conf.py', '-b', f'127.0.0.1:{port}', 'app:app'],
+                                    env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        args.app_url = f'http://127.0.0.1:{port}'
+    report = {'requests': args.requests, 'concurrency': args.concurrency,
+              'llm_latency': args.llm_latency, 'llm_jitter': args.llm_jitter,
+              'embedding_latency': args.embedding_latency, 'error_rate': args.error_rate,
+              'runs': []}
+    try:
+        wait_for_http(args.app_url + '/status')
+        for workers in args.workers:
+            result = run_once(args, env, receiver, workers)
+            print(json.dumps(result))
+            report['runs'].append(result)
+    finally:
+        if gunicorn is not None:
+            gunicorn.terminate()
+            gunicorn.wait()
+        stub.stop()
+        receiver.stop()
+    report['openai_stub'] = stub.counters
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"Report saved into {args.output}")
+    else:
+        print(output)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test of /ask -> RQ -> LLM -> response_url")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="Requests per run - default: 200")
+    parser.add_argument("-c", "--concurrency", type=int, default=200, help="Concurrent /ask requests - default: 200")
+    parser.add_argument("-w", "--workers", type=lambda v: [int(w) for w in v.split(',')], default=[1, 2, 4],
+                        help="Comma separated rqworker counts, one run each - default: 1,2,4")
+    parser.add_argument("--worker-warmup", type=float, default=3.0, help="Seconds to wait for the rqworkers to start - default: 3")
+    parser.add_argument("--llm-latency", type=float, default=2.0, help="Mean chat completion latency in seconds - default: 2")
+    parser.add_argument("--llm-jitter", type=float, default=0.5, help="Chat completion latency std deviation - default: 0.5")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="Embedding latency in seconds - default: 0.05")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of chat completions failing with a 500 - default: 0")
+    parser.add_argument("--app-url", type=str, default="", help="Running app to test - default: start gunicorn")
+    parser.add_argument("--app-port", type=int, default=50606, help="Port of the gunicorn started by the harness - default: 50606")
+    parser.add_argument("--vector-database", type=str, default="", help="VECTOR_DATABASE for the workers - default: fixture FAISS index")
+    parser.add_argument("--docs", type=int, default=1000, help="Fixture index size - default: 1000")
+    parser.add_argument("--token", type=str, default=os.getenv('SLACK_TOKEN_ID') or 'loadtest-token', help="Slack verification token")
+    parser.add_argument("--signing-secret", type=str, default=os.getenv('SLACK_SIGNING_SECRET', ''), help="Slack signing secret used to sign the payloads")
+    parser.add_argument("--question", dest="questions", action="append", default=None, help="Question to ask, can be repeated")
+    parser.add_argument("--admission", action="store_true", help="Keep the admission control settings (rate limits, load shedding) - default: disabled")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for all the answers of a run - default: 600")
+    parser.add_argument("-o", "--output", type=str, default="", help="Write the JSON report into this file")
+    args = parser.parse_args()
+    if not args.questions:
+        args.questions = ['How can I send an SMS?', 'How do I buy a phone number?',
+                          'What is a webhook?', 'How to play audio with XML?']
+    run(args)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
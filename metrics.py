@@ -0,0 +1,187 @@
+"""Per-stage latency spans and counters, aggregated in Redis and rendered in
+the Prometheus text format.
+
+The rqworkers (where the questions are answered) and the gunicorn workers
+(which serve /metrics) are different processes, so the aggregates live in
+the Redis instance already used by RQ. A job records its spans in memory
+and writes them with a single pipeline at the end.
+
+    with metrics.Spans(api_id) as spans:
+        with metrics.span('llm'):
+            ...
+        metrics.incr('askme_tokens_total', 42, type='prompt')
+    spans.flush()
+"""
+import time
+import contextvars
+from contextlib import contextmanager
+from redis import Redis
+
+
+PREFIX = 'askme:metrics'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, float('inf'))
+
+_current = contextvars.ContextVar('askme_spans', default=None)
+
+
+def _bucket(seconds):
+    for le in BUCKETS:
+        if seconds <= le:
+            return '+Inf' if le == float('inf') else str(le)
+    return '+Inf'
+
+
+def _labels(labels):
+    return ','.join(f'{k}={v}' for k, v in sorted(labels.items()))
+
+
+class Spans(object):
+    """Stage durations and counters of one ticket (api_id)."""
+    def __init__(self, api_id=None):
+        self.api_id = api_id
+        self.durations = {}
+        self.counters = {}
+        self.attrs = {}
+        # a profiler.Profiler sampling this ticket, told about every stage
+        self.profiler = None
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _current.reset(self._token)
+        self._token = None
+        return False
+
+    def observe(self, stage, seconds):
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    def incr(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, stage):
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+            if profiler is not None:
+                profiler.exit(stage)
+
+    def as_dict(self):
+        return {stage: round(seconds, 4) for stage, seconds in self.durations.items()}
+
+    def flush(self, conn=None):
+        """Add the spans and counters to the Redis aggregates, never raises."""
+        try:
+            pipe = (conn or Redis()).pipeline(transaction=False)
+            for stage, seconds in self.durations.items():
+                key = f'{PREFIX}:hist:{stage}'
+                pipe.hincrby(key, _bucket(seconds), 1)
+                pipe.hincrbyfloat(key, 'sum', seconds)
+                pipe.hincrby(key, 'count', 1)
+            for (name, labels), value in self.counters.items():
+                pipe.hincrbyfloat(f'{PREFIX}:counters', f'{name}|{labels}', value)
+            pipe.execute()
+            return True
+        except Exception as e:
+            print(f"WARNING: metrics flush failed: {e}")
+            return False
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def span(stage):
+    """Time a stage of the current ticket, no-op outside of a Spans context."""
+    spans = _current.get()
+    if spans is None:
+        yield
+        return
+    with spans.span(stage):
+        yield
+
+
+def observe(stage, seconds):
+    spans = _current.get()
+    if spans is not None:
+        spans.observe(stage, seconds)
+
+
+def incr(name, value=1, **labels):
+    spans = _current.get()
+    if spans is not None:
+        spans.incr(name, value, **labels)
+
+
+def annotate(**attrs):
+    """Attach attributes (e.g. context packing stats) to the current ticket."""
+    spans = _current.get()
+    if spans is not None:
+        spans.attrs.update(attrs)
+
+
+def set_gauge(name, value, conn=None):
+    try:
+        (conn or Redis()).hset(f'{PREFIX}:gauges', name, value)
+        return True
+    except Exception as e:
+        print(f"WARNING: metrics gauge failed: {e}")
+        return False
+
+
+def get_gauges(conn=None):
+    raw = (conn or Redis()).hgetall(f'{PREFIX}:gauges')
+    return {k.decode(): float(v) for k, v in raw.items()}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for item in labels.split(','):
+        k, v = item.split('=', 1)
+        parts.append(f'{k}="{v}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def render(conn=None, extra_gauges=None):
+    """Render the aggregates in the Prometheus text exposition format."""
+    conn = conn or Redis()
+    lines = ['# HELP askme_stage_seconds Latency of each stage of a question',
+             '# TYPE askme_stage_seconds histogram']
+    for key in sorted(conn.scan_iter(f'{PREFIX}:hist:*')):
+        stage = key.decode().rsplit(':', 1)[-1]
+        data = {k.decode(): v for k, v in conn.hgetall(key).items()}
+        cumulative = 0
+        for le in BUCKETS:
+            name = '+Inf' if le == float('inf') else str(le)
+            cumulative += int(data.get(name, 0))
+            lines.append(f'askme_stage_seconds_bucket{{stage="{stage}",le="{name}"}} {cumulative}')
+        lines.append(f'askme_stage_seconds_sum{{stage="{stage}"}} {float(data.get("sum", 0))}')
+        lines.append(f'askme_stage_seconds_count{{stage="{stage}"}} {int(data.get("count", 0))}')
+
+    counters = {}
+    for field, value in conn.hgetall(f'{PREFIX}:counters').items():
+        name, labels = field.decode().split('|', 1)
+        counters.setdefault(name, []).append((labels, float(value)))
+    for name in sorted(counters):
+        lines.append(f'# TYPE {name} counter')
+        for labels, value in sorted(counters[name]):
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+
+    gauges = get_gauges(conn)
+    gauges.update(extra_gauges or {})
+    for name in sorted(gauges):
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {gauges[name]}')
+    return '\n'.join(lines) + '\n'
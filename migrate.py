@@ -0,0 +1,64 @@
+"""Move an index between engines, or back it up, without crawling nor
+embedding anything again.
+
+The chunks are streamed out of the source engine with their vectors and
+metadata, batch by batch, and written in bulk into the destination engine,
+either directly (copy) or through a compact vector file (export, import):
+gzip of JSON lines for the texts and metadata and raw float32 vectors.
+
+    python3 migrate.py export /data/codebot.faiss codebot.vectors.gz
+    python3 migrate.py import codebot.vectors.gz qdrant://localhost:6333 --index-name plivoaskme
+    python3 migrate.py copy /data/codebot.faiss redis://localhost:6379
+
+A FAISS source is loaded whole, as when serving it; a FAISS destination
+keeps its flat index in memory and writes the chunks to its SQLite docstore
+as they come, then builds FAISS_INDEX_TYPE/FAISS_QUANTIZER.
+"""
+import os
+import sys
+import argparse
+
+import vectordb
+from index_versions import record_ingest_run
+
+
+def is_faiss_file(vector_url):
+    return '://' not in vector_url and vector_url not in ('mock', 'dummy')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export, import or copy an index with its vectors")
+    parser.add_argument("command", choices=['export', 'import', 'copy'])
+    parser.add_argument("source", type=str, help="export/copy: vector URL of the index, import: vector file")
+    parser.add_argument("destination", type=str, help="export: vector file, import/copy: vector URL to write")
+    parser.add_argument("--index-name", type=str, default="", help="Redis index / Qdrant collection to read or write - default: plivoaskme")
+    parser.add_argument("--destination-index-name", type=str, default="", help="copy: Redis index / Qdrant collection to write - default: --index-name")
+    parser.add_argument("-b", "--batch-size", type=int, default=vectordb.EXPORT_BATCH_SIZE, help=f"Chunks per batch - default: {vectordb.EXPORT_BATCH_SIZE}")
+    parser.add_argument("-f", "--force", action="store_true", help="Overwrite an existing vector file or FAISS file")
+    args = parser.parse_args()
+    index_name = args.index_name or None
+    if args.command == 'export':
+        destination_exists = os.path.exists(args.destination)
+    else:
+        destination_exists = is_faiss_file(args.destination) and os.path.exists(args.destination)
+    if destination_exists and not args.force:
+        print(f"{args.destination} already exists. Use --force to overwrite it")
+        sys.exit(1)
+
+    if args.command == 'export':
+        vectordb.export_index(args.source, args.destination, index_name, args.batch_size)
+        sys.exit(0)
+    if args.command == 'import':
+        ok = vectordb.import_index(args.source, args.destination, index_name)
+    else:
+        index_name = args.destination_index_name or index_name
+        ok = vectordb.copy_index(args.source, args.destination, args.index_name or None,
+                                 index_name, args.batch_size)
+    if ok and not is_faiss_file(args.destination) and not args.destination.startswith('multi://'):
+        # new content in an engine synced in place: refresh its precomputed answers
+        record_ingest_run(args.destination, vectordb.INGEST_RUN_ID, index_name)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Precomputed answers for the most frequent questions.
+
+/ask records every question in a capped Redis list. Off-peak (e.g. from
+cron) and after every ingestion, the recorded questions are normalized,
+embedded and clustered, and the PRECOMPUTE_TOP most asked clusters are
+answered through the normal BaseFAQBot path. The answers are stored in Redis
+along with the index version they were computed from.
+
+A question matching a member of a cluster once normalized (or, with
+PRECOMPUTE_MATCH_SIMILARITY, close enough to a cluster) is answered from the
+store in milliseconds, as long as the index version served is still the one
+the answers were computed from.
+
+    python3 precompute.py                  # refresh if the index version changed
+    python3 precompute.py --force --top 300
+    python3 precompute.py --questions questions.txt
+"""
+import re
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+import numpy as np
+from redis import Redis
+
+import settings
+
+
+PREFIX = 'askme:precomputed'
+QUESTIONS_KEY = 'askme:questions'
+
+# centroids of the stored clusters, per process: {generation: (ids, matrix)}
+_centroids = {}
+
+
+def normalize(question):
+    """Lower case words, without punctuation nor repeated spaces."""
+    return ' '.join(re.findall(r'\w+', (question or '').lower()))
+
+
+def record_question(question, conn=None):
+    """Append an asked question to the capped log mined by precompute()."""
+    try:
+        pipe = (conn or Redis()).pipeline(transaction=False)
+        pipe.lpush(QUESTIONS_KEY, question)
+        pipe.ltrim(QUESTIONS_KEY, 0, getattr(settings, 'PRECOMPUTE_LOG_SIZE', 50000) - 1)
+        pipe.execute()
+        return True
+    except Exception as e:
+        print(f"WARNING: recording question failed: {e}")
+        return False
+
+
+def recorded_questions(conn=None):
+    return [q.decode() for q in (conn or Redis()).lrange(QUESTIONS_KEY, 0, -1)]
+
+
+def _unit(vectors):
+    vectors = np.asarray(vectors, dtype='float32')
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def cluster(questions, embeddings, similarity=0.92, min_count=2, max_questions=5000):
+    """Group the questions by meaning, most asked clusters first.
+
+    Every distinct (normalized) question asked at least min_count times joins
+    the cluster of the first, more frequent, question it is similar enough to,
+    or starts a new one. Return [{'question', 'members', 'count', 'vector'}]
+    where question is the most asked spelling of the most asked member.
+    """
+    spellings = {}
+    counts = Counter()
+    for question in questions:
+        key = normalize(question)
+        if key:
+            counts[key] += 1
+            spellings.setdefault(key, Counter())[question.strip()] += 1
+    top = [(key, count) for key, count in counts.most_common(max_questions) if count >= min_count]
+    if not top:
+        return []
+    vectors = _unit(embeddings.embed_documents([key for key, _ in top]))
+    clusters = []
+    leaders = np.zeros((0, vectors.shape[1]), dtype='float32')
+    for (key, count), vector in zip(top, vectors):
+        if len(clusters):
+            scores = leaders @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= similarity:
+                clusters[best]['members'].append(key)
+                clusters[best]['count'] += count
+                continue
+        clusters.append({'question': spellings[key].most_common(1)[0][0],
+                         'members': [key],
+                         'count': count,
+                         'vector': vector})
+        leaders = np.vstack([leaders, vector])
+    clusters.sort(key=lambda c: c['count'], reverse=True)
+    return clusters
+
+
+class PrecomputedAnswers(object):
+    def __init__(self, conn=None):
+        self.conn = conn or Redis()
+
+    def version(self):
+        version = self.conn.get(f'{PREFIX}:version')
+        return version.decode() if version is not None else None
+
+    def lookup(self, question, version, embeddings=None, similarity=0.0):
+        """The stored response of a question, None when not precomputed or
+        computed from another index version."""
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.get(f'{PREFIX}:version')
+        pipe.get(f'{PREFIX}:generation')
+        pipe.hget(f'{PREFIX}:questions', normalize(question))
+        stored_version, generation, cluster_id = pipe.execute()
+        if stored_version is None or stored_version.decode() != version:
+            return None
+        if cluster_id is None and similarity and embeddings is not None:
+            cluster_id = self._closest(question, generation, embeddings, similarity)
+        if cluster_id is None:
+            return None
+        answer = self.conn.hget(f'{PREFIX}:answers', cluster_id)
+        return json.loads(answer) if answer is not None else None
+
+    def _closest(self, question, generation, embeddings, similarity):
+        if generation not in _centroids:
+            raw = self.conn.hgetall(f'{PREFIX}:centroids')
+            ids = sorted(raw)
+            matrix = np.stack([np.frombuffer(raw[i], dtype='float32') for i in ids]) if ids else None
+            _centroids.clear()
+            _centroids[generation] = (ids, matrix)
+        ids, matrix = _centroids[generation]
+        if matrix is None:
+            return None
+        scores = matrix @ _unit(embeddings.embed_query(question))
+        best = int(np.argmax(scores))
+        return ids[best] if scores[best] >= similarity else None
+
+    def store(self, version, clusters, responses):
+        """Replace the stored answers, atomically for the readers."""
+        questions, answers, centroids = {}, {}, {}
+        for i, (entry, response) in enumerate(zip(clusters, responses)):
+            if response is None:
+                continue
+            cluster_id = str(i)
+            answers[cluster_id] = json.dumps(dict(response, precomputed={
+                'cluster': entry['question'], 'count': entry['count'],
+                'version': version, 'computed_at': time.time()}))
+            centroids[cluster_id] = np.asarray(entry['vector'], dtype='float32').tobytes()
+            for member in entry['members']:
+                questions[member] = cluster_id
+        pipe = self.conn.pipeline(transaction=True)
+        for name, mapping in (('questions', questions), ('answers', answers), ('centroids', centroids)):
+            pipe.delete(f'{PREFIX}:{name}')
+            if mapping:
+                pipe.hset(f'{PREFIX}:{name}', mapping=mapping)
+        pipe.set(f'{PREFIX}:version', version)
+        pipe.set(f'{PREFIX}:generation', str(time.time()))
+        pipe.execute()
+        return len(answers)
+
+
+def lookup(question, version, embeddings=None):
+    """Stored response of a question for the index version, None on a miss or
+    when Redis is not available."""
+    try:
+        return PrecomputedAnswers().lookup(question, version, embeddings,
+                                           getattr(settings, 'PRECOMPUTE_MATCH_SIMILARITY', 0.0))
+    except Exception as e:
+        print(f"WARNING: precomputed answer lookup failed: {e}")
+        return None
+
+
+def precompute(bot, questions, top=200, similarity=0.92, min_count=2, conn=None):
+    """Answer the top clusters of questions with bot and store the answers for
+    the index version it serves."""
+    version = bot.index_version()
+    clusters = cluster(questions, bot._embeddings, similarity, min_count)[:top]
+    print(f"Precomputing {len(clusters)} clusters out of {len(questions)} questions for index version {version}")
+    start = time.perf_counter()
+    bot.use_precomputed = False
+    responses = []
+    for entry, result in zip(clusters, bot.ask_batch([c['question'] for c in clusters])):
+        data = json.loads(result)
+        if data['status'] != 'success':
+            print(f"WARNING: precomputing '{entry['question']}' failed: {data.get('error')}")
+            responses.append(None)
+            continue
+        responses.append(data['response'])
+    stored = PrecomputedAnswers(conn).store(version, clusters, responses)
+    print(f"Stored {stored} precomputed answers in {time.perf_counter() - start:.1f}s")
+    return stored
+
+
+def refresh(force=False, questions_file=None, top=None, similarity=None, min_count=None):
+    """Precompute the answers again if the index version served changed since the last run."""
+    from faqbot import FAQBot
+    bot = FAQBot()
+    version = bot.index_version()
+    store = PrecomputedAnswers()
+    if not force and store.version() == version:
+        print(f"Precomputed answers are up to date with index version {version}")
+        return 0
+    questions = recorded_questions()
+    if questions_file:
+        with open(questions_file) as f:
+            questions += [line.strip() for line in f if line.strip()]
+    return precompute(bot, questions,
+                      top=top or getattr(settings, 'PRECOMPUTE_TOP', 200),
+                      similarity=similarity or getattr(settings, 'PRECOMPUTE_SIMILARITY', 0.92),
+                      min_count=min_count or getattr(settings, 'PRECOMPUTE_MIN_COUNT', 2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the answers of the most frequent questions")
+    parser.add_argument("-f", "--force", action="store_true", help="Precompute even if the index version did not change")
+    parser.add_argument("-q", "--questions", type=str, default="", help="File with more questions, one per line (e.g. mined from older logs)")
+    parser.add_argument("-t", "--top", type=int, default=0, help="Clusters to precompute - default: PRECOMPUTE_TOP")
+    parser.add_argument("-s", "--similarity", type=float, default=0, help="Cosine similarity to join a cluster - default: PRECOMPUTE_SIMILARITY")
+    parser.add_argument("-m", "--min-count", type=int, default=0, help="Minimum times a question was asked - default: PRECOMPUTE_MIN_COUNT")
+    args = parser.parse_args()
+    refresh(args.force, args.questions, args.top, args.similarity, args.min_count)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""Opt-in sampling profiler for the questions and the ingestion runs.
+
+A profiled ticket (PROFILE_SAMPLE_RATE of the Slack questions, or an
+ingest.py --profile run) gets:
+  - a background thread sampling the Python stacks of every thread each
+    PROFILE_INTERVAL_MS, written in the folded format of flamegraph.pl and
+    speedscope: <PROFILE_DIR>/<ticket>.folded
+  - with PROFILE_TRACEMALLOC, the peak memory traced during every stage
+    (the metrics spans) and the allocations still held at the end:
+    <PROFILE_DIR>/<ticket>.memory.json
+
+    flamegraph.pl profiles/<ticket>.folded > <ticket>.svg
+
+The stacks tell apart unpickling the index, parsing, splitting and waiting
+on the network (socket reads). tracemalloc slows the allocations down, keep
+the sample rate low in production.
+"""
+import os
+import sys
+import json
+import time
+import random
+import threading
+import tracemalloc
+from collections import Counter
+
+import settings
+
+
+class Profiler(object):
+    def __init__(self, name, interval=0.01, trace_memory=True, output_dir='profiles'):
+        self.name = name
+        self.interval = interval
+        self.trace_memory = trace_memory
+        self.output_dir = output_dir
+        self.stacks = Counter()
+        self.samples = 0
+        self.stages = {}
+        self._open = []
+        self._thread = None
+        self._stop = threading.Event()
+        self._started_tracing = False
+        self._snapshot = None
+        self._start = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._start = time.perf_counter()
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(getattr(settings, 'PROFILE_TRACEMALLOC_FRAMES', 1))
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+            self._snapshot = tracemalloc.take_snapshot()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='askme-profiler')
+        self._thread.start()
+        return self
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            with self._lock:
+                for ident, frame in sys._current_frames().items():
+                    if ident != own:
+                        self.stacks[self._collapse(names.get(ident, str(ident)), frame)] += 1
+                self.samples += 1
+
+    @staticmethod
+    def _collapse(thread_name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.append(thread_name)
+        return ';'.join(reversed(stack))
+
+    def _memory_checkpoint(self):
+        """Account the peak since the last checkpoint to every open stage."""
+        current, peak = tracemalloc.get_traced_memory()
+        for entry in self._open:
+            entry['peak'] = max(entry['peak'], peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def enter(self, stage):
+        entry = {'stage': stage, 'start': time.perf_counter(), 'peak': 0, 'current': 0}
+        if self.trace_memory and tracemalloc.is_tracing():
+            entry['current'] = self._memory_checkpoint()
+        self._open.append(entry)
+
+    def exit(self, stage):
+        if self.trace_memory and tracemalloc.is_tracing():
+            self._memory_checkpoint()
+        for i in range(len(self._open) - 1, -1, -1):
+            if self._open[i]['stage'] == stage:
+                entry = self._open.pop(i)
+                break
+        else:
+            return
+        stats = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'peak_bytes': 0, 'peak_increase_bytes': 0})
+        stats['count'] += 1
+        stats['seconds'] += time.perf_counter() - entry['start']
+        stats['peak_bytes'] = max(stats['peak_bytes'], entry['peak'])
+        stats['peak_increase_bytes'] = max(stats['peak_increase_bytes'], entry['peak'] - entry['current'])
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        held = []
+        if self.trace_memory and tracemalloc.is_tracing():
+            self._memory_checkpoint()
+            snapshot = tracemalloc.take_snapshot()
+            held = [{'where': str(stat.traceback), 'size_bytes': stat.size_diff, 'count': stat.count_diff}
+                    for stat in snapshot.compare_to(self._snapshot, 'lineno')[:20] if stat.size_diff > 0]
+            self._snapshot = None
+            if self._started_tracing:
+                tracemalloc.stop()
+        self.held = held
+        return self
+
+    def save(self, **extra):
+        """Write the folded stacks and the memory report, return their paths."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        folded = os.path.join(self.output_dir, f'{self.name}.folded')
+        with open(folded, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        report = dict({'name': self.name,
+                       'seconds': round(time.perf_counter() - self._start, 3),
+                       'samples': self.samples,
+                       'interval_ms': self.interval * 1000,
+                       'stages': {stage: dict(stats, seconds=round(stats['seconds'], 4))
+                                  for stage, stats in self.stages.items()},
+                       'held_at_end': getattr(self, 'held', [])}, **extra)
+        memory = os.path.join(self.output_dir, f'{self.name}.memory.json')
+        with open(memory, 'w') as f:
+            json.dump(report, f, indent=2)
+        return folded, memory
+
+
+def create(name):
+    return Profiler(name,
+                    interval=getattr(settings, 'PROFILE_INTERVAL_MS', 10) / 1000.0,
+                    trace_memory=getattr(settings, 'PROFILE_TRACEMALLOC', True),
+                    output_dir=getattr(settings, 'PROFILE_DIR', '') or 'profiles')
+
+
+def sample(name):
+    """A started Profiler for PROFILE_SAMPLE_RATE of the calls, None otherwise."""
+    rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0.0)
+    if not rate or random.random() >= rate:
+        return None
+    return create(name).start()
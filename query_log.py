@@ -0,0 +1,197 @@
+"""Local query log for capacity planning.
+
+Every question answered by BaseFAQBot (Slack, CLI, batch and async API)
+appends one row to a SQLite file (QUERY_LOG_PATH, WAL mode so the workers
+append concurrently): the normalized question, the index version, the
+retrieved chunks with their relevance, the per-stage timings and the
+prompt/completion tokens and cost.
+
+    python3 query_log.py top --since 7d -n 20
+    python3 query_log.py latency --since 24h
+    python3 query_log.py spend --since 30d --bucket day
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+import settings
+from precompute import normalize
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS queries (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    ticket TEXT,
+    origin TEXT,
+    status TEXT,
+    question TEXT,
+    normalized TEXT,
+    index_version TEXT,
+    model TEXT,
+    degraded TEXT,
+    hedged INTEGER DEFAULT 0,
+    precomputed INTEGER DEFAULT 0,
+    retrieved TEXT,
+    stages TEXT,
+    seconds REAL,
+    prompt_tokens INTEGER DEFAULT 0,
+    completion_tokens INTEGER DEFAULT 0,
+    cost_usd REAL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS queries_ts ON queries (ts);
+CREATE INDEX IF NOT EXISTS queries_normalized ON queries (normalized);
+'''
+# added to the logs created before them
+COLUMNS = {'degraded': 'TEXT', 'hedged': 'INTEGER DEFAULT 0'}
+BUCKETS = {'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d', 'week': '%Y-W%W', 'month': '%Y-%m'}
+
+
+def log_path():
+    return getattr(settings, 'QUERY_LOG_PATH', '') or 'query_log.sqlite'
+
+
+class QueryLog(object):
+    """One connection per process and thread, opened on first use."""
+    def __init__(self, path=None):
+        self.path = path or log_path()
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            existing = {row[1] for row in conn.execute('PRAGMA table_info(queries)')}
+            for name, definition in COLUMNS.items():
+                if name not in existing:
+                    conn.execute(f'ALTER TABLE queries ADD COLUMN {name} {definition}')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def append(self, question, origin=None, ticket=None, status='success', index_version=None,
+               model=None, degraded=None, hedged=False, precomputed=False, retrieved=None, stages=None,
+               seconds=None, prompt_tokens=0, completion_tokens=0, cost_usd=0.0):
+        conn = self._conn()
+        with conn:
+            conn.execute('INSERT INTO queries (ts, ticket, origin, status, question, normalized, index_version, '
+                         'model, degraded, hedged, precomputed, retrieved, stages, seconds, prompt_tokens, '
+                         'completion_tokens, cost_usd) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (time.time(), ticket, origin, status, question, normalize(question), index_version,
+                          model, degraded, int(bool(hedged)), int(bool(precomputed)), json.dumps(retrieved or []), json.dumps(stages or {}),
+                          seconds, prompt_tokens, completion_tokens, cost_usd))
+
+    def _where(self, since=None, origin=None):
+        clauses, params = [], []
+        if since:
+            clauses.append('ts >= ?')
+            params.append(time.time() - since)
+        if origin:
+            clauses.append('origin = ?')
+            params.append(origin)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def top_questions(self, since=None, origin=None, limit=20):
+        where, params = self._where(since, origin)
+        rows = self._conn().execute(
+            f'SELECT normalized, COUNT(*), MAX(question), AVG(seconds), SUM(precomputed), SUM(cost_usd) '
+            f'FROM queries{where} GROUP BY normalized ORDER BY COUNT(*) DESC LIMIT ?', params + [limit])
+        return [{'question': question, 'normalized': normalized, 'count': count,
+                 'avg_seconds': round(avg or 0, 3), 'precomputed': int(precomputed or 0),
+                 'cost_usd': round(cost or 0, 4)}
+                for normalized, count, question, avg, precomputed, cost in rows]
+
+    def latency(self, since=None, origin=None, percentiles=(50, 90, 95, 99)):
+        """Percentiles of the total and per-stage seconds."""
+        where, params = self._where(since, origin)
+        series = {}
+        for seconds, stages in self._conn().execute(f'SELECT seconds, stages FROM queries{where}', params):
+            if seconds is not None:
+                series.setdefault('total', []).append(seconds)
+            for stage, value in json.loads(stages or '{}').items():
+                series.setdefault(stage, []).append(value)
+        report = {}
+        for stage, values in sorted(series.items()):
+            values.sort()
+            report[stage] = dict({'count': len(values)},
+                                 **{f'p{p}': round(percentile(values, p), 3) for p in percentiles})
+        return report
+
+    def spend(self, since=None, origin=None, bucket='day'):
+        where, params = self._where(since, origin)
+        rows = self._conn().execute(
+            f"SELECT strftime(?, ts, 'unixepoch') AS period, COUNT(*), SUM(prompt_tokens), "
+            f"SUM(completion_tokens), SUM(cost_usd), SUM(precomputed), SUM(hedged), "
+            f"SUM(degraded IS NOT NULL) "
+            f"FROM queries{where} GROUP BY period ORDER BY period", [BUCKETS[bucket]] + params)
+        return [{'period': period, 'questions': count, 'prompt_tokens': prompt or 0,
+                 'completion_tokens': completion or 0, 'cost_usd': round(cost or 0, 4),
+                 'precomputed': int(precomputed or 0), 'hedged': int(hedged or 0),
+                 'degraded': int(degraded or 0)}
+                for period, count, prompt, completion, cost, precomputed, hedged, degraded in rows]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    rank = max(1, int(-(-p * len(values) // 100)))
+    return values[min(rank, len(values)) - 1]
+
+
+_log = None
+
+
+def append(question, **row):
+    """Append a question to the query log of the process, never raises."""
+    global _log
+    if not getattr(settings, 'QUERY_LOG_ENABLED', True):
+        return False
+    try:
+        if _log is None:
+            _log = QueryLog()
+        _log.append(question, **row)
+        return True
+    except Exception as e:
+        print(f"WARNING: query log append failed: {e}")
+        return False
+
+
+def duration(value):
+    """Seconds of a 30m, 24h, 7d or 2w duration."""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report on the query log")
+    parser.add_argument("report", choices=['top', 'latency', 'spend'])
+    parser.add_argument("--since", type=duration, default=None, help="Time window, e.g. 24h, 7d - default: everything")
+    parser.add_argument("--origin", type=str, default="", help="Only the questions from slack, cli, batch or api")
+    parser.add_argument("-n", "--limit", type=int, default=20, help="top: number of questions - default: 20")
+    parser.add_argument("--bucket", choices=list(BUCKETS), default='day', help="spend: period of a row - default: day")
+    parser.add_argument("--path", type=str, default="", help="Query log file - default: QUERY_LOG_PATH")
+    args = parser.parse_args()
+    log = QueryLog(args.path or None)
+    if args.report == 'top':
+        report = log.top_questions(args.since, args.origin, args.limit)
+    elif args.report == 'latency':
+        report = log.latency(args.since, args.origin)
+    else:
+        report = log.spend(args.since, args.origin, args.bucket)
+    print(json.dumps(report, indent=2))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""Deadline, hedging and circuit breaking for the completions.
+
+- a question gets a deadline (FAQBOT_DEADLINE seconds after it was asked,
+  RQ retries included): every stage checks it and each completion request
+  times out at the deadline instead of after FAQBOT_OPENAI_REQUEST_TIMEOUT
+- a completion still running after the p95 latency observed by the process
+  is hedged: a second identical request is sent and the first answer wins
+- each model has a circuit breaker: after FAQBOT_BREAKER_FAILURES failures
+  (errors or timeouts) within FAQBOT_BREAKER_WINDOW seconds the model is
+  skipped for FAQBOT_BREAKER_COOLDOWN seconds, in favour of the fallback
+  model (FAQBOT_OPENAI_FALLBACK_MODEL)
+- without any model available, or too little time left, the answer is
+  "sources only": the retrieved documents without a completion
+
+The breakers and latencies are per process. resilience_check.py exercises
+all of this against a local slow/failing OpenAI stub.
+"""
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, List
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+import metrics
+
+
+SOURCES_ONLY_MESSAGE = ("Sorry, I can't write an answer right now, "
+                        "the documents below should help with your question.")
+# observed completions needed before hedging at their p95 instead of the default delay
+MIN_LATENCY_SAMPLES = 20
+
+_deadline = contextvars.ContextVar('askme_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """Answer before deadline (a time.time() timestamp), or an earlier one already set."""
+    current = _deadline.get()
+    if current is not None:
+        deadline = current if deadline is None else min(current, deadline)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left before the deadline of the current question, None without deadline."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+
+def check(stage):
+    left = remaining()
+    if left is not None and left <= 0:
+        metrics.incr('askme_deadline_exceeded_total', stage=stage)
+        raise DeadlineExceeded(f"Deadline exceeded before {stage}")
+
+
+class CircuitBreaker(object):
+    """closed -> open after failures in window seconds -> half open (one trial
+    request) after cooldown seconds -> closed on success, open on failure."""
+    def __init__(self, name, failures=5, window=60.0, cooldown=30.0):
+        self.name = name
+        self.failures = failures
+        self.window = window
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self._failed_at = deque()
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self._opened_at >= self.cooldown:
+                self.state = 'half_open'
+                self._trial = False
+            if self.state == 'half_open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.state != 'closed':
+                print(f"Circuit of {self.name} closed")
+            self.state = 'closed'
+            self._failed_at.clear()
+
+    def failure(self):
+        with self._lock:
+            now = time.time()
+            self._failed_at.append(now)
+            while self._failed_at and now - self._failed_at[0] > self.window:
+                self._failed_at.popleft()
+            if self.state == 'half_open' or (self.state == 'closed' and len(self._failed_at) >= self.failures):
+                print(f"WARNING: circuit of {self.name} open for {self.cooldown}s")
+                metrics.incr('askme_llm_circuit_open_total', model=self.name)
+                self.state = 'open'
+                self._opened_at = now
+
+
+class LatencyTracker(object):
+    """Latencies of the last successful completions of a model."""
+    def __init__(self, size=200):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._values.append(seconds)
+
+    def percentile(self, p):
+        with self._lock:
+            values = sorted(self._values)
+        if len(values) < MIN_LATENCY_SAMPLES:
+            return None
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+_breakers = {}
+_latencies = {}
+_registry_lock = threading.Lock()
+_executor = None
+
+
+def breaker(name, **kwargs):
+    with _registry_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **kwargs)
+        return _breakers[name]
+
+
+def latency(name):
+    with _registry_lock:
+        return _latencies.setdefault(name, LatencyTracker())
+
+
+def reset():
+    """Forget the breakers and latencies, e.g. between two checks."""
+    with _registry_lock:
+        _breakers.clear()
+        _latencies.clear()
+
+
+def _pool():
+    global _executor
+    with _registry_lock:
+        if _executor is None:
+            # the requests of a hedged pair that lost keep running until their timeout
+            _executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='askme-llm')
+        return _executor
+
+
+class ResilientChatModel(BaseChatModel):
+    """Chat model trying models in order (primary first, then fallbacks), each
+    one behind a circuit breaker, with hedged requests and the question deadline."""
+    models: List[Any]
+    hedge: bool = True
+    # hedging delay until enough latencies were observed, and its lower bound
+    hedge_delay: float = 10.0
+    hedge_min_delay: float = 1.0
+    # don't start a completion with less time left
+    min_seconds: float = 2.0
+    breaker_failures: int = 5
+    breaker_window: float = 60.0
+    breaker_cooldown: float = 30.0
+    sources_only_message: str = SOURCES_ONLY_MESSAGE
+
+    @property
+    def _llm_type(self):
+        return 'resilient-chat'
+
+    def _combine_llm_outputs(self, llm_outputs):
+        """Token usage of the models that answered, the losing requests of the
+        hedged pairs included, for the cost accounting."""
+        outputs = [output for output in llm_outputs if output]
+        if not outputs:
+            return None
+        token_usage = {}
+        for output in outputs:
+            for name, value in (output.get('token_usage') or {}).items():
+                token_usage[name] = token_usage.get(name, 0) + value
+        return {'token_usage': token_usage, 'model_name': outputs[0].get('model_name'),
+                'hedged': any(output.get('hedged') for output in outputs)}
+
+    @staticmethod
+    def _with_hedge(result, losers):
+        """The winning result of a hedged pair, flagged, with the usage of the losing
+        requests added: OpenAI bills them too. A loser still running (or cancelled)
+        is accounted as the winner, same prompt and about the same completion."""
+        output = dict(result.llm_output or {})
+        winner = dict(output.get('token_usage') or {})
+        token_usage = dict(winner)
+        for loser in losers:
+            usage = ((loser.llm_output or {}).get('token_usage') if loser is not None else None) or winner
+            for name, value in usage.items():
+                token_usage[name] = token_usage.get(name, 0) + value
+        output.update(token_usage=token_usage, hedged=True)
+        return ChatResult(generations=result.generations, llm_output=output)
+
+    def _name(self, model):
+        return getattr(model, 'model_name', type(model).__name__)
+
+    def _breaker(self, model):
+        return breaker(self._name(model), failures=self.breaker_failures,
+                       window=self.breaker_window, cooldown=self.breaker_cooldown)
+
+    def _timeout(self, model):
+        timeout = getattr(model, 'request_timeout', None)
+        left = remaining()
+        if left is not None:
+            timeout = left if timeout is None else min(float(timeout), left)
+        return timeout
+
+    def _hedge_after(self, model, timeout):
+        if not self.hedge:
+            return None
+        delay = latency(self._name(model)).percentile(95) or self.hedge_delay
+        delay = max(self.hedge_min_delay, delay)
+        # a hedge that can't finish in time is a waste
+        if timeout is not None and timeout - delay < self.min_seconds:
+            return None
+        return delay
+
+    def _available(self):
+        """The models to try now, in order."""
+        for model in self.models:
+            left = remaining()
+            if left is not None and left < self.min_seconds:
+                metrics.incr('askme_llm_degraded_total', reason='deadline')
+                return
+            if not self._breaker(model).allow():
+                metrics.incr('askme_llm_degraded_total', reason='circuit_open', model=self._name(model))
+                continue
+            yield model
+
+    def _done(self, model, start, error=None):
+        if error is None:
+            self._breaker(model).success()
+            latency(self._name(model)).observe(time.perf_counter() - start)
+            return
+        print(f"WARNING: completion with {self._name(model)} failed: {error!r}")
+        metrics.incr('askme_llm_failures_total', model=self._name(model))
+        self._breaker(model).failure()
+
+    def _sources_only(self):
+        metrics.incr('askme_llm_degraded_total', reason='sources_only')
+        metrics.annotate(degraded='sources_only')
+        # no llm_output: no tokens nor cost accounted
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.sources_only_message))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        for model in self._available():
+            start = time.perf_counter()
+            try:
+                result = self._hedged(model, messages, stop)
+            except Exception as e:
+                self._done(model, start, e)
+                continue
+            self._done(model, start)
+            return result
+        return self._sources_only()
+
+    def _hedged(self, model, messages, stop):
+        timeout = self._timeout(model)
+        call = model.copy(update={'request_timeout': timeout}) if timeout is not None else model
+        end = None if timeout is None else time.perf_counter() + timeout
+        futures = {_pool().submit(call._generate, messages, stop)}
+        submitted = list(futures)
+        delay = self._hedge_after(model, timeout)
+        if delay is not None:
+            done, _ = wait(futures, timeout=delay)
+            if not done:
+                metrics.incr('askme_llm_hedged_total', model=self._name(model))
+                submitted.append(_pool().submit(call._generate, messages, stop))
+                futures.add(submitted[-1])
+        error = None
+        while futures:
+            left = None if end is None else max(0.0, end - time.perf_counter())
+            done, futures = wait(futures, timeout=left, return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError(f"No completion from {self._name(model)} in {timeout:.1f}s")
+            for future in done:
+                if future.exception() is None:
+                    if len(submitted) == 1:
+                        return future.result()
+                    losers = [other.result() if other.done() and other.exception() is None else None
+                              for other in submitted if other is not future]
+                    return self._with_hedge(future.result(), losers)
+                error = future.exception()
+        raise error
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        for model in self._available():
+            start = time.perf_counter()
+            try:
+                result = await self._ahedged(model, messages, stop)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._done(model, start, e)
+                continue
+            self._done(model, start)
+            return result
+        return self._sources_only()
+
+    async def _ahedged(self, model, messages, stop):
+        timeout = self._timeout(model)
+        call = model.copy(update={'request_timeout': timeout}) if timeout is not None else model
+        end = None if timeout is None else time.perf_counter() + timeout
+        tasks = {asyncio.ensure_future(call._agenerate(messages, stop))}
+        submitted = list(tasks)
+        try:
+            delay = self._hedge_after(model, timeout)
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    metrics.incr('askme_llm_hedged_total', model=self._name(model))
+                    submitted.append(asyncio.ensure_future(call._agenerate(messages, stop)))
+                    tasks.add(submitted[-1])
+            error = None
+            while tasks:
+                left = None if end is None else max(0.0, end - time.perf_counter())
+                done, tasks = await asyncio.wait(tasks, timeout=left, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise TimeoutError(f"No completion from {self._name(model)} in {timeout:.1f}s")
+                for task in done:
+                    if task.exception() is None:
+                        if len(submitted) == 1:
+                            return task.result()
+                        losers = [other.result() if other.done() and not other.cancelled()
+                                  and other.exception() is None else None
+                                  for other in submitted if other is not task]
+                        return self._with_hedge(task.result(), losers)
+                    error = task.exception()
+            raise error
+        finally:
+            # unlike threads, the losing request is really cancelled
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,138 @@
+"""Check the deadline, hedging, circuit breaker and fallbacks of the
+completions against the local OpenAI stub of loadtest.py.
+
+Scenarios, every one from fresh breakers and latencies:
+  - baseline: a slow tail (--slow-rate of the completions take --slow-latency)
+    without hedging
+  - hedged: the same tail with hedging, p99 must be lower
+  - fallback: the primary model always fails, the fallback model must answer
+    and the primary circuit must open
+  - sources_only: every model fails, the answers must be sources only
+  - deadline: every completion is slower than the deadline, the answers must
+    be sources only and arrive before the deadline
+
+    python3 resilience_check.py -n 100 --slow-rate 0.1 --slow-latency 5 --deadline 8
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import HumanMessage
+
+import resilience
+from loadtest import OpenAIStub, percentiles
+
+
+PRIMARY = 'gpt-4'
+FALLBACK = 'gpt-3.5-turbo'
+
+
+def build_model(stub, args, hedge=True, fallback=True):
+    models = [ChatOpenAI(model_name=name, openai_api_base=stub.url + '/v1', openai_api_key='sk-stub',
+                         request_timeout=args.request_timeout, max_retries=1)
+              for name in ([PRIMARY, FALLBACK] if fallback else [PRIMARY])]
+    return resilience.ResilientChatModel(models=models, hedge=hedge, hedge_delay=args.hedge_delay,
+                                         hedge_min_delay=args.hedge_min_delay, min_seconds=args.min_seconds,
+                                         breaker_failures=args.breaker_failures, breaker_cooldown=60)
+
+
+def ask(model, i, deadline):
+    start = time.perf_counter()
+    with resilience.deadline_scope(time.time() + deadline):
+        result = model.generate([[HumanMessage(content=f'Question {i}: how do I send an SMS?')]])
+    text = result.generations[0][0].text
+    answered_by = (result.llm_output or {}).get('model_name')
+    return {'seconds': time.perf_counter() - start,
+            'sources_only': text == model.sources_only_message,
+            'model': answered_by}
+
+
+def scenario(name, stub, model, args, deadline=None, **stub_settings):
+    resilience.reset()
+    stub.slow_rate = stub_settings.get('slow_rate', 0.0)
+    stub.slow_latency = stub_settings.get('slow_latency', args.slow_latency)
+    stub.failing_models = set(stub_settings.get('failing_models', ()))
+    before = dict(stub.counters)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        answers = list(pool.map(lambda i: ask(model, i, deadline or args.deadline), range(args.requests)))
+    models = {}
+    for answer in answers:
+        key = 'sources_only' if answer['sources_only'] else answer['model']
+        models[key] = models.get(key, 0) + 1
+    result = {'scenario': name,
+              'latency_s': percentiles([answer['seconds'] for answer in answers]),
+              'answers': models,
+              'completions_sent': stub.counters['chat'] - before['chat'],
+              'circuits': {breaker.name: breaker.state for breaker in resilience._breakers.values()}}
+    print(json.dumps(result))
+    return result
+
+
+def run(args):
+    stub = OpenAIStub(llm_latency=args.llm_latency, llm_jitter=args.llm_jitter, embedding_latency=0).start()
+    # older openai clients only read the base from the environment
+    os.environ['OPENAI_API_BASE'] = stub.url + '/v1'
+    report = {'requests': args.requests, 'deadline': args.deadline, 'results': [], 'errors': []}
+    try:
+        tail = {'slow_rate': args.slow_rate, 'slow_latency': args.slow_latency}
+        baseline = scenario('baseline', stub, build_model(stub, args, hedge=False), args, **tail)
+        hedged = scenario('hedged', stub, build_model(stub, args), args, **tail)
+        fallback = scenario('fallback', stub, build_model(stub, args), args, failing_models=[PRIMARY])
+        sources_only = scenario('sources_only', stub, build_model(stub, args), args,
+                                failing_models=[PRIMARY, FALLBACK])
+        deadline = scenario('deadline', stub, build_model(stub, args), args, deadline=args.min_seconds + 1,
+                            slow_rate=1.0, slow_latency=args.min_seconds + 5)
+    finally:
+        stub.stop()
+    report['results'] = [baseline, hedged, fallback, sources_only, deadline]
+
+    errors = report['errors']
+    if args.slow_rate and hedged['latency_s']['p99'] >= baseline['latency_s']['p99']:
+        errors.append(f"hedging did not lower p99: {hedged['latency_s']['p99']}s >= {baseline['latency_s']['p99']}s")
+    if fallback['answers'].get(FALLBACK) != args.requests:
+        errors.append(f"fallback: {fallback['answers']}, expected {args.requests} answers by {FALLBACK}")
+    if fallback['circuits'].get(PRIMARY) != 'open':
+        errors.append(f"fallback: {PRIMARY} circuit is {fallback['circuits'].get(PRIMARY)}, expected open")
+    if sources_only['answers'].get('sources_only') != args.requests:
+        errors.append(f"sources_only: {sources_only['answers']}")
+    if deadline['answers'].get('sources_only') != args.requests \
+            or deadline['latency_s']['max'] > args.min_seconds + 1 + 0.5:
+        errors.append(f"deadline: {deadline['answers']} in {deadline['latency_s']}")
+    for error in errors:
+        print(f"ERROR: {error}")
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"Report saved into {args.output}")
+    else:
+        print(output)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the completion deadline, hedging, circuit breaker and fallbacks")
+    parser.add_argument("-n", "--requests", type=int, default=100, help="Completions per scenario - default: 100")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Concurrent completions - default: 8")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Mean completion latency in seconds - default: 0.3")
+    parser.add_argument("--llm-jitter", type=float, default=0.05, help="Completion latency std deviation - default: 0.05")
+    parser.add_argument("--slow-rate", type=float, default=0.1, help="Fraction of slow completions - default: 0.1")
+    parser.add_argument("--slow-latency", type=float, default=5.0, help="Latency of the slow completions - default: 5")
+    parser.add_argument("--deadline", type=float, default=10.0, help="Question deadline in seconds - default: 10")
+    parser.add_argument("--request-timeout", type=float, default=30.0, help="Completion request timeout - default: 30")
+    parser.add_argument("--hedge-delay", type=float, default=1.0, help="Hedging delay before the p95 is known - default: 1")
+    parser.add_argument("--hedge-min-delay", type=float, default=0.2, help="Lower bound of the hedging delay - default: 0.2")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="Minimum time left to start a completion - default: 1")
+    parser.add_argument("--breaker-failures", type=int, default=5, help="Failures opening a circuit - default: 5")
+    parser.add_argument("-o", "--output", type=str, default="", help="Write the JSON report into this file")
+    args = parser.parse_args()
+    report = run(args)
+    sys.exit(1 if report['errors'] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
 from typing import Any, Callable, List, Optional
 import re
+import asyncio
 from langchain.schema import Document
 #from langchain.document_loaders.sitemap import SitemapLoader
 from sitemap import SitemapLoader
+import cpu_pool
 
 
 class SitemapChunkLoader(SitemapLoader):
@@ -64,6 +66,14 @@ class SitemapChunkLoader(SitemapLoader):
                 break
         return els
 
+    def skip_urls(self, urls) -> int:
+        """Drop the given pages without fetching them, when resuming."""
+        urls = set(urls)
+        count = len(self._els)
+        self._els = [el for el in self._els if el.get("loc", "").strip() not in urls]
+        print(f"{len(self._els)} documents left in sitemap")
+        return count - len(self._els)
+
     def load_chunks(self, chunk_size: int = 200) -> List[Document]:
         """Load sitemap in chunks."""
         if len(self._els) <= 0:
@@ -73,14 +83,13 @@ class SitemapChunkLoader(SitemapLoader):
         print(f"Loading {chunk_size} documents from sitemap")
         els = self._pop(chunk_size)
         print(f"Found {len(els)} documents to load from sitemap")
-        results = self.scrape_all([el["loc"].strip() for el in els if "loc" in el])
-        docs = [
-            Document(
-                page_content=self.parsing_function(results[i]),
-                metadata=self.meta_function(els[i], results[i]),
-            )
-            for i in range(len(results))
-        ]
+        els = [el for el in els if "loc" in el]
+        # the pages of the chunk, recorded by the ingestion journal
+        self.last_urls = [el["loc"].strip() for el in els]
+        pages = asyncio.run(self.fetch_all([el["loc"].strip() for el in els]))
+        # the soups are built and reduced to text in the CPU pool
+        docs = cpu_pool.parse_pages(list(zip(pages, els)), self.parsing_function, self.meta_function,
+                                    parser=getattr(self, "default_parser", "html.parser"))
         print(f"Loaded {len(docs)} documents from sitemap")
         print(f"{len(self._els)} documents left in sitemap")
         return docs
@@ -0,0 +1,163 @@
+"""Check that re-ingesting into Redis/Qdrant is an idempotent sync.
+
+The fixture corpus is ingested three times with fake embeddings (no OpenAI
+calls): a first full upload, an unchanged re-run that must not embed nor add
+anything, then a run with edited and removed chunks whose stale copies must
+be deleted. Upload times are reported for every batch size / parallelism.
+
+    python3 sync_check.py -e qdrant,redis -n 5000 --batch-size 128,512 --parallelism 1,4
+
+Qdrant runs in local mode (on disk, in-process) and Redis needs a local
+redis-stack server (--redis-url), it is skipped when not reachable.
+"""
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import redis
+from qdrant_client import QdrantClient
+from langchain.docstore.document import Document
+
+import vectordb
+from bench import HashEmbeddings, fixture_corpus, engine_url, redis_available
+
+
+SOURCE = 'fixture'
+
+
+class CountingEmbeddings(HashEmbeddings):
+    def __init__(self, size=256):
+        super().__init__(size)
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return super().embed_documents(texts)
+
+
+def count_chunks(engine, vector_url):
+    if engine == 'qdrant':
+        client = QdrantClient(**vectordb.Loader(vector_url, HashEmbeddings())._qdrant_client_kwargs())
+        return client.count(vectordb.DEFAULT_INDEX_NAME, exact=True).count
+    client = redis.from_url(vector_url)
+    return sum(1 for _ in client.scan_iter(match=f"doc:{vectordb.DEFAULT_INDEX_NAME}:*", count=1000))
+
+
+def drop_index(engine, vector_url):
+    if engine == 'qdrant':
+        client = QdrantClient(**vectordb.Loader(vector_url, HashEmbeddings())._qdrant_client_kwargs())
+        if vectordb.DEFAULT_INDEX_NAME in [c.name for c in client.get_collections().collections]:
+            client.delete_collection(vectordb.DEFAULT_INDEX_NAME)
+    if engine == 'redis':
+        client = redis.from_url(vector_url)
+        try:
+            client.ft(vectordb.DEFAULT_INDEX_NAME).dropindex(delete_documents=True)
+        except redis.ResponseError:
+            pass
+
+
+def sync(engine, vector_url, docs, embeddings, run_id, **kwargs):
+    embeddings.embedded = 0
+    start = time.perf_counter()
+    vectordb.Ingestor.ingest(vector_url, list(docs), embeddings=embeddings, source=SOURCE,
+                             run_id=run_id, **kwargs)
+    upsert_s = time.perf_counter() - start
+    deleted = vectordb.Ingestor.delete_stale(vector_url, SOURCE, embeddings=embeddings, run_id=run_id)
+    return {'upsert_s': round(upsert_s, 3),
+            'docs_per_s': round(len(docs) / upsert_s, 1) if upsert_s else None,
+            'embedded': embeddings.embedded,
+            'deleted': deleted,
+            'chunks': count_chunks(engine, vector_url)}
+
+
+def check_engine(engine, docs, workdir, args):
+    vector_url = engine_url(engine, workdir, args)
+    embeddings = CountingEmbeddings(args.dim)
+    result = {'engine': engine, 'vector_url': vector_url, 'docs': len(docs), 'uploads': [], 'errors': []}
+
+    # upload speed, from an empty index every time
+    for batch_size in args.batch_size:
+        for parallelism in args.parallelism:
+            drop_index(engine, vector_url)
+            upload = sync(engine, vector_url, docs, embeddings, 'upload',
+                          batch_size=batch_size, parallelism=parallelism)
+            upload.update(batch_size=batch_size, parallelism=parallelism)
+            print(upload)
+            result['uploads'].append(upload)
+            if upload['chunks'] != len(docs):
+                result['errors'].append(f"upload: {upload['chunks']} chunks, expected {len(docs)}")
+
+    unchanged = sync(engine, vector_url, docs, embeddings, 'unchanged')
+    result['unchanged'] = unchanged
+    if unchanged['embedded'] or unchanged['deleted'] or unchanged['chunks'] != len(docs):
+        result['errors'].append(f"unchanged re-run is not a no-op: {unchanged}")
+
+    # edit every 10th chunk and remove every 10th one
+    edited = [Document(page_content=doc.page_content + ' edited', metadata=doc.metadata) if i % 10 == 0 else doc
+              for i, doc in enumerate(docs) if i % 10 != 5]
+
+    changes = sync(engine, vector_url, edited, embeddings, 'changes')
+    result['changes'] = changes
+    n_edited = len([i for i in range(len(docs)) if i % 10 == 0])
+    n_removed = len(docs) - len(edited)
+    if changes['embedded'] != n_edited or changes['deleted'] != n_edited + n_removed \
+            or changes['chunks'] != len(edited):
+        result['errors'].append(f"changes: {changes}, expected {n_edited} embedded, "
+                                f"{n_edited + n_removed} deleted, {len(edited)} chunks")
+    drop_index(engine, vector_url)
+    return result
+
+
+def run(args):
+    docs = fixture_corpus(args.docs, args.seed)
+    report = {'docs': len(docs), 'dim': args.dim, 'results': []}
+    for engine in args.engines:
+        if engine == 'redis' and not redis_available(args.redis_url):
+            report['results'].append({'engine': engine, 'skipped': 'redis not reachable'})
+            continue
+        workdir = tempfile.mkdtemp(prefix=f'sync-{engine}-')
+        try:
+            print(f"Checking engine: {engine}")
+            result = check_engine(engine, docs, workdir, args)
+        except Exception as e:
+            print(f"ERROR: engine {engine}: {e}")
+            result = {'engine': engine, 'errors': [str(e)]}
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        report['results'].append(result)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"Report saved into {args.output}")
+    else:
+        print(output)
+    return report
+
+
+def main():
+    int_list = lambda v: [int(x) for x in v.split(',') if x.strip()]
+    parser = argparse.ArgumentParser(description="Check idempotent Redis/Qdrant re-ingestion")
+    parser.add_argument("-e", "--engines", type=lambda v: [e.strip() for e in v.split(',') if e.strip()],
+                        default=['qdrant', 'redis'], help="Engines among qdrant,redis - default: qdrant,redis")
+    parser.add_argument("-n", "--docs", type=int, default=2000, help="Fixture corpus size - default: 2000")
+    parser.add_argument("--dim", type=int, default=256, help="Fake embedding size - default: 256")
+    parser.add_argument("--seed", type=int, default=42, help="Fixture random seed - default: 42")
+    parser.add_argument("--batch-size", type=int_list, default=[vectordb.UPSERT_BATCH_SIZE], help="Upsert batch sizes to time, comma separated")
+    parser.add_argument("--parallelism", type=int_list, default=[1, vectordb.UPSERT_PARALLELISM], help="Upsert parallelisms to time, comma separated")
+    parser.add_argument("--qdrant-url", type=str, default="", help="Qdrant url - default: local mode in a temp directory")
+    parser.add_argument("--redis-url", type=str, default="redis://localhost:6379", help="Redis stack url - default: redis://localhost:6379")
+    parser.add_argument("-o", "--output", type=str, default="", help="Write the JSON report into this file")
+    args = parser.parse_args()
+    for engine in args.engines:
+        if engine not in ('qdrant', 'redis'):
+            parser.error(f"Unknown engine: {engine}")
+    report = run(args)
+    sys.exit(1 if any(result.get('errors') for result in report['results']) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,690 @@
 import os
+import sys
+import json
+import time
+import uuid
 import pickle
-from langchain.vectorstores.faiss import FAISS
-from langchain.vectorstores.redis import Redis
-from langchain.vectorstores.chroma import Chroma
-from qdrant_client import QdrantClient
-from langchain.vectorstores.qdrant import Qdrant
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import math
+import hashlib
+import gzip
+import sqlite3
+import itertools
+import threading
+from contextlib import nullcontext
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from langchain.vectorstores.base import VectorStore
+from langchain.docstore.base import Docstore, AddableMixin
+from langchain.docstore.document import Document
+
+# The engine clients (faiss, redis, qdrant_client, chromadb), OpenAIEmbeddings and
+# the ingestion process pool are imported by the methods using them: a process
+# only pays for the engine it serves. Check with: python3 import_time.py
+
+
+FAISS_INDEX_TYPES = ('flat', 'hnsw', 'ivf')
+FAISS_QUANTIZERS = ('none', 'sq8', 'fp16', 'pq')
+FAISS_VECTORS_SUFFIX = '.vectors.npy'
+FAISS_DOCSTORE_SUFFIX = '.docstore.sqlite'
+FAISS_SHARD_DIGEST_SUFFIX = '.digest'
+# a FAISS sub-index being refreshed, renamed over the served one once its source is complete
+FAISS_STAGING_SUFFIX = '.staging'
+DEFAULT_INDEX_NAME = 'plivoaskme'
+MULTI_MANIFEST = 'indexes.json'
+UPSERT_BATCH_SIZE = 256
+UPSERT_PARALLELISM = 4
+# vector files written by export_index(), read by import_index()
+EXPORT_FORMAT = 'askme-vectors'
+EXPORT_VERSION = 1
+EXPORT_BATCH_SIZE = 1000
+# stamped on every chunk upserted by this process, see Ingestor.delete_stale()
+INGEST_RUN_ID = uuid.uuid4().hex
+
+
+def _import_faiss():
+    import faiss
+    return faiss
+
+
+def is_faiss(db):
+    """Whether db is a LangChain FAISS store, without importing FAISS to check a store of another engine."""
+    module = sys.modules.get('langchain.vectorstores.faiss')
+    return module is not None and isinstance(db, module.FAISS)
+
+
+class FaissRescoringIndex(object):
+    """Wrap a quantized faiss index and re-score its top candidates with exact
+    L2 distances computed from the full precision vectors (memory mapped from disk).
+    """
+    def __init__(self, index, vectors, factor=4):
+        self.index = index
+        self.vectors = vectors
+        self.factor = max(1, int(factor))
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'index':
+            raise AttributeError(name)
+        return getattr(self.index, name)
+
+    def search(self, x, k):
+        candidates = min(self.index.ntotal, k * self.factor)
+        _, ids = self.index.search(x, candidates)
+        distances = np.full((x.shape[0], k), np.inf, dtype='float32')
+        labels = np.full((x.shape[0], k), -1, dtype='int64')
+        for row, (query, row_ids) in enumerate(zip(x, ids)):
+            row_ids = row_ids[row_ids >= 0]
+            if len(row_ids) == 0:
+                continue
+            # sorted ids keep the memory mapped reads sequential
+            row_ids = np.sort(row_ids)
+            diff = np.asarray(self.vectors[row_ids], dtype='float32') - query
+            exact = np.einsum('ij,ij->i', diff, diff)
+            order = np.argsort(exact)[:k]
+            distances[row, :len(order)] = exact[order]
+            labels[row, :len(order)] = row_ids[order]
+        return distances, labels
+
+
+def faiss_unwrap(index):
+    if isinstance(index, FaissRescoringIndex):
+        return index.index
+    return index
+
+
+def faiss_is_flat(index):
+    """True if the index is an exact, unquantized IndexFlat."""
+    faiss = _import_faiss()
+    return isinstance(faiss_unwrap(index), faiss.IndexFlat)
+
+
+def faiss_index_type(index):
+    """Return the index type (flat, hnsw or ivf) of a faiss index."""
+    faiss = _import_faiss()
+    index = faiss_unwrap(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return 'hnsw'
+    if faiss_extract_ivf(index) is not None:
+        return 'ivf'
+    return 'flat'
+
+
+def faiss_extract_ivf(index):
+    faiss = _import_faiss()
+    try:
+        return faiss.extract_index_ivf(faiss_unwrap(index))
+    except RuntimeError:
+        return None
+
+
+def faiss_extract_vectors(index):
+    """Return all the vectors stored in a faiss index as a float32 matrix.
+
+    Quantized indexes only return approximate vectors, unless they are wrapped
+    with the full precision vectors (FaissRescoringIndex).
+    """
+    if isinstance(index, FaissRescoringIndex):
+        return np.array(index.vectors, dtype='float32')
+    faiss_make_direct_map(index)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def faiss_make_direct_map(index):
+    """Build the id -> list map IVF indexes need to reconstruct vectors, once: at
+    load time, before the serving processes fork and share the index pages."""
+    ivf = faiss_extract_ivf(index)
+    if ivf is not None and ivf.direct_map.type == _import_faiss().DirectMap.NoMap:
+        ivf.make_direct_map()
+    return index
+
+
+def _faiss_pq_string(dim, ntotal, **kwargs):
+    m = int(kwargs.get('pq_m') or os.environ.get('FAISS_PQ_M', 0))
+    if m <= 0:
+        # 16x smaller than float32 by default
+        m = dim // 4
+    while dim % m != 0:
+        m -= 1
+    # each sub-quantizer needs 2^nbits training points
+    nbits = max(1, min(8, int(math.log2(max(2, ntotal)))))
+    return f'PQ{m}x{nbits}'
+
+
+def faiss_encoding_string(quantizer, dim, ntotal, **kwargs):
+    if quantizer in (None, 'none'):
+        return 'Flat'
+    if quantizer == 'sq8':
+        return 'SQ8'
+    if quantizer == 'fp16':
+        return 'SQfp16'
+    if quantizer == 'pq':
+        return _faiss_pq_string(dim, ntotal, **kwargs)
+    raise ValueError(f"Unknown FAISS quantizer: {quantizer}")
+
+
+def faiss_index_factory_string(index_type, ntotal, dim=None, quantizer='none', **kwargs):
+    encoding = faiss_encoding_string(quantizer, dim, ntotal, **kwargs)
+    if index_type == 'flat':
+        return encoding
+    if index_type == 'hnsw':
+        m = int(kwargs.get('hnsw_m') or os.environ.get('FAISS_HNSW_M', 32))
+        return f'HNSW{m},{encoding}'
+    if index_type == 'ivf':
+        nlist = int(kwargs.get('ivf_nlist') or os.environ.get('FAISS_IVF_NLIST', 0))
+        if nlist <= 0:
+            nlist = int(4 * math.sqrt(ntotal))
+        # faiss needs ~39 training points per centroid
+        nlist = max(1, min(nlist, ntotal // 39))
+        return f'IVF{nlist},{encoding}'
+    raise ValueError(f"Unknown FAISS index type: {index_type}")
+
+
+def faiss_build_index(vectors, index_type='flat', quantizer='none', **kwargs):
+    """Build a faiss index of the given type (flat, hnsw or ivf) and vector
+    encoding (none, sq8, fp16 or pq) from a float32 matrix.
+    """
+    faiss = _import_faiss()
+    ntotal, dim = vectors.shape
+    if index_type == 'flat' and quantizer in (None, 'none'):
+        # same index class as FAISS.from_documents so merge_from keeps working
+        index = faiss.IndexFlatL2(dim)
+    else:
+        factory = faiss_index_factory_string(index_type, ntotal, dim=dim, quantizer=quantizer, **kwargs)
+        index = faiss.index_factory(dim, factory)
+    if index_type == 'hnsw':
+        ef_construction = kwargs.get('hnsw_ef_construction') or os.environ.get('FAISS_HNSW_EF_CONSTRUCTION', 80)
+        index.hnsw.efConstruction = int(ef_construction)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    faiss_set_search_params(index, **kwargs)
+    return index
+
+
+def _option(kwargs, name, env, default=None):
+    """kwargs[name] when given, 0 included, the environment variable env otherwise."""
+    value = kwargs.get(name)
+    return os.environ.get(env, default) if value is None else value
+
+
+def faiss_set_search_params(index, **kwargs):
+    """Apply query time tuning parameters (efSearch for hnsw, nprobe for ivf)."""
+    faiss = _import_faiss()
+    index = faiss_unwrap(index)
+    index_type = faiss_index_type(index)
+    params = faiss.ParameterSpace()
+    if index_type == 'hnsw':
+        ef_search = _option(kwargs, 'hnsw_ef_search', 'FAISS_HNSW_EF_SEARCH')
+        if ef_search:
+            params.set_index_parameter(index, 'efSearch', int(ef_search))
+    elif index_type == 'ivf':
+        nprobe = _option(kwargs, 'ivf_nprobe', 'FAISS_IVF_NPROBE')
+        if nprobe:
+            params.set_index_parameter(index, 'nprobe', int(nprobe))
+    return index
+
+
+def faiss_reconstruct(index, i):
+    """Return the stored vector of id i, from the full precision copy when available."""
+    if isinstance(index, FaissRescoringIndex):
+        return np.asarray(index.vectors[i], dtype='float32')
+    faiss_make_direct_map(index)
+    return index.reconstruct(i)
+
+
+def faiss_reconstruct_n(index, start, n):
+    """Return the stored vectors of ids start to start + n, from the full precision copy when available."""
+    if isinstance(index, FaissRescoringIndex):
+        return np.asarray(index.vectors[start:start + n], dtype='float32')
+    faiss_make_direct_map(index)
+    return index.reconstruct_n(start, n)
+
+
+def faiss_search_with_vectors(db, embedding, k):
+    """Return [(Document, vector)] of the k nearest chunks of a LangChain FAISS store."""
+    return faiss_search_batch(db, [embedding], k)[0]
+
+
+def faiss_search_batch(db, embeddings, k, with_vectors=True):
+    """Search many embeddings with a single matrix query on a LangChain FAISS store.
+
+    Return one [(Document, vector or None)] list per embedding.
+    """
+    return [[(doc, vector) for doc, vector, _ in hits]
+            for hits in faiss_scored_search_batch(db, embeddings, k, with_vectors)]
+
+
+def faiss_scored_search_batch(db, embeddings, k, with_vectors=True):
+    """Like faiss_search_batch, with the squared L2 distance of every hit:
+    one [(Document, vector or None, distance)] list per embedding."""
+    distances, ids = db.index.search(np.array(embeddings, dtype='float32'), k)
+    results = []
+    for row_distances, row in zip(distances, ids):
+        hits = []
+        for distance, i in zip(row_distances, row):
+            if i == -1:
+                continue
+            doc = db.docstore.search(db.index_to_docstore_id[i])
+            if not isinstance(doc, Document):
+                continue
+            vector = faiss_reconstruct(db.index, int(i)) if with_vectors else None
+            hits.append((doc, vector, float(distance)))
+        results.append(hits)
+    return results
+
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    """Docstore keeping chunk text and metadata in SQLite, fetched by id for
+    the retrieved hits only, with a small LRU cache in front.
+
+    Only the path is pickled, connections are opened lazily per thread and process.
+    """
+    def __init__(self, path, cache_size=256):
+        self.path = path
+        self.cache_size = cache_size
+        self._init_local()
+
+    def _init_local(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        return {'path': self.path, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_local()
+
+    def _conn(self):
+        # never reuse a connection inherited from a forked parent
+        if self._pid != os.getpid():
+            self._init_local()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("CREATE TABLE IF NOT EXISTS docs "
+                         "(id TEXT PRIMARY KEY, page_content TEXT, metadata TEXT)")
+            self._local.conn = conn
+        return conn
+
+    def add(self, texts):
+        rows = [(_id, doc.page_content, json.dumps(doc.metadata)) for _id, doc in texts.items()]
+        conn = self._conn()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO docs VALUES (?, ?, ?)", rows)
+        with self._lock:
+            for _id in texts:
+                self._cache.pop(_id, None)
+
+    def search(self, search):
+        with self._lock:
+            doc = self._cache.get(search)
+            if doc is not None:
+                self._cache.move_to_end(search)
+                return doc
+        row = self._conn().execute("SELECT page_content, metadata FROM docs WHERE id = ?",
+                                   (search,)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        doc = Document(page_content=row[0], metadata=json.loads(row[1]))
+        with self._lock:
+            self._cache[search] = doc
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return doc
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+
+def chunk_id(doc):
+    """Deterministic ID of a chunk: the same content from the same source always
+    gets the same ID, so re-ingesting it overwrites the chunk instead of adding a copy."""
+    digest = hashlib.sha256(doc.page_content.encode('utf-8')).hexdigest()
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{doc.metadata.get('source', '')}#{digest}"))
+
+
+def engine_of(db):
+    """Engine name of a LangChain store, as in the vector URL schemes."""
+    name = type(db).__name__.lower()
+    return name if name in ('redis', 'chroma', 'qdrant') else 'faiss'
+
+
+def relevance_score(engine_name, score):
+    """Map the raw score of an engine to a relevance comparable across engines,
+    higher is better (for unit length embeddings, like OpenAI's)."""
+    if engine_name in ('faiss', 'chroma'):
+        # squared L2 distance
+        return 1.0 - score / 2.0
+    if engine_name == 'redis':
+        # cosine distance
+        return 1.0 - score
+    # qdrant: cosine similarity
+    return score
+
+
+def multi_directory(vector_url):
+    return vector_url.replace("multi://", "", 1)
+
+
+def multi_read_manifest(directory):
+    """Return the {name: {"vector_url": ..., "index_name": ...}} sub-indexes of a multi-index."""
+    path = os.path.join(directory, MULTI_MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def multi_write_manifest(directory, manifest):
+    path = os.path.join(directory, MULTI_MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def multi_sub_url(directory, entry):
+    """Vector URL of a sub-index, local FAISS files are relative to the multi-index directory."""
+    url = entry['vector_url']
+    if '://' in url or url in ('mock', 'dummy') or os.path.isabs(url):
+        return url
+    return os.path.join(directory, url)
+
+
+def multi_default_entry(name):
+    """Sub-index of a new source: a FAISS file in the multi-index directory, or a
+    collection named after the source on MULTI_INDEX_ENGINE_URL (e.g. a Qdrant server)."""
+    safe_name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+    engine_url = os.environ.get("MULTI_INDEX_ENGINE_URL")
+    if engine_url:
+        return {"vector_url": engine_url, "index_name": f"{DEFAULT_INDEX_NAME}_{safe_name}"}
+    return {"vector_url": f"{safe_name}.faiss"}
+
+
+class MultiIndex(VectorStore):
+    """Named sub-indexes (e.g. one per repo and one per docs site) searched in parallel.
+
+    Every sub-index is searched in its own thread (FAISS releases the GIL, the
+    remote engines wait on the network) and the hits are merged by relevance,
+    keeping at most max_per_index of them from one sub-index when set.
+    """
+    def __init__(self, indexes, embeddings, max_workers=None, max_per_index=0):
+        # name -> (engine name, vector store)
+        self.indexes = indexes
+        self.embeddings = embeddings
+        self.max_workers = max_workers or max(1, len(indexes))
+        self.max_per_index = max_per_index
+        self._pool = None
+        self._pool_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = state['_pool_pid'] = None
+        return state
+
+    def _executor(self):
+        # threads don't survive a fork, every worker process starts its own pool
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def _search_index(self, name, queries, vectors, k, with_vectors):
+        engine_name, db = self.indexes[name]
+        if is_faiss(db):
+            results = faiss_scored_search_batch(db, vectors, k, with_vectors)
+        else:
+            results = []
+            for query, vector in zip(queries, vectors):
+                if hasattr(db, 'similarity_search_with_score_by_vector'):
+                    hits = db.similarity_search_with_score_by_vector(vector, k=k)
+                elif query is not None:
+                    hits = db.similarity_search_with_score(query, k=k)
+                else:
+                    hits = []
+                results.append([(doc, None, score) for doc, score in hits])
+        return [[(doc, vector, relevance_score(engine_name, score)) for doc, vector, score in hits]
+                for hits in results]
+
+    def search(self, queries, vectors, k=4, with_vectors=False):
+        """Fan out the queries to every sub-index and merge the hits by relevance.
+
+        Return one [(Document, vector or None, relevance)] list per query, best
+        first. A failing sub-index is logged and left out of the results.
+        """
+        futures = [(name, self._executor().submit(self._search_index, name, queries, vectors, k, with_vectors))
+                   for name in self.indexes]
+        merged = [[] for _ in vectors]
+        for name, future in futures:
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"WARNING: search in sub-index {name} failed: {e}")
+                continue
+            for row, hits in enumerate(results):
+                merged[row].extend((hit, name) for hit in hits)
+        results = []
+        for hits in merged:
+            hits.sort(key=lambda hit: hit[0][2], reverse=True)
+            counts = {}
+            selected = []
+            for hit, name in hits:
+                if self.max_per_index and counts.get(name, 0) >= self.max_per_index:
+                    continue
+                counts[name] = counts.get(name, 0) + 1
+                selected.append(hit)
+                if len(selected) == k:
+                    break
+            results.append(selected)
+        return results
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        vector = self.embeddings.embed_query(query)
+        return [(doc, score) for doc, _, score in self.search([query], [vector], k)[0]]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _, _ in self.search([None], [embedding], k)[0]]
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("Ingest into a sub-index with Ingestor.ingest(vector_url, docs, source=name)")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("Ingest into a sub-index with Ingestor.ingest(vector_url, docs, source=name)")
+
+
+def warm(db, queries=4, k=4):
+    """Fault in the pages of a freshly loaded index with a few random searches,
+    so its first real questions don't pay for it."""
+    if isinstance(db, MultiIndex):
+        for _, sub in db.indexes.values():
+            warm(sub, queries, k)
+    elif is_faiss(db) and db.index.ntotal:
+        vectors = np.random.default_rng(0).standard_normal((queries, db.index.d)).astype('float32')
+        faiss_search_batch(db, vectors, k, with_vectors=False)
+
+
+def index_memory(db):
+    """Approximate bytes a loaded index holds in the process memory: the FAISS
+    codes and the in-memory docstore. The memory mapped vectors, the SQLite
+    docstores and the remote engines (Redis, Qdrant, Chroma) count for nothing."""
+    if isinstance(db, MultiIndex):
+        return sum(index_memory(sub) for _, sub in db.indexes.values())
+    if not is_faiss(db):
+        return 0
+    index = faiss_unwrap(db.index)
+    try:
+        code_size = index.sa_code_size()
+    except Exception:
+        code_size = index.d * 4
+    size = code_size * index.ntotal
+    docs = getattr(db.docstore, '_dict', None)
+    if docs:
+        size += sum(len(doc.page_content) + len(str(doc.metadata)) for doc in docs.values())
+    return size
+
+
+class VectorFileWriter(object):
+    """Compact stream of the chunks of an index with their vectors, written
+    batch by batch: gzip of a JSON header line, then per batch a JSON line (the
+    texts, metadata and sources) followed by the raw float32 vectors, and a
+    JSON trailer line with the chunk count, so a truncated file is detected."""
+    def __init__(self, path, **header):
+        self.path = path
+        self.count = 0
+        self._raw = open(path + '.tmp', 'wb')
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=6)
+        self._write_line(dict(header, format=EXPORT_FORMAT, version=EXPORT_VERSION, created_at=time.time()))
+
+    def _write_line(self, data):
+        self._file.write(json.dumps(data).encode('utf-8') + b'\n')
+
+    def write(self, batch):
+        """Append [(Document, vector, source)], source being the sub-index or the ingested source."""
+        if not batch:
+            return
+        vectors = np.asarray([vector for _, vector, _ in batch], dtype='<f4')
+        self._write_line({'count': len(batch), 'dim': vectors.shape[1],
+                          'texts': [doc.page_content for doc, _, _ in batch],
+                          'metadatas': [doc.metadata for doc, _, _ in batch],
+                          'sources': [source for _, _, source in batch]})
+        self._file.write(vectors.tobytes())
+        self.count += len(batch)
+
+    def close(self, complete=True):
+        if complete:
+            self._write_line({'end': True, 'count': self.count})
+        self._file.close()
+        self._raw.close()
+        if complete:
+            os.replace(self.path + '.tmp', self.path)
+        else:
+            os.remove(self.path + '.tmp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(complete=exc_type is None)
+        return False
+
+
+class VectorFileReader(object):
+    """Read back the [(Document, vector, source)] batches of a VectorFileWriter file."""
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self._raw = open(path, 'rb')
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='rb')
+        self.header = json.loads(self._file.readline() or b'{}')
+        if self.header.get('format') != EXPORT_FORMAT:
+            self.close()
+            raise ValueError(f"{path} is not a vector export")
+        if self.header.get('version', 0) > EXPORT_VERSION:
+            self.close()
+            raise ValueError(f"{path} has format version {self.header['version']}, newer than {EXPORT_VERSION}")
+
+    def __iter__(self):
+        while True:
+            line = self._file.readline()
+            if not line:
+                raise ValueError(f"{self.path} is truncated")
+            frame = json.loads(line)
+            if frame.get('end'):
+                return
+            size = frame['count'] * frame['dim'] * 4
+            data = self._file.read(size)
+            if len(data) != size:
+                raise ValueError(f"{self.path} is truncated")
+            vectors = np.frombuffer(data, dtype='<f4').reshape(frame['count'], frame['dim'])
+            yield [(Document(page_content=text, metadata=metadata or {}), vector, source)
+                   for text, metadata, vector, source in zip(frame['texts'], frame['metadatas'],
+                                                             vectors, frame['sources'])]
+
+    def progress(self):
+        """Fraction of the file read so far."""
+        return self._raw.tell() / float(self.size or 1)
+
+    def close(self):
+        self._file.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _report_progress(batches, action, progress=None):
+    """Pass the batches through, printing the chunks done (written by the
+    consumer once it asks for the next batch) and the rate."""
+    count = 0
+    start = time.perf_counter()
+    for batch in batches:
+        yield batch
+        count += len(batch)
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        done = f", {progress() * 100:.0f}% of the file" if progress is not None else ''
+        print(f"{action} {count} chunks ({count / elapsed:.0f} chunks/s{done})", flush=True)
+    print(f"{action} {count} chunks in {time.perf_counter() - start:.1f}s")
+
+
+def export_index(vector_url, path, index_name=None, batch_size=EXPORT_BATCH_SIZE, **kwargs):
+    """Stream the chunks and vectors of any engine into a vector file, without embedding anything."""
+    loader = Loader(vector_url, kwargs.pop("embeddings", None), index_name)
+    with VectorFileWriter(path, engine=loader.engine_name, vector_url=vector_url) as writer:
+        for batch in _report_progress(loader.export(batch_size, **kwargs), "Exported"):
+            writer.write(batch)
+    print(f"Exported {writer.count} chunks from {vector_url} into {path}")
+    return writer.count
+
+
+def import_index(path, vector_url, index_name=None, **kwargs):
+    """Bulk write the chunks and vectors of a vector file into any engine, without embedding anything."""
+    ingestor = Ingestor(vector_url, [], kwargs.pop("embeddings", None), index_name)
+    with VectorFileReader(path) as reader:
+        print(f"Importing {reader.header.get('engine')} export of {reader.header.get('vector_url')} into {vector_url}")
+        return ingestor.import_batches(_report_progress(reader, "Imported", reader.progress), **kwargs)
+
+
+def copy_index(src_url, dst_url, src_index_name=None, dst_index_name=None, batch_size=EXPORT_BATCH_SIZE, **kwargs):
+    """Stream the chunks and vectors of an index into another engine, without an intermediate file."""
+    embeddings = kwargs.pop("embeddings", None)
+    loader = Loader(src_url, embeddings, src_index_name)
+    ingestor = Ingestor(dst_url, [], loader.embeddings, dst_index_name)
+    print(f"Copying {src_url} into {dst_url}")
+    return ingestor.import_batches(_report_progress(loader.export(batch_size), "Copied"), **kwargs)
+
+
+def _batched(records, size):
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, size))
+        if not batch:
+            return
+        yield batch
 
 
 class BaseEngine(object):
-    def __init__(self, vector_url):
+    def __init__(self, vector_url, embeddings=None, index_name=None):
         self.vector_url = vector_url
-        self.embeddings = OpenAIEmbeddings()
+        if embeddings is None:
+            from langchain.embeddings import OpenAIEmbeddings
+            embeddings = OpenAIEmbeddings()
+        self.embeddings = embeddings
+        # Redis index / Qdrant collection
+        self.index_name = index_name or DEFAULT_INDEX_NAME
         self.engine_name = "faiss"
-        if self.vector_url.startswith("redis://"):
+        if self.vector_url.startswith("multi://"):
+            self.engine_name = "multi"
+        elif self.vector_url.startswith("redis://"):
             self.engine_name = "redis"
         elif self.vector_url.startswith("chroma://"):
             self.engine_name = "chroma"
@@ -37,16 +707,27 @@ class BaseEngine(object):
             raise ValueError(f"Unknown engine: {self.engine_name}")
         return load_func(**kwargs)
 
+    def _qdrant_client_kwargs(self):
+        url = self.vector_url.replace("qdrant://", "") or None
+        if not url:
+            raise ValueError("Qdrant URL is required")
+        # local mode: qdrant://:memory: or qdrant:///path/to/dir
+        if url == ":memory:":
+            return {"location": url}
+        if url.startswith("/") or url.startswith("."):
+            return {"path": url}
+        api_key = os.environ.get("QDRANT_API_KEY", None)
+        return {"url": url, "api_key": api_key, "prefer_grpc": True}
+
 
 
 class Ingestor(BaseEngine):
-    def __init__(self, vector_url, docs):
-        super().__init__(vector_url)
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500,
-            chunk_overlap=10,
-        )
-        self.docs = text_splitter.split_documents(docs)
+    def __init__(self, vector_url, docs, embeddings=None, index_name=None):
+        super().__init__(vector_url, embeddings, index_name)
+        import cpu_pool
+        import metrics
+        with metrics.span('split'):
+            self.docs = cpu_pool.split_documents(docs)
 
     def _ingest_mock(self, **kwargs):
         while len(self.docs) > 0:
@@ -56,80 +737,169 @@ class Ingestor(BaseEngine):
             print(f"Loaded chunks: processed: {len(docs)}, unprocessed: 0")
         return True
 
-    def _ingest_redis(self, **kwargs):
-        db = None
-        while len(self.docs) > 0:
-            print(f"Total chunks left to process: {len(self.docs)}")
-            docs = self._pop()
-            print(f"Processing {len(docs)} chunks...")
-            if db is None:
-                db = Redis.from_documents(docs, self.embeddings, redis_url=self.vector_url, index_name='plivoaskme')
-                print(f"Loaded chunks: processed: {len(docs)}, unprocessed: 0")
-            else:
-                try:
-                    db.add_documents(documents=docs, embedding=self.embeddings)
-                    processed = len(docs)
-                    unprocessed = 0
-                except ValueError as e:
-                    print(f"ERROR: {e}")
-                    processed = 0
-                    unprocessed = 0
-                    for doc in docs:
-                        try:
-                            db.add_documents(documents=[doc], embedding=self.embeddings)
-                            processed += 1
-                        except ValueError as e:
-                            unprocessed += 1
-                            print(f"ERROR: {e}")
-                            print(f"SKIPPING: {doc}")
-                print(f"Loaded chunks: processed: {processed}, unprocessed: {unprocessed}")
-        db = None
+    def _embed_chunks(self, chunks):
+        """Return [(id, doc, vector)] of the [(id, doc)] chunks, skipping the
+        ones the embeddings reject."""
+        try:
+            vectors = self.embeddings.embed_documents([doc.page_content for _, doc in chunks])
+            return [(_id, doc, vector) for (_id, doc), vector in zip(chunks, vectors)]
+        except ValueError as e:
+            print(f"ERROR: {e}")
+        embedded = []
+        for _id, doc in chunks:
+            try:
+                embedded.append((_id, doc, self.embeddings.embed_documents([doc.page_content])[0]))
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                print(f"SKIPPING: {doc}")
+        return embedded
+
+    def _parallel_upsert(self, upsert, **kwargs):
+        """Upsert the chunks by chunk_id() in batches of batch_size, parallelism
+        batches in flight. upsert(batch) returns the batch counts."""
+        batch_size = int(kwargs.get("batch_size") or os.environ.get("UPSERT_BATCH_SIZE", UPSERT_BATCH_SIZE))
+        parallelism = int(kwargs.get("parallelism") or os.environ.get("UPSERT_PARALLELISM", UPSERT_PARALLELISM))
+        chunks = list(OrderedDict((chunk_id(doc), doc) for doc in self.docs).items())
+        self.docs = []
+        batches = [chunks[i:i+batch_size] for i in range(0, len(chunks), batch_size)]
+        print(f"Upserting {len(chunks)} chunks in {len(batches)} batches of {batch_size}, {parallelism} in parallel")
+        totals = {'embedded': 0, 'unchanged': 0, 'skipped': 0}
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+            for counts in pool.map(upsert, batches):
+                for name, value in counts.items():
+                    totals[name] += value
+                print(f"Upserted chunks: {totals}")
+        print(f"Upserted {len(chunks)} chunks in {time.perf_counter() - start:.1f}s: {totals}")
         return True
 
+    def _ingest_redis(self, **kwargs):
+        from langchain.vectorstores.redis import Redis
+        db = Redis(redis_url=self.vector_url, index_name=self.index_name,
+                   embedding_function=self.embeddings.embed_query)
+        # same keys as langchain's Redis.add_texts, with deterministic IDs
+        prefix = f"doc:{self.index_name}"
+        stamp = {'ingest_source': kwargs.get("source") or '', 'ingest_run': kwargs.get("run_id") or INGEST_RUN_ID}
+        index_lock = threading.Lock()
+        state = {'index': False}
+
+        def upsert(batch):
+            pipe = db.client.pipeline(transaction=False)
+            for _id, _ in batch:
+                pipe.exists(f"{prefix}:{_id}")
+            exists = pipe.execute()
+            unchanged = [_id for (_id, _), found in zip(batch, exists) if found]
+            embedded = self._embed_chunks([chunk for chunk, found in zip(batch, exists) if not found])
+            if embedded and not state['index']:
+                with index_lock:
+                    if not state['index']:
+                        db._create_index(dim=len(embedded[0][2]))
+                        state['index'] = True
+            pipe = db.client.pipeline(transaction=False)
+            for _id in unchanged:
+                pipe.hset(f"{prefix}:{_id}", mapping=stamp)
+            for _id, doc, vector in embedded:
+                pipe.hset(f"{prefix}:{_id}", mapping=dict(stamp, **{
+                    db.content_key: doc.page_content,
+                    db.vector_key: np.array(vector, dtype=np.float32).tobytes(),
+                    db.metadata_key: json.dumps(doc.metadata)}))
+            pipe.execute()
+            return {'embedded': len(embedded), 'unchanged': len(unchanged),
+                    'skipped': len(batch) - len(unchanged) - len(embedded)}
+
+        return self._parallel_upsert(upsert, **kwargs)
+
+    def _delete_stale_redis(self, source, run_id):
+        import redis
+        client = redis.from_url(self.vector_url)
+        stale = 0
+        keys = []
+
+        def delete(keys):
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                pipe.hmget(key, 'ingest_source', 'ingest_run')
+            old = [key for key, (_source, _run) in zip(keys, pipe.execute())
+                   if _source is not None and _source.decode() == source
+                   and (_run is None or _run.decode() != run_id)]
+            if old:
+                client.delete(*old)
+            return len(old)
+
+        for key in client.scan_iter(match=f"doc:{self.index_name}:*", count=1000):
+            keys.append(key)
+            if len(keys) == 1000:
+                stale += delete(keys)
+                keys = []
+        if keys:
+            stale += delete(keys)
+        return stale
+
+    def _qdrant_client(self):
+        from qdrant_client import QdrantClient
+        client_kwargs = self._qdrant_client_kwargs()
+        client = QdrantClient(**client_kwargs)
+        # the local mode (in-process stand-in) is not thread safe
+        lock = threading.Lock() if "url" not in client_kwargs else nullcontext()
+        return client, lock
+
+    def _qdrant_collection_exists(self, client):
+        return self.index_name in [c.name for c in client.get_collections().collections]
+
     def _ingest_qdrant(self, **kwargs):
-        url = self.vector_url.replace("qdrant://", "") or None
-        api_key = os.environ.get("QDRANT_API_KEY", None)
-        if not url:
-            raise ValueError("Qdrant URL is required")
-        db = None
-        while len(self.docs) > 0:
-            print(f"Total chunks left to process: {len(self.docs)}")
-            docs = self._pop()
-            print(f"Processing {len(docs)} chunks...")
-            if db is None:
-                db = Qdrant.from_documents(
-                    docs, self.embeddings,
-                    url=url, api_key=api_key,
-                    prefer_grpc=True,
-                    collection_name="plivoaskme",
-                )
-                print(f"Loaded chunks: processed: {len(docs)}, unprocessed: 0")
-            else:
-                try:
-                    db.add_documents(documents=docs, embedding=self.embeddings)
-                    processed = len(docs)
-                    unprocessed = 0
-                except ValueError as e:
-                    print(f"ERROR: {e}")
-                    processed = 0
-                    unprocessed = 0
-                    for doc in docs:
-                        try:
-                            db.add_documents(documents=[doc], embedding=self.embeddings)
-                            processed += 1
-                        except ValueError as e:
-                            unprocessed += 1
-                            print(f"ERROR: {e}")
-                            print(f"SKIPPING: {doc}")
-                print(f"Loaded chunks: processed: {processed}, unprocessed: {unprocessed}")
+        from qdrant_client.http import models as qdrant_models
+        from langchain.vectorstores.qdrant import Qdrant
+        client, lock = self._qdrant_client()
+        stamp = {'ingest_source': kwargs.get("source") or '', 'ingest_run': kwargs.get("run_id") or INGEST_RUN_ID}
+        state = {'collection': self._qdrant_collection_exists(client)}
+        collection_lock = threading.Lock()
 
-        db = None
-        return True
+        def upsert(batch):
+            unchanged = []
+            if state['collection']:
+                with lock:
+                    points = client.retrieve(self.index_name, [_id for _id, _ in batch],
+                                             with_payload=False, with_vectors=False)
+                    unchanged = [str(point.id) for point in points]
+                    if unchanged:
+                        client.set_payload(self.index_name, payload=stamp, points=unchanged)
+            embedded = self._embed_chunks([(_id, doc) for _id, doc in batch if _id not in set(unchanged)])
+            if embedded and not state['collection']:
+                with collection_lock, lock:
+                    if not state['collection']:
+                        # same layout as langchain's Qdrant.from_documents
+                        client.create_collection(self.index_name, vectors_config=qdrant_models.VectorParams(
+                            size=len(embedded[0][2]), distance=qdrant_models.Distance.COSINE))
+                        state['collection'] = True
+            if embedded:
+                points = [qdrant_models.PointStruct(id=_id, vector=vector, payload=dict(stamp, **{
+                              Qdrant.CONTENT_KEY: doc.page_content, Qdrant.METADATA_KEY: doc.metadata}))
+                          for _id, doc, vector in embedded]
+                with lock:
+                    client.upsert(self.index_name, points=points)
+            return {'embedded': len(embedded), 'unchanged': len(unchanged),
+                    'skipped': len(batch) - len(unchanged) - len(embedded)}
+
+        return self._parallel_upsert(upsert, **kwargs)
+
+    def _delete_stale_qdrant(self, source, run_id):
+        from qdrant_client.http import models as qdrant_models
+        client, _ = self._qdrant_client()
+        if not self._qdrant_collection_exists(client):
+            return 0
+        stale = qdrant_models.Filter(
+            must=[qdrant_models.FieldCondition(key='ingest_source', match=qdrant_models.MatchValue(value=source))],
+            must_not=[qdrant_models.FieldCondition(key='ingest_run', match=qdrant_models.MatchValue(value=run_id))])
+        count = client.count(self.index_name, count_filter=stale, exact=True).count
+        if count:
+            client.delete(self.index_name, points_selector=qdrant_models.FilterSelector(filter=stale))
+        return count
 
     def _ingest_chroma(self, **kwargs):
         directory = self.vector_url.replace("chroma://", "") or None
         if not directory:
             raise ValueError("Chroma directory is required")
+        from langchain.vectorstores.chroma import Chroma
         try:
             os.makedirs(directory)
         except:
@@ -140,7 +910,7 @@ class Ingestor(BaseEngine):
             docs = self._pop()
             print(f"Processing {len(docs)} chunks...")
             if db is None:
-                db = Chroma.from_documents(chunks=docs, embedding=self.embeddings, 
+                db = Chroma.from_documents(documents=docs, embedding=self.embeddings,
                                    persist_directory=directory)
                 print(f"Loaded chunks: processed: {len(docs)}, unprocessed: 0")
             else:
@@ -167,10 +937,41 @@ class Ingestor(BaseEngine):
         db = None
         return True
 
+    def _ingest_multi(self, **kwargs):
+        source = kwargs.pop("source", None)
+        if not source:
+            raise ValueError("A source (sub-index name) is required to ingest into a multi-index")
+        directory = multi_directory(self.vector_url)
+        os.makedirs(directory, exist_ok=True)
+        entry = multi_read_manifest(directory).get(source) or multi_default_entry(source)
+        sub = Ingestor(multi_sub_url(directory, entry), [], self.embeddings, entry.get("index_name"))
+        staged = sub.engine_name == "faiss"
+        if staged:
+            # the served sub-index is only replaced once the source is complete, see delete_stale()
+            sub = Ingestor(sub.vector_url + FAISS_STAGING_SUFFIX, [], self.embeddings)
+        # already split
+        sub.docs = self.docs
+        print(f"Ingesting source {source} into {sub.vector_url}")
+        if not sub.run(source=source, **kwargs):
+            return False
+        if not staged:
+            self._update_manifest(directory, source, entry)
+        return True
+
+    @staticmethod
+    def _update_manifest(directory, source, entry):
+        # re-read: other sources may have been ingested meanwhile
+        manifest = multi_read_manifest(directory)
+        manifest[source] = dict(entry, updated_at=time.time())
+        multi_write_manifest(directory, manifest)
+
     def _retry_ingest_faiss(self, docs):
         print(f"DEBUG: _retry_ingest_faiss start processing {len(docs)}")
+        from langchain.vectorstores.faiss import FAISS
+        from langchain.embeddings import OpenAIEmbeddings
         # re-init embeddings
-        self.embeddings = OpenAIEmbeddings()
+        if isinstance(self.embeddings, OpenAIEmbeddings):
+            self.embeddings = OpenAIEmbeddings()
         db = None
         _db = None
         prev_doc = None
@@ -204,65 +1005,217 @@ class Ingestor(BaseEngine):
         print(f"DEBUG: _retry_ingest_faiss done: processed:{processed}, unprocessed:{unnprocessed}")
         return db
 
+    def _full_precision_vectors(self, index):
+        """The vectors of the index, from the full precision copy when the index is
+        quantized, even if it was loaded without re-scoring (FAISS_RESCORE_FACTOR=0)."""
+        vectors_url = self.vector_url + FAISS_VECTORS_SUFFIX
+        if not isinstance(index, FaissRescoringIndex) and not faiss_is_flat(index) \
+                and os.path.exists(vectors_url):
+            vectors = np.load(vectors_url, mmap_mode='r')
+            if vectors.shape[0] == index.ntotal:
+                return np.array(vectors, dtype='float32')
+            print(f"WARNING: ignoring {vectors_url}: {vectors.shape[0]} vectors, index has {index.ntotal}")
+        return faiss_extract_vectors(index)
+
+    def _build_faiss_index(self, db, index_type, quantizer='none', keep_vectors=False, **kwargs):
+        """Rebuild db.index. keep_vectors: an intermediate flat rebuild (e.g. to merge
+        into), the full precision copy is still the reference of the final build."""
+        if index_type not in FAISS_INDEX_TYPES:
+            raise ValueError(f"Unknown FAISS index type: {index_type}")
+        if quantizer not in FAISS_QUANTIZERS:
+            raise ValueError(f"Unknown FAISS quantizer: {quantizer}")
+        print(f"Building FAISS {index_type}/{quantizer} index with {db.index.ntotal} vectors")
+        vectors = self._full_precision_vectors(db.index)
+        db.index = faiss_build_index(vectors, index_type, quantizer, **kwargs)
+        vectors_url = self.vector_url + FAISS_VECTORS_SUFFIX
+        if quantizer != 'none':
+            # full precision copy used to re-score the quantized candidates
+            print(f"Saving full precision vectors into {vectors_url}")
+            # the served file is memory mapped: write a new one and rename it over
+            with open(vectors_url + '.tmp', 'wb') as f:
+                np.save(f, vectors)
+            os.replace(vectors_url + '.tmp', vectors_url)
+        elif os.path.exists(vectors_url) and not keep_vectors:
+            os.remove(vectors_url)
+        print(f"Built FAISS {index_type}/{quantizer} index with {db.index.ntotal} vectors")
+        return db
+
+    def _save_faiss_docstore(self, db, docstore):
+        if docstore != 'sqlite' or isinstance(db.docstore, SQLiteDocstore):
+            return db
+        path = self.vector_url + FAISS_DOCSTORE_SUFFIX
+        # written aside, never truncated under the readers of the previous one
+        self._remove_paths([path + '.tmp'])
+        print(f"Saving {len(db.index_to_docstore_id)} chunks into docstore {path}")
+        store = SQLiteDocstore(path + '.tmp')
+        ids = list(db.index_to_docstore_id.values())
+        for i in range(0, len(ids), 1000):
+            store.add({_id: db.docstore.search(_id) for _id in ids[i:i+1000]})
+        store._conn().close()
+        os.replace(path + '.tmp', path)
+        db.docstore = SQLiteDocstore(path)
+        print(f"Saved chunks into docstore {path}")
+        return db
+
+    def _save_faiss(self, db, vector_url):
+        # never leave a half written index behind
+        with open(vector_url + ".tmp", "wb") as f:
+            pickle.dump(db, f)
+        os.replace(vector_url + ".tmp", vector_url)
+
+    def _faiss_shard(self, idx, docs):
+        """Return the FAISS store of a batch of chunks, saved as the .idx shard.
+
+        The shard is reused when a previous (interrupted) run already embedded
+        the very same chunks, which its digest file tells.
+        """
+        vector_url = self.vector_url + f".{idx}"
+        digest = hashlib.sha256('\n'.join(chunk_id(doc) for doc in docs).encode()).hexdigest()
+        digest_url = vector_url + FAISS_SHARD_DIGEST_SUFFIX
+        if os.path.exists(vector_url) and os.path.exists(digest_url):
+            with open(digest_url) as f:
+                if f.read().strip() == digest:
+                    print(f"Reusing {len(docs)} chunks already embedded in FAISS {vector_url}")
+                    return
+        from langchain.vectorstores.faiss import FAISS
+        import metrics
+        try:
+            with metrics.span('embedding'):
+                db = FAISS.from_documents(docs, self.embeddings)
+        except ValueError as e:
+            print(f"ERROR FAISS.from_documents: {e}")
+            with metrics.span('embedding'):
+                db = self._retry_ingest_faiss(docs)
+        print(f"Saving {len(docs)} chunks into FAISS {vector_url}")
+        with metrics.span('save_index'):
+            self._save_faiss(db, vector_url)
+        with open(digest_url, "w") as f:
+            f.write(digest)
+        print(f"Saved {len(docs)} chunks into FAISS {vector_url}")
+
+    def _new_chunks(self, docs):
+        """The chunks of docs that are not in the FAISS index yet, by chunk ID."""
+        db = Loader.load(self.vector_url, embeddings=self.embeddings)
+        stored = set()
+        for _id in db.index_to_docstore_id.values():
+            doc = db.docstore.search(_id)
+            if isinstance(doc, Document):
+                stored.add(chunk_id(doc))
+        new = [doc for doc in docs if chunk_id(doc) not in stored]
+        if len(new) < len(docs):
+            print(f"Skipping {len(docs) - len(new)} chunks already in {self.vector_url}")
+        return new
+
+    def _remove_faiss_shards(self, count):
+        # including the leftovers of an interrupted run with more shards
+        i = 1
+        while i <= count or os.path.exists(self.vector_url + f".{i}"):
+            for path in (self.vector_url + f".{i}", self.vector_url + f".{i}" + FAISS_SHARD_DIGEST_SUFFIX):
+                if os.path.exists(path):
+                    os.remove(path)
+            i += 1
+
     def _ingest_faiss(self, **kwargs):
         overwrite = kwargs.get("overwrite", True)
         ingest_size = kwargs.get("ingest_size", 500)
+        checkpoint = kwargs.get("checkpoint") or (lambda stage: None)
+        index_type = kwargs.pop("index_type", None) or os.environ.get("FAISS_INDEX_TYPE", "flat")
+        quantizer = kwargs.pop("quantizer", None) or os.environ.get("FAISS_QUANTIZER", "none")
+        docstore = kwargs.pop("docstore", None) or os.environ.get("FAISS_DOCSTORE", "sqlite")
+        # False for the batches of an ingestion run: the index stays flat (cheap to merge
+        # into) and build_index() builds the ANN/quantized index once, at the end
+        build = kwargs.pop("build_index", True) and (index_type != 'flat' or quantizer != 'none')
+        if kwargs.pop("dedupe", False) and overwrite is not True and os.path.exists(self.vector_url):
+            # a batch saved by an interrupted run and ingested again
+            self.docs = self._new_chunks(self.docs)
         idx = 1
         print(f"Total chunks to process: {len(self.docs)}")
         while len(self.docs) > 0:
             print(f"Total chunks left to process: {len(self.docs)}")
             docs = self._pop(size=ingest_size)
             print(f"Processing {len(docs)} chunks...")
-            try:
-                db = FAISS.from_documents(docs, self.embeddings)
-            except ValueError as e:
-                print(f"ERROR FAISS.from_documents: {e}")
-                db = self._retry_ingest_faiss(docs)
-            vector_url = self.vector_url + f".{idx}"
-            print(f"Saving {len(docs)} chunks into FAISS {vector_url}")
-            with open(vector_url, "wb") as f:
-                pickle.dump(db, f)
+            self._faiss_shard(idx, docs)
             idx += 1
-            print(f"Saved {len(docs)} chunks into FAISS {vector_url}")
             print(f"Processed {len(docs)} chunks...")
+        checkpoint('embedded')
         
         orig_vector_url = self.vector_url + '.1'
         if not os.path.exists(orig_vector_url):
             print(f"No FAISS file {orig_vector_url} created, stopping...")
             return False
 
-        db = Loader.load(orig_vector_url)
-        for i in range(2, idx):
-            vector_url = self.vector_url + f".{i}"
-            if not os.path.exists(vector_url):
-                print(f"No FAISS file {vector_url} created, skipping...")
-                continue
-            print(f"Merging {vector_url} into {orig_vector_url}")
-            db.merge_from(Loader.load(vector_url))
-            os.remove(vector_url)
-            print(f"Merged {vector_url} into {orig_vector_url}")
-
-        try: os.remove(orig_vector_url)
-        except: pass
+        import metrics
+        with metrics.span('merge'):
+            db = Loader.load(orig_vector_url, embeddings=self.embeddings)
+            for i in range(2, idx):
+                vector_url = self.vector_url + f".{i}"
+                if not os.path.exists(vector_url):
+                    print(f"No FAISS file {vector_url} created, skipping...")
+                    continue
+                print(f"Merging {vector_url} into {orig_vector_url}")
+                db.merge_from(Loader.load(vector_url, embeddings=self.embeddings))
+                print(f"Merged {vector_url} into {orig_vector_url}")
 
         if overwrite is True or not os.path.exists(self.vector_url):
             print(f"New FAISS file created {self.vector_url}, saving...")
-            with open(self.vector_url, "wb") as f:
-                pickle.dump(db, f)
+            if build:
+                db = self._build_faiss_index(db, index_type, quantizer, **kwargs)
+            elif os.path.exists(self.vector_url + FAISS_VECTORS_SUFFIX):
+                os.remove(self.vector_url + FAISS_VECTORS_SUFFIX)
+            db = self._save_faiss_docstore(db, docstore)
+            self._save_faiss(db, self.vector_url)
             print(f"Saved data into {self.vector_url}")
-            return True
         else:
             print(f"Found existing FAISS file {self.vector_url}, merging...")
-            src_db = Loader.load(self.vector_url)
+            src_db = Loader.load(self.vector_url, embeddings=self.embeddings)
+            # ANN and quantized indexes can't be merged in place, rebuild from the flat vectors
+            if not faiss_is_flat(src_db.index):
+                src_db = self._build_faiss_index(src_db, 'flat', keep_vectors=True)
             src_db.merge_from(db)
-            with open(self.vector_url, "wb") as f:
-                pickle.dump(src_db, f)
+            if build:
+                src_db = self._build_faiss_index(src_db, index_type, quantizer, **kwargs)
+            src_db = self._save_faiss_docstore(src_db, docstore)
+            self._save_faiss(src_db, self.vector_url)
             print(f"Merged data into {self.vector_url}")
-            return True
+        # the shards are only removed once their chunks are safely in the index
+        self._remove_faiss_shards(idx - 1)
+        return True
     
     def run(self, **kwargs):
         return self._ingest(**kwargs)
 
+    @classmethod
+    def build_index(cls, vector_url, **kwargs):
+        """Build FAISS_INDEX_TYPE/FAISS_QUANTIZER from the flat FAISS index (or the
+        flat FAISS sub-indexes of a multi-index) left by batches ingested with
+        build_index=False. The other engines index as they ingest."""
+        embeddings = kwargs.pop("embeddings", None)
+        return cls(vector_url, [], embeddings).build_faiss_indexes(**kwargs)
+
+    def build_faiss_indexes(self, **kwargs):
+        if self.engine_name == "multi":
+            directory = multi_directory(self.vector_url)
+            built = 0
+            for entry in multi_read_manifest(directory).values():
+                sub = Ingestor(multi_sub_url(directory, entry), [], self.embeddings, entry.get("index_name"))
+                built += sub.build_faiss_indexes(**kwargs)
+            return built
+        index_type = kwargs.pop("index_type", None) or os.environ.get("FAISS_INDEX_TYPE", "flat")
+        quantizer = kwargs.pop("quantizer", None) or os.environ.get("FAISS_QUANTIZER", "none")
+        if self.engine_name != "faiss" or (index_type == 'flat' and quantizer == 'none') \
+                or not os.path.exists(self.vector_url):
+            return 0
+        db = Loader.load(self.vector_url, embeddings=self.embeddings)
+        # the sub-indexes not refreshed by the run are already built
+        if not faiss_is_flat(db.index):
+            return 0
+        import metrics
+        with metrics.span('build_index'):
+            db = self._build_faiss_index(db, index_type, quantizer, **kwargs)
+            self._save_faiss(db, self.vector_url)
+        print(f"Saved data into {self.vector_url}")
+        return 1
+
     def _pop(self, size=500):
         docs = []
         i = 0
@@ -277,31 +1230,262 @@ class Ingestor(BaseEngine):
 
     @classmethod
     def ingest(cls, vector_url, docs, **kwargs):
-        return cls(vector_url, docs).run(**kwargs)
+        embeddings = kwargs.pop("embeddings", None)
+        index_name = kwargs.pop("index_name", None)
+        return cls(vector_url, docs, embeddings, index_name).run(**kwargs)
+
+    def _delete_stale_multi(self, source, run_id):
+        directory = multi_directory(self.vector_url)
+        entry = multi_read_manifest(directory).get(source)
+        sub = Ingestor(multi_sub_url(directory, entry or multi_default_entry(source)), [], self.embeddings,
+                       (entry or {}).get("index_name"))
+        if sub.engine_name == "faiss":
+            # the staged sub-index is complete: build it and serve it
+            if sub.publish_staged():
+                self._update_manifest(directory, source, entry or multi_default_entry(source))
+            return 0
+        if entry is None:
+            return 0
+        return sub.delete_stale_chunks(source, run_id)
+
+    def publish_staged(self, **kwargs):
+        """Replace the FAISS index, its docstore and vectors with the staged ones,
+        renames only, the index file last. False when nothing is staged (e.g. a
+        resumed run that already published it)."""
+        staged = Ingestor(self.vector_url + FAISS_STAGING_SUFFIX, [], self.embeddings)
+        if not os.path.exists(staged.vector_url):
+            return False
+        staged.build_faiss_indexes(**kwargs)
+        for suffix in (FAISS_VECTORS_SUFFIX, FAISS_DOCSTORE_SUFFIX, ''):
+            if os.path.exists(staged.vector_url + suffix):
+                os.replace(staged.vector_url + suffix, self.vector_url + suffix)
+            elif os.path.exists(self.vector_url + suffix):
+                os.remove(self.vector_url + suffix)
+        print(f"Published {staged.vector_url} into {self.vector_url}")
+        return True
+
+    def delete_stale_chunks(self, source, run_id=None):
+        """Delete the chunks of source that were not upserted by the run."""
+        delete_func = getattr(self, f"_delete_stale_{self.engine_name}", None)
+        if delete_func is None:
+            # FAISS and Chroma indexes are rebuilt or replaced as a whole
+            return 0
+        deleted = delete_func(source, run_id or INGEST_RUN_ID)
+        print(f"Deleted {deleted} stale chunks of {source} from {self.vector_url}")
+        return deleted
+
+    @classmethod
+    def delete_stale(cls, vector_url, source, **kwargs):
+        """Finish the sync of a source: once all its documents are ingested, delete
+        the chunks left from previous runs (changed or removed content), or serve
+        the FAISS sub-index of a multi-index staged by the run."""
+        embeddings = kwargs.pop("embeddings", None)
+        index_name = kwargs.pop("index_name", None)
+        return cls(vector_url, [], embeddings, index_name).delete_stale_chunks(source, kwargs.get("run_id"))
         
 
 
+    def import_batches(self, batches, **kwargs):
+        """Bulk write [(Document, vector, source)] batches (e.g. from Loader.export())
+        with their vectors: nothing is embedded again."""
+        import_func = getattr(self, f"_import_{self.engine_name}", None)
+        if not import_func:
+            raise ValueError(f"Importing into {self.engine_name} is not supported")
+        return import_func(batches, **kwargs)
+
+    def _import_mock(self, batches, **kwargs):
+        for _ in batches:
+            pass
+        return True
+
+    def _import_redis(self, batches, **kwargs):
+        from langchain.vectorstores.redis import Redis
+        db = Redis(redis_url=self.vector_url, index_name=self.index_name,
+                   embedding_function=self.embeddings.embed_query)
+        # same keys as _ingest_redis
+        prefix = f"doc:{self.index_name}"
+        created = False
+        for batch in batches:
+            if not batch:
+                continue
+            if not created:
+                db._create_index(dim=len(batch[0][1]))
+                created = True
+            pipe = db.client.pipeline(transaction=False)
+            for doc, vector, source in batch:
+                pipe.hset(f"{prefix}:{chunk_id(doc)}", mapping={
+                    'ingest_source': source or '', 'ingest_run': INGEST_RUN_ID,
+                    db.content_key: doc.page_content,
+                    db.vector_key: np.asarray(vector, dtype=np.float32).tobytes(),
+                    db.metadata_key: json.dumps(doc.metadata)})
+            pipe.execute()
+        return True
+
+    def _import_qdrant(self, batches, **kwargs):
+        from qdrant_client.http import models as qdrant_models
+        from langchain.vectorstores.qdrant import Qdrant
+        client, _ = self._qdrant_client()
+        exists = self._qdrant_collection_exists(client)
+        for batch in batches:
+            if not batch:
+                continue
+            if not exists:
+                # same layout as _ingest_qdrant
+                client.create_collection(self.index_name, vectors_config=qdrant_models.VectorParams(
+                    size=len(batch[0][1]), distance=qdrant_models.Distance.COSINE))
+                exists = True
+            client.upsert(self.index_name, points=[
+                qdrant_models.PointStruct(id=chunk_id(doc), vector=[float(x) for x in vector], payload={
+                    'ingest_source': source or '', 'ingest_run': INGEST_RUN_ID,
+                    Qdrant.CONTENT_KEY: doc.page_content, Qdrant.METADATA_KEY: doc.metadata})
+                for doc, vector, source in batch])
+        return True
+
+    def _import_chroma(self, batches, **kwargs):
+        directory = self.vector_url.replace("chroma://", "") or None
+        if not directory:
+            raise ValueError("Chroma directory is required")
+        from langchain.vectorstores.chroma import Chroma
+        os.makedirs(directory, exist_ok=True)
+        db = Chroma(persist_directory=directory, embedding_function=self.embeddings)
+        for batch in batches:
+            if not batch:
+                continue
+            db._collection.upsert(ids=[chunk_id(doc) for doc, _, _ in batch],
+                                  embeddings=[[float(x) for x in vector] for _, vector, _ in batch],
+                                  documents=[doc.page_content for doc, _, _ in batch],
+                                  metadatas=[doc.metadata for doc, _, _ in batch])
+        db.persist()
+        return True
+
+    def _import_faiss(self, batches, **kwargs):
+        """Build a new FAISS file: a flat index grown batch by batch, the chunks
+        written to the SQLite docstore as they come, then the index type and
+        encoding of FAISS_INDEX_TYPE/FAISS_QUANTIZER built from the flat vectors.
+
+        Everything is written next to the FAISS file first (.import) and only
+        replaces the previous index, docstore and vectors once the whole stream
+        has been read (a truncated vector file fails at its end)."""
+        from langchain.vectorstores.faiss import FAISS
+        from langchain.docstore.in_memory import InMemoryDocstore
+        faiss = _import_faiss()
+        index_type = kwargs.pop("index_type", None) or os.environ.get("FAISS_INDEX_TYPE", "flat")
+        quantizer = kwargs.pop("quantizer", None) or os.environ.get("FAISS_QUANTIZER", "none")
+        docstore = kwargs.pop("docstore", None) or os.environ.get("FAISS_DOCSTORE", "sqlite")
+        suffixes = ('', FAISS_DOCSTORE_SUFFIX, FAISS_VECTORS_SUFFIX)
+        tmp = Ingestor(self.vector_url + '.import', [], self.embeddings)
+        # leftovers of an interrupted import
+        self._remove_paths(tmp.vector_url + suffix for suffix in suffixes)
+        try:
+            if docstore == 'sqlite':
+                store = SQLiteDocstore(tmp.vector_url + FAISS_DOCSTORE_SUFFIX)
+            else:
+                store = InMemoryDocstore({})
+            index = None
+            index_to_docstore_id = {}
+            seen = set()
+            for batch in batches:
+                chunks = OrderedDict()
+                for doc, vector, _ in batch:
+                    _id = chunk_id(doc)
+                    if _id not in seen:
+                        seen.add(_id)
+                        chunks[_id] = (doc, vector)
+                if not chunks:
+                    continue
+                vectors = np.asarray([vector for _, vector in chunks.values()], dtype='float32')
+                if index is None:
+                    index = faiss.IndexFlatL2(vectors.shape[1])
+                store.add({_id: doc for _id, (doc, _) in chunks.items()})
+                for i, _id in enumerate(chunks, start=index.ntotal):
+                    index_to_docstore_id[i] = _id
+                index.add(vectors)
+            if index is None:
+                print(f"No chunks to import into {self.vector_url}")
+                self._remove_paths(tmp.vector_url + suffix for suffix in suffixes)
+                return False
+            db = FAISS(self.embeddings.embed_query, index, store, index_to_docstore_id)
+            if index_type != 'flat' or quantizer != 'none':
+                db = tmp._build_faiss_index(db, index_type, quantizer, **kwargs)
+            tmp._save_faiss(db, tmp.vector_url)
+        except BaseException:
+            self._remove_paths(tmp.vector_url + suffix for suffix in suffixes)
+            raise
+        # renames only, the index file last
+        for suffix in reversed(suffixes):
+            if os.path.exists(tmp.vector_url + suffix):
+                os.replace(tmp.vector_url + suffix, self.vector_url + suffix)
+            elif os.path.exists(self.vector_url + suffix):
+                os.remove(self.vector_url + suffix)
+        print(f"Saved {index.ntotal} chunks into {self.vector_url}")
+        return True
+
+    @staticmethod
+    def _remove_paths(paths):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _import_multi(self, batches, **kwargs):
+        """Every source goes into its sub-index, the chunks of a source must be
+        contiguous (as exported from a multi-index)."""
+        directory = multi_directory(self.vector_url)
+        os.makedirs(directory, exist_ok=True)
+        records = (record for batch in batches for record in batch)
+        imported = set()
+        for source, group in itertools.groupby(records, key=lambda record: record[2] or 'default'):
+            if source in imported:
+                raise ValueError(f"The chunks of source {source} are not contiguous, "
+                                 f"import into a single index instead")
+            imported.add(source)
+            entry = multi_read_manifest(directory).get(source) or multi_default_entry(source)
+            sub = Ingestor(multi_sub_url(directory, entry), [], self.embeddings, entry.get("index_name"))
+            print(f"Importing source {source} into {sub.vector_url}")
+            if not sub.import_batches(_batched(group, EXPORT_BATCH_SIZE), **dict(kwargs)):
+                continue
+            manifest = multi_read_manifest(directory)
+            manifest[source] = dict(entry, updated_at=time.time())
+            multi_write_manifest(directory, manifest)
+        return True
+
+
 class Loader(BaseEngine):
-    def __init__(self, vector_url):
-        super().__init__(vector_url)
+    def __init__(self, vector_url, embeddings=None, index_name=None):
+        super().__init__(vector_url, embeddings, index_name)
+
+    def _load_multi(self, **kwargs):
+        directory = multi_directory(self.vector_url)
+        manifest = multi_read_manifest(directory)
+        sources = kwargs.pop("sources", None) or sorted(manifest)
+        if not sources:
+            raise Exception(f"No sub-index found in {directory}")
+        missing = [name for name in sources if name not in manifest]
+        if missing:
+            raise Exception(f"Unknown sub-indexes {missing} in {directory}")
+
+        def load(name):
+            entry = manifest[name]
+            loader = Loader(multi_sub_url(directory, entry), self.embeddings, entry.get("index_name"))
+            return name, (loader.engine_name, loader.run(**kwargs))
+
+        with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+            indexes = dict(pool.map(load, sources))
+        max_per_index = int(kwargs.get("max_per_index") or os.environ.get("MULTI_INDEX_MAX_PER_INDEX", 0))
+        return MultiIndex(indexes, self.embeddings, max_per_index=max_per_index)
 
     def _load_redis(self, **kwargs):
+        from langchain.vectorstores.redis import Redis
         db = Redis.from_existing_index(self.embeddings, 
                                       redis_url=self.vector_url, 
-                                      index_name='plivoaskme')
+                                      index_name=self.index_name)
         return db 
 
     def _load_qdrant(self, **kwargs):
-        url = self.vector_url.replace("qdrant://", "") or None
-        api_key = os.environ.get("QDRANT_API_KEY", None)
-        if not url:
-            raise Exception(f"Qdrant URL not found: {url}")
-        client = QdrantClient(
-            url=url, api_key=api_key,
-            prefer_grpc=True
-        )
+        from qdrant_client import QdrantClient
+        from langchain.vectorstores.qdrant import Qdrant
+        client = QdrantClient(**self._qdrant_client_kwargs())
         db = Qdrant(
-            client=client, collection_name="plivoaskme",
+            client=client, collection_name=self.index_name,
             embeddings=self.embeddings
         )
         return db
@@ -310,7 +1494,8 @@ class Loader(BaseEngine):
         directory = self.vector_url.replace("chroma://", "") or None
         if not directory:
             raise Exception(f"Chroma directory not found: {directory}")
-        db = Chroma(persist_directory=self.vector_url, 
+        from langchain.vectorstores.chroma import Chroma
+        db = Chroma(persist_directory=directory,
                     embedding_function=self.embeddings)
         return db
 
@@ -319,12 +1504,112 @@ class Loader(BaseEngine):
             raise Exception(f"FAISS file not found: {self.vector_url}")
         with open(self.vector_url, "rb") as f:
             db = pickle.load(f)
+        if isinstance(db.docstore, SQLiteDocstore):
+            # the docstore always lives next to the index file
+            db.docstore.path = self.vector_url + FAISS_DOCSTORE_SUFFIX
+        faiss_set_search_params(db.index, **kwargs)
+        vectors_url = self.vector_url + FAISS_VECTORS_SUFFIX
+        rescore_factor = int(_option(kwargs, "rescore_factor", "FAISS_RESCORE_FACTOR", 4))
+        if rescore_factor > 0 and os.path.exists(vectors_url):
+            # memory mapped: pages are shared between processes and only read for the candidates
+            vectors = np.load(vectors_url, mmap_mode='r')
+            if vectors.shape[0] == db.index.ntotal:
+                db.index = FaissRescoringIndex(db.index, vectors, rescore_factor)
+            else:
+                print(f"Ignoring {vectors_url}: {vectors.shape[0]} vectors, index has {db.index.ntotal}")
+        if not isinstance(db.index, FaissRescoringIndex):
+            # the vectors of the hits are reconstructed from the index
+            faiss_make_direct_map(db.index)
         return db
 
+    def export(self, batch_size=EXPORT_BATCH_SIZE, **kwargs):
+        """Yield the [(Document, vector, source)] batches of the index, source
+        being the sub-index (multi-index) or the ingested source (Redis, Qdrant)."""
+        export_func = getattr(self, f"_export_{self.engine_name}", None)
+        if not export_func:
+            raise ValueError(f"Exporting from {self.engine_name} is not supported")
+        return export_func(batch_size, **kwargs)
+
+    def _export_faiss(self, batch_size, **kwargs):
+        db = self._load_faiss(**kwargs)
+        for start in range(0, db.index.ntotal, batch_size):
+            n = min(batch_size, db.index.ntotal - start)
+            batch = []
+            for i, vector in enumerate(faiss_reconstruct_n(db.index, start, n), start=start):
+                doc = db.docstore.search(db.index_to_docstore_id[i])
+                if isinstance(doc, Document):
+                    batch.append((doc, vector, None))
+            yield batch
+
+    def _export_redis(self, batch_size, **kwargs):
+        db = self._load_redis()
+
+        def read(keys):
+            pipe = db.client.pipeline(transaction=False)
+            for key in keys:
+                pipe.hmget(key, db.content_key, db.metadata_key, db.vector_key, 'ingest_source')
+            batch = []
+            for content, metadata, vector, source in pipe.execute():
+                if content is None or vector is None:
+                    continue
+                doc = Document(page_content=content.decode('utf-8'), metadata=json.loads(metadata or '{}'))
+                batch.append((doc, np.frombuffer(vector, dtype=np.float32), source.decode() if source else None))
+            return batch
+
+        keys = []
+        for key in db.client.scan_iter(match=f"doc:{self.index_name}:*", count=batch_size):
+            keys.append(key)
+            if len(keys) == batch_size:
+                yield read(keys)
+                keys = []
+        if keys:
+            yield read(keys)
+
+    def _export_qdrant(self, batch_size, **kwargs):
+        from qdrant_client import QdrantClient
+        from langchain.vectorstores.qdrant import Qdrant
+        client = QdrantClient(**self._qdrant_client_kwargs())
+        offset = None
+        while True:
+            points, offset = client.scroll(self.index_name, limit=batch_size, offset=offset,
+                                           with_payload=True, with_vectors=True)
+            batch = []
+            for point in points:
+                payload = point.payload or {}
+                doc = Document(page_content=payload.get(Qdrant.CONTENT_KEY) or '',
+                               metadata=payload.get(Qdrant.METADATA_KEY) or {})
+                batch.append((doc, np.asarray(point.vector, dtype='float32'), payload.get('ingest_source') or None))
+            if batch:
+                yield batch
+            if offset is None:
+                return
+
+    def _export_chroma(self, batch_size, **kwargs):
+        db = self._load_chroma()
+        offset = 0
+        while True:
+            data = db._collection.get(include=['embeddings', 'documents', 'metadatas'],
+                                      limit=batch_size, offset=offset)
+            if not data['ids']:
+                return
+            yield [(Document(page_content=text, metadata=metadata or {}), np.asarray(vector, dtype='float32'), None)
+                   for text, metadata, vector in zip(data['documents'], data['metadatas'], data['embeddings'])]
+            offset += len(data['ids'])
+
+    def _export_multi(self, batch_size, **kwargs):
+        directory = multi_directory(self.vector_url)
+        for name, entry in sorted(multi_read_manifest(directory).items()):
+            sub = Loader(multi_sub_url(directory, entry), self.embeddings, entry.get("index_name"))
+            print(f"Exporting sub-index {name} from {sub.vector_url}")
+            for batch in sub.export(batch_size, **kwargs):
+                yield [(doc, vector, name) for doc, vector, _ in batch]
+
     def run(self, **kwargs):
         return self._load(**kwargs)
 
     @classmethod
     def load(cls, vector_url, **kwargs):
-        return cls(vector_url).run(**kwargs)
+        embeddings = kwargs.pop("embeddings", None)
+        index_name = kwargs.pop("index_name", None)
+        return cls(vector_url, embeddings, index_name).run(**kwargs)
 
@@ -0,0 +1,260 @@
+"""Supervised pool of RQ workers sharing one copy of the vector index.
+
+The parent process loads the index once, freezes the GC (so its objects are
+not touched and stay shared copy-on-write) and forks SimpleWorkers, which
+run the jobs in their own process instead of forking a work horse per job.
+The number of workers is scaled between RQ_WORKERS_MIN and RQ_WORKERS_MAX
+from the queue depth and the wait time of the oldest queued job.
+
+With several knowledge bases (see knowledge_bases.py) the parent preloads the
+default one, then the others while they fit in INDEX_CACHE_MAX_MB.
+
+With a versioned VECTOR_DATABASE (see index_versions.py) only the parent
+watches the versions: it loads and warms every new version in the background,
+switches to it, then stops the workers (after their current job) and forks
+new ones sharing the new version. The workers never load a version themselves,
+which would give each of them a private copy.
+
+On SIGTERM/SIGINT the pool drains: every worker finishes its current job
+(RQ warm shutdown) and is killed after RQ_POOL_DRAIN_TIMEOUT.
+
+    python3 worker_pool.py
+"""
+import os
+import gc
+import sys
+import time
+import math
+import signal
+from datetime import datetime
+from redis import Redis
+from rq import Queue, SimpleWorker, Worker
+
+from faqbot import FAQBot
+from index_versions import IndexVersions, is_versioned
+from admission import QUEUES, queue_wait
+import metrics
+import knowledge_bases
+import settings
+
+
+class WorkerPool(object):
+    def __init__(self, min_workers=1, max_workers=4, jobs_per_worker=1,
+                 scale_up_wait=5.0, scale_down_idle=60.0, interval=2.0,
+                 drain_timeout=300.0, queue_names=QUEUES):
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.jobs_per_worker = jobs_per_worker
+        self.scale_up_wait = scale_up_wait
+        self.scale_down_idle = scale_down_idle
+        self.interval = interval
+        self.drain_timeout = drain_timeout
+        # in priority order, workers always drain the first queue first
+        self.queue_names = queue_names
+        self.conn = Redis()
+        self.queues = [Queue(name, connection=self.conn) for name in queue_names]
+        self.children = {}
+        self.stopping = set()
+        self._draining = False
+        # current version of the versioned knowledge bases the parent didn't preload
+        self._current_urls = {}
+        self._idle_since = time.time()
+
+    def log(self, msg, **data):
+        _log = {'component': 'worker_pool', 'timestamp': str(datetime.utcnow()), 'msg': msg}
+        _log.update(data)
+        print(_log, flush=True)
+
+    def preload(self):
+        start = time.perf_counter()
+        # the default knowledge base first, then the others while they fit in the index cache
+        names = [knowledge_bases.default_name()]
+        names += [name for name in knowledge_bases.knowledge_bases() if name not in names]
+        cache = FAQBot.index_cache()
+        vector_urls = []
+        # counts the index cache loads and evictions, no question to add them to
+        with metrics.Spans() as spans:
+            for name in names:
+                if vector_urls and cache.max_bytes and cache.bytes() >= cache.max_bytes:
+                    break
+                vector_urls.append(FAQBot.serving_url(name))
+                FAQBot.load_db(vector_urls[-1], name)
+        spans.flush(self.conn)
+        FAQBot.preload_imports()
+        load_seconds = time.perf_counter() - start
+        metrics.set_gauge('askme_index_loaded_timestamp_seconds', time.time(), self.conn)
+        metrics.set_gauge('askme_index_load_seconds', load_seconds, self.conn)
+        # keep the preloaded objects out of the collector, so the children never
+        # write to (and copy) their pages
+        gc.freeze()
+        metrics.set_gauge('askme_index_cache_bytes', cache.bytes(), self.conn)
+        self.log('Preloaded index', vector_urls=vector_urls, load_seconds=round(load_seconds, 3))
+
+    def refresh_index(self):
+        """Switch to the new index versions loaded in the background and replace
+        the workers, so that they are forked again onto the shared new versions."""
+        switched = []
+        with metrics.Spans() as spans:
+            for name, kb in knowledge_bases.knowledge_bases().items():
+                if not is_versioned(kb.vector_database):
+                    continue
+                active = FAQBot.active_url(name)
+                if active is None:
+                    # not preloaded: the workers load it on their first question, replace
+                    # them when its version changes
+                    url = IndexVersions(kb.vector_database).current_url()
+                    if self._current_urls.setdefault(name, url) != url:
+                        self._current_urls[name] = url
+                        switched.append(url)
+                elif FAQBot.serving_url(name) != active:
+                    switched.append(FAQBot.active_url(name))
+        spans.flush(self.conn)
+        if not switched:
+            return
+        gc.freeze()
+        workers = len(self.children) - len(self.stopping)
+        self.log('Switched index', vector_urls=switched, workers=workers)
+        # RQ warm shutdown: the old workers finish their current job
+        for pid in list(self.children):
+            self.stop(pid)
+        for _ in range(max(workers, self.min_workers)):
+            self.spawn()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            FAQBot.watch_versions = False
+            # the parent releases its lease when it switches, not when this worker is done
+            FAQBot.lease_versions()
+            conn = Redis()
+            worker = SimpleWorker([Queue(name, connection=conn) for name in self.queue_names], connection=conn)
+            try:
+                worker.work()
+            finally:
+                # the leases of dead pids are dropped by the version gc
+                os._exit(0)
+        self.children[pid] = time.time()
+        self.log('Started worker', pid=pid, workers=len(self.children))
+        return pid
+
+    def stop(self, pid):
+        if pid in self.stopping:
+            return
+        self.stopping.add(pid)
+        try:
+            # RQ warm shutdown: finish the current job then exit
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        self.log('Stopping worker', pid=pid)
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            self.children.pop(pid, None)
+            expected = pid in self.stopping
+            self.stopping.discard(pid)
+            self.log('Worker exited', pid=pid, status=status, expected=expected)
+
+    def oldest_wait(self):
+        return max(queue_wait(queue) for queue in self.queues)
+
+    def idle_workers(self):
+        idle = []
+        for worker in Worker.all(connection=self.conn):
+            if worker.pid in self.children and worker.pid not in self.stopping \
+                    and worker.get_state() == 'idle':
+                idle.append(worker.pid)
+        return idle
+
+    def desired(self, depth, wait, active):
+        if depth > 0:
+            self._idle_since = time.time()
+        if depth > active * self.jobs_per_worker or wait > self.scale_up_wait:
+            target = active + int(math.ceil(depth / float(self.jobs_per_worker)))
+        elif depth == 0 and time.time() - self._idle_since > self.scale_down_idle:
+            target = active - 1
+        else:
+            target = active
+        return min(self.max_workers, max(self.min_workers, target))
+
+    def scale(self):
+        depth = sum(len(queue) for queue in self.queues)
+        wait = self.oldest_wait()
+        active = len(self.children) - len(self.stopping)
+        target = self.desired(depth, wait, active)
+        if target > active:
+            self.log('Scaling up', queue_depth=depth, oldest_wait=round(wait, 3), workers=active, target=target)
+            for _ in range(target - active):
+                self.spawn()
+        elif target < active:
+            idle = self.idle_workers()
+            if idle:
+                self.log('Scaling down', queue_depth=depth, workers=active, target=target)
+                for pid in idle[:active - target]:
+                    self.stop(pid)
+                self._idle_since = time.time()
+        metrics.set_gauge('askme_workers', len(self.children) - len(self.stopping), self.conn)
+
+    def drain(self, *args):
+        if self._draining:
+            return
+        self._draining = True
+        self.log('Draining workers', workers=len(self.children))
+        for pid in list(self.children):
+            self.stop(pid)
+
+    def run(self):
+        self.preload()
+        signal.signal(signal.SIGTERM, self.drain)
+        signal.signal(signal.SIGINT, self.drain)
+        for _ in range(self.min_workers):
+            self.spawn()
+        while not self._draining:
+            self.reap()
+            try:
+                self.refresh_index()
+            except Exception as e:
+                self.log('Index switch failed', error=str(e))
+            try:
+                self.scale()
+            except Exception as e:
+                self.log('Scaling failed', error=str(e))
+            time.sleep(self.interval)
+
+        deadline = time.time() + self.drain_timeout
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.5)
+        for pid in list(self.children):
+            self.log('Killing worker after drain timeout', pid=pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            self.children.pop(pid, None)
+        metrics.set_gauge('askme_workers', 0, self.conn)
+        self.log('Drained')
+
+
+def main():
+    pool = WorkerPool(min_workers=getattr(settings, 'RQ_WORKERS_MIN', 1),
+                      max_workers=getattr(settings, 'RQ_WORKERS_MAX', 4),
+                      jobs_per_worker=getattr(settings, 'RQ_JOBS_PER_WORKER', 1),
+                      scale_up_wait=getattr(settings, 'RQ_SCALE_UP_WAIT', 5.0),
+                      scale_down_idle=getattr(settings, 'RQ_SCALE_DOWN_IDLE', 60.0),
+                      drain_timeout=getattr(settings, 'RQ_POOL_DRAIN_TIMEOUT', 300.0))
+    pool.run()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()